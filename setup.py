@@ -23,6 +23,7 @@ testing_extras = [
     'WebTest == 2.0.18',
     'mock == 1.0.1',
     'nosexcover == 1.0.8',
+    'fakeredis == 0.8.2',
 ]
 
 setup(name='eduid_idp',
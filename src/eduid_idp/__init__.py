@@ -40,6 +40,9 @@ __authors__ = ['Fredrik Thulin']
 import eduid_idp.config
 import eduid_idp.idp_user
 import eduid_idp.service
+import eduid_idp.stats
+import eduid_idp.breaker
+import eduid_idp.policy
 import eduid_idp.cache
 import eduid_idp.login
 import eduid_idp.logout
@@ -50,4 +53,5 @@ import eduid_idp.assurance
 import eduid_idp.thirdparty
 import eduid_idp.sso_session
 import eduid_idp.authn
+import eduid_idp.vccs
 import eduid_idp.util
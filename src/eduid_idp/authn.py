@@ -37,16 +37,43 @@ Module handling authentication of users. Also applies login policies
 such as rate limiting.
 """
 
+import copy
+import Queue
+import httplib
 import datetime
+import threading
+import pymongo
+import multiprocessing.pool
 import vccs_client
 
 import eduid_idp.assurance
 import eduid_idp.error
+import eduid_idp.stats
+import eduid_idp.vccs
+import eduid_idp.breaker
 
 from eduid_userdb import MongoDB, Password
 from eduid_userdb.exceptions import UserHasNotCompletedSignup
 from eduid_common.authn import get_vccs_client
 
+# number of threads checking passwords with VCCS when vccs_concurrent_verify is enabled, unless
+# vccs_pool_size is set (there is no point in having more threads than connections to VCCS)
+_VERIFY_WORKERS = 5
+
+
+def _is_vccs_failure(exc):
+    """
+    Check if an HTTP error from VCCS means that it is failing.
+
+    A failing VCCS behind a proxy results in 502, 503 or 504 errors. Other errors are
+    responses from VCCS itself - in particular 500, which VCCS returns for revoked
+    credentials (see _authn_factor()), and must not make the breaker fail all logins.
+
+    :type exc: Exception
+    :rtype: bool
+    """
+    return isinstance(exc, vccs_client.VCCSClientHTTPError) and exc.http_code in (502, 503, 504)
+
 
 class IdPAuthn(object):
     """
@@ -64,10 +91,63 @@ class IdPAuthn(object):
         self.userdb = userdb
         self.auth_client = auth_client
         if self.auth_client is None:
-            self.auth_client = get_vccs_client(config.vccs_url)
+            if config.vccs_pool_size:
+                self.auth_client = eduid_idp.vccs.PooledVCCSClient(config.vccs_url, logger,
+                                                                   pool_size = config.vccs_pool_size,
+                                                                   timeout = config.vccs_timeout)
+            else:
+                self.auth_client = get_vccs_client(config.vccs_url)
         self.authn_store = authn_store
         if self.authn_store is None and config.mongo_uri:
             self.authn_store = AuthnInfoStoreMDB(uri = config.mongo_uri, logger = logger)
+        _breaker_args = {'failure_threshold': config.breaker_failure_threshold,
+                         'latency_threshold': config.breaker_latency_threshold,
+                         'reset_timeout': config.breaker_reset_timeout,
+                         }
+        self.vccs_breaker = eduid_idp.breaker.CircuitBreaker(
+            'vccs', logger, (IOError, httplib.HTTPException, eduid_idp.vccs.VCCSPoolTimeout),
+            is_failure = _is_vccs_failure, **_breaker_args)
+        self.authn_store_breaker = eduid_idp.breaker.CircuitBreaker(
+            'authn_info', logger, (pymongo.errors.ConnectionFailure,), **_breaker_args)
+        self.authn_log = None
+        if self.authn_store and config.authn_log_flush_interval:
+            self.authn_log = AuthnLogWriter(self.authn_store, logger,
+                                            interval = config.authn_log_flush_interval,
+                                            max_pending = config.authn_log_max_pending)
+            self.authn_log.start()
+        self._verify_pool = None
+        if config.vccs_concurrent_verify:
+            self._verify_pool = multiprocessing.pool.ThreadPool(config.vccs_pool_size or _VERIFY_WORKERS)
+
+    def with_config(self, config, userdb):
+        """
+        Get a copy of this IdPAuthn using another configuration (see IdPApplication.reload_config()).
+
+        The VCCS client, authn info store, authn log writer, circuit breakers and verification
+        threads are shared with this instance.
+
+        :param config: IdP configuration data
+        :param userdb: User database, using the same configuration
+
+        :type config: eduid_idp.config.IdPConfig
+        :type userdb: eduid_idp.idp_user.IdPUserDb
+        :rtype: IdPAuthn
+        """
+        res = copy.copy(self)
+        res.config = config
+        res.userdb = userdb
+        return res
+
+    def stop(self):
+        """
+        Write any queued authn log events to the database, e.g. on shutdown.
+
+        :return: None
+        """
+        if self.authn_log:
+            self.authn_log.stop()
+        if self._verify_pool:
+            self._verify_pool.close()
 
     def get_authn_user(self, login_data, user_authn):
         """
@@ -130,7 +210,8 @@ class IdPAuthn(object):
         :rtype: IdPUser | None
         """
         try:
-            user = self.userdb.lookup_user(username)
+            # the credentials might have changed since the user was cached
+            user = self.userdb.lookup_user(username, use_cache = False)
         except UserHasNotCompletedSignup:
             # XXX Redirect user to some kind of info page
             user = None
@@ -141,8 +222,10 @@ class IdPAuthn(object):
             return None
         self.logger.debug("Found user {!r}".format(user))
 
+        authn_info = None
         if self.authn_store:  # requires optional configuration
-            authn_info = self.authn_store.get_user_authn_info(user)
+            with self.authn_store_breaker.call():
+                authn_info = self.authn_store.get_user_authn_info(user)
             if authn_info.failures_this_month() > self.config.max_authn_failures_per_month:
                 self.logger.info("User {!r} AuthN failures this month {!r} > {!r}".format(
                     user, authn_info.failures_this_month(), self.config.max_authn_failures_per_month))
@@ -161,9 +244,9 @@ class IdPAuthn(object):
         else:
             creds = user.passwords.to_list()
 
-        return self._authn_passwords(user, username, password, creds)
+        return self._authn_passwords(user, username, password, creds, authn_info)
 
-    def _authn_passwords(self, user, username, password, credentials):
+    def _authn_passwords(self, user, username, password, credentials, authn_info = None):
         """
         Perform the final actual authentication of a user based on a list of (password) credentials.
 
@@ -171,14 +254,17 @@ class IdPAuthn(object):
         :param username: Username provided
         :param password: Password provided
         :param credentials: Authn credentials to try
+        :param authn_info: Stored authn information for the user, if loaded already
         :return: User | None
 
         :type user: IdPUser
         :type username: string
         :type password: string
         :type credentials: [Password]
+        :type authn_info: UserAuthnInfo | None
         :rtype: IdPUser | None
         """
+        factors = []
         for cred in credentials:
             if isinstance(cred, Password):
                 try:
@@ -186,41 +272,117 @@ class IdPAuthn(object):
                 except ValueError as exc:
                     self.logger.info("User {!r} password factor {!s} unusable: {!r}".format(username, cred.id, exc))
                     continue
-                self.logger.debug("Password-authenticating {!r}/{!r} with VCCS: {!r}".format(
-                    username, str(cred.id), factor))
-                user_id = str(user.user_id)
-                try:
-                    if self.auth_client.authenticate(user_id, [factor]):
-                        self.logger.debug("VCCS authenticated user {!r} (user_id {!r})".format(user, user_id))
-                        # Verify that the credential had been successfully used in the last 18 monthts
-                        # (Kantara AL2_CM_CSM#050).
-                        if self.credential_expired(cred):
-                            self.logger.info('User {!r} credential {!s} has expired'.format(user, cred.key))
-                            raise eduid_idp.error.Forbidden('CREDENTIAL_EXPIRED')
-                        self.log_authn(user, success=[cred.id], failure=[])
-                        return user
-                except vccs_client.VCCSClientHTTPError as exc:
-                    if exc.http_code == 500:
-                        self.logger.debug("VCCS credential {!r} might be revoked".format(cred.id))
-                        continue
+                factors.append((cred, factor))
             else:
                 self.logger.debug("Unknown credential: {!s}".format(cred))
+        if self._verify_pool is not None and len(factors) > 1:
+            cred = self._authn_factors_concurrently(user, username, factors)
+        else:
+            cred = None
+            for this, factor in factors:
+                if self._authn_factor(user, username, this, factor):
+                    cred = this
+                    break
+        if cred is not None:
+            # Verify that the credential had been successfully used in the last 18 monthts
+            # (Kantara AL2_CM_CSM#050).
+            if self.credential_expired(cred, authn_info):
+                self.logger.info('User {!r} credential {!s} has expired'.format(user, cred.key))
+                raise eduid_idp.error.Forbidden('CREDENTIAL_EXPIRED')
+            self.log_authn(user, success=[cred.id], failure=[])
+            return user
         self.logger.debug("VCCS username-password authentication FAILED for user {!r}".format(user))
         self.log_authn(user, success=[], failure=[cred.id for cred in user.passwords.to_list()])
         return None
 
-    def credential_expired(self, cred):
+    def _authn_factor(self, user, username, cred, factor):
+        """
+        Check a single password factor with VCCS.
+
+        :param user: User object
+        :param username: Username provided
+        :param cred: Password credential
+        :param factor: Password factor for cred
+
+        :type user: IdPUser
+        :type username: string
+        :type cred: Password
+        :type factor: vccs_client.VCCSPasswordFactor
+        :rtype: bool
+        """
+        self.logger.debug("Password-authenticating {!r}/{!r} with VCCS: {!r}".format(
+            username, str(cred.id), factor))
+        user_id = str(user.user_id)
+        try:
+            with self.vccs_breaker.call():
+                _success = self.auth_client.authenticate(user_id, [factor])
+            if _success:
+                self.logger.debug("VCCS authenticated user {!r} (user_id {!r})".format(user, user_id))
+                return True
+        except vccs_client.VCCSClientHTTPError as exc:
+            if exc.http_code == 500:
+                self.logger.debug("VCCS credential {!r} might be revoked".format(cred.id))
+        return False
+
+    def _authn_factors_concurrently(self, user, username, factors):
+        """
+        Check a number of password factors with VCCS at the same time.
+
+        VCCS requires all factors in a single authenticate() request to be valid, so
+        one request per factor is made, using the shared pool of verification threads
+        (so the number of parallel requests to VCCS is bounded). The first factor found
+        to be valid is returned without waiting for the remaining requests.
+
+        :param user: User object
+        :param username: Username provided
+        :param factors: Password credentials and their factors
+
+        :type user: IdPUser
+        :type username: string
+        :type factors: [(Password, vccs_client.VCCSPasswordFactor)]
+        :return: The credential the password was valid for, if any
+        :rtype: Password | None
+        """
+        results = Queue.Queue()
+
+        def _verify(cred, factor):
+            try:
+                results.put((cred, self._authn_factor(user, username, cred, factor), None))
+            except Exception as exc:
+                results.put((cred, False, exc))
+
+        for cred, factor in factors:
+            self._verify_pool.apply_async(_verify, (cred, factor))
+        error = None
+        for _ in range(len(factors)):
+            cred, success, exc = results.get()
+            if success:
+                return cred
+            if exc is not None and error is None:
+                error = exc
+        if error is not None:
+            # same as when checking the credentials one by one
+            raise error
+        return None
+
+    def credential_expired(self, cred, authn_info = None):
         """
         Check that a credential hasn't been unused for too long according to Kantara AL2_CM_CSM#050.
         :param cred: Authentication credential
+        :param authn_info: Stored authn information for the user, if loaded already
 
         :type cred: Password
+        :type authn_info: UserAuthnInfo | None
         :rtype: bool
         """
         if not self.authn_store:  # requires optional configuration
             self.logger.debug("Can't check if credential {!r} is expired, no authn_store available".format(cred.key))
             return False
-        last_used = self.authn_store.get_credential_last_used(cred.id)
+        if authn_info is not None and authn_info.has_credential(cred.id):
+            last_used = authn_info.credential_last_used(cred.id)
+        else:
+            with self.authn_store_breaker.call():
+                last_used = self.authn_store.get_credential_last_used(cred.id)
         if last_used is None:
             # Can't disallow this while there is a short-path from signup to dashboard unforch...
             self.logger.debug('Allowing never-used credential {!r}'.format(cred))
@@ -245,6 +407,9 @@ class IdPAuthn(object):
         """
         if not self.authn_store:  # requires optional configuration
             return None
+        if self.authn_log:
+            self.authn_log.log_authn(user.user_id, success, failure)
+            return None
         if success:
             self.authn_store.credential_success(success)
         if success or failure:
@@ -260,6 +425,20 @@ class AuthnInfoStore(object):
         self.logger = logger
 
 
+class AuthnLogWriteError(pymongo.errors.PyMongoError):
+    """
+    Some of the writes made by AuthnInfoStoreMDB.bulk_log_authn() failed.
+
+    :param message: Description of the error
+    :param credentials: The credentials that were not written
+    :param users: The users that were not written
+    """
+    def __init__(self, message, credentials, users):
+        pymongo.errors.PyMongoError.__init__(self, message)
+        self.credentials = credentials
+        self.users = users
+
+
 class AuthnInfoStoreMDB(AuthnInfoStore):
     """
     This is a MongoDB version of AuthnInfoStore().
@@ -348,6 +527,60 @@ class AuthnInfoStoreMDB(AuthnInfoStore):
             }, upsert = True, new = True, multi = False)
         return None
 
+    def bulk_log_authn(self, credentials, users):
+        """
+        Write the result of a number of authentications, coalesced by AuthnLogWriter,
+        to the database in one bulk operation.
+
+        The writes are equivalent to the ones made by credential_success() and update_user().
+
+        :param credentials: Last successful use of credentials
+        :param users: Data for update_user(), as (success, ts, counts) where counts
+                      are increments of the fail_count and success_count fields.
+        :return: None
+
+        :type credentials: {bson.ObjectId: datetime.datetime}
+        :type users: {bson.ObjectId: ([bson.ObjectId], datetime.datetime, {str: int})}
+
+        :raises AuthnLogWriteError: when some of the writes failed (and the others were made)
+        :raises pymongo.errors.PyMongoError: when the bulk operation failed
+        """
+        bulk = self.collection.initialize_unordered_bulk_op()
+        # the operations in the order they were added, to find the ones in bulk write errors
+        ops = []
+        for cred_id, ts in credentials.items():
+            bulk.find({'_id': cred_id}).upsert().replace_one({'_id': cred_id,
+                                                              'success_ts': ts,
+                                                              })
+            ops.append((cred_id, None))
+        for user_id, (success, ts, counts) in users.items():
+            bulk.find({'_id': user_id}).upsert().update_one({
+                '$set': {
+                    'success_ts': ts,
+                    'last_credential_ids': success,
+                },
+                '$inc': counts,
+            })
+            ops.append((None, user_id))
+        try:
+            bulk.execute()
+        except pymongo.errors.BulkWriteError as exc:
+            # An unordered bulk operation makes all the writes it can, so only the failed
+            # ones may be written again (re-applying the $inc of the others would inflate
+            # the fail counts). Write concern errors are for writes that were made.
+            _failed_credentials = {}
+            _failed_users = {}
+            for error in exc.details.get('writeErrors', []):
+                cred_id, user_id = ops[error['index']]
+                if cred_id is not None:
+                    _failed_credentials[cred_id] = credentials[cred_id]
+                else:
+                    _failed_users[user_id] = users[user_id]
+            raise AuthnLogWriteError('{!s} of {!s} writes failed: {!r}'.format(
+                len(_failed_credentials) + len(_failed_users), len(ops), exc.details.get('writeErrors')),
+                _failed_credentials, _failed_users)
+        return None
+
     def unlock_user(self, user_id, fail_count = 0, ts=None):
         """
         Set the fail count for a specific user and month.
@@ -379,17 +612,27 @@ class AuthnInfoStoreMDB(AuthnInfoStore):
 
     def get_user_authn_info(self, user):
         """
-        Load stored Authn information for user.
+        Load stored Authn information for user, and for the user's password credentials.
+
+        The information about the user and the credentials (written by update_user() and
+        credential_success() respectively) is loaded using a single query, so that a
+        password login only needs one round trip to the database before the credentials
+        are verified.
 
         :param user: User object
 
         :type user: IdPUser
         :rtype: UserAuthnInfo
         """
-        data = self.collection.find({'_id': user.user_id})
-        if not data.count():
-            return UserAuthnInfo({})
-        return UserAuthnInfo(data[0])
+        _cred_ids = [x.id for x in user.passwords.to_list()]
+        data = {}
+        last_used = dict([(x, None) for x in _cred_ids])
+        for this in self.collection.find({'_id': {'$in': [user.user_id] + _cred_ids}}):
+            if this['_id'] == user.user_id:
+                data = this
+            else:
+                last_used[this['_id']] = this.get('success_ts')
+        return UserAuthnInfo(data, credentials_last_used = last_used)
 
     def get_credential_last_used(self, cred_id):
         """
@@ -401,19 +644,186 @@ class AuthnInfoStoreMDB(AuthnInfoStore):
         :return: None | datetime.datetime
         """
         # Locate documents written by credential_success() above
-        data = self.collection.find({'_id': cred_id})
-        if not data.count():
+        data = self.collection.find_one({'_id': cred_id})
+        if not data:
             return None
-        return data[0]['success_ts']
+        return data['success_ts']
+
+
+class AuthnLogWriter(threading.Thread):
+    """
+    Background thread writing authentication results to an AuthnInfoStoreMDB, to keep
+    the MongoDB writes out of the login request.
+
+    Authentications of the same user are coalesced until the next flush, which writes
+    everything queued using a single bulk operation. At most `max_pending' users are
+    queued - authentications of further users are written directly (and counted as
+    'overflow') until the queue has been flushed, since dropping failed authentications
+    would weaken the max_authn_failures_per_month limit. Queued authentications that
+    fail to be written are queued again (regardless of `max_pending'), and tried on
+    the next flush.
+
+    Note that the fail counts checked on login, and the last use of credentials, are
+    only updated in the database when the queue is flushed.
+
+    :param store: Where to write the authentication results
+    :param logger: logging logger instance
+    :param interval: seconds between flushes
+    :param max_pending: maximum number of users to queue authentications for
+
+    :type store: AuthnInfoStoreMDB
+    :type logger: logging.Logger
+    :type interval: int
+    :type max_pending: int
+    """
+
+    def __init__(self, store, logger, interval = 1, max_pending = 10000):
+        threading.Thread.__init__(self, name = 'AuthnLogWriter')
+        self.daemon = True
+        self.logger = logger
+        self.stats = eduid_idp.stats.Stats()
+        self._store = store
+        self._interval = interval
+        self._max_pending = max_pending
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._stop_event = threading.Event()
+        self._credentials = {}
+        self._users = {}
+
+    def run(self):
+        while not self._stop_event.wait(self._interval):
+            self.flush()
+
+    def stop(self):
+        """
+        Make the writer thread exit, and write anything still queued.
+        """
+        self._stop_event.set()
+        self.flush()
+
+    def log_authn(self, user_id, success, failure, ts = None):
+        """
+        Queue the result of an authentication, see IdPAuthn.log_authn().
+
+        :param user_id: User identifier
+        :param success: List of Credential Ids successfully authenticated
+        :param failure: List of Credential Ids for which authentication failed
+        :param ts: Optional timestamp
+        :return: False if the queue was full, and the authentication was written directly
+
+        :type user_id: bson.ObjectId
+        :type success: [bson.ObjectId]
+        :type failure: [bson.ObjectId]
+        :type ts: datetime.datetime | None
+        :rtype: bool
+
+        :raises pymongo.errors.PyMongoError: when the queue was full, and writing directly failed
+        """
+        if ts is None:
+            ts = datetime.datetime.utcnow()
+        this_month = str((ts.year * 100) + ts.month)  # format year-month as integer (e.g. 201402)
+        counts = {'fail_count.' + this_month: len(failure),
+                  'success_count.' + this_month: len(success),
+                  }
+        credentials = dict([(x, ts) for x in success])
+        users = {user_id: (success, ts, counts)}
+        self.stats.incr('events')
+        with self._lock:
+            res = self._queue(credentials, users)
+        if not res:
+            self.logger.error('Authn log queue full, writing authentication of user {!s} directly'.format(user_id))
+            self.stats.incr('overflow')
+            with self.stats.timed('flush'):
+                self._store.bulk_log_authn(credentials, users)
+        return res
+
+    def _queue(self, credentials, users, force = False):
+        """
+        Coalesce authentication results with the ones already queued.
+
+        Must be called with the lock held.
+
+        :param force: Queue the results even if more than max_pending users are queued
+
+        :type credentials: {bson.ObjectId: datetime.datetime}
+        :type users: {bson.ObjectId: ([bson.ObjectId], datetime.datetime, {str: int})}
+        :type force: bool
+        :return: False if nothing was queued because the queue was full
+        :rtype: bool
+        """
+        _new = [x for x in users if x not in self._users]
+        if _new and not force and len(self._users) + len(_new) > self._max_pending:
+            return False
+        for user_id, (success, ts, counts) in users.items():
+            if user_id in self._users:
+                _old_success, _old_ts, _old_counts = self._users[user_id]
+                for k, v in _old_counts.items():
+                    counts[k] = counts.get(k, 0) + v
+                if _old_ts > ts:
+                    success, ts = _old_success, _old_ts
+                self.stats.incr('coalesced')
+            self._users[user_id] = (success, ts, counts)
+        for cred_id, ts in credentials.items():
+            self._credentials[cred_id] = max(ts, self._credentials.get(cred_id, ts))
+        return True
+
+    def flush(self):
+        """
+        Write everything queued to the database.
+
+        :return: None
+        """
+        with self._flush_lock:
+            with self._lock:
+                credentials, self._credentials = self._credentials, {}
+                users, self._users = self._users, {}
+            if not credentials and not users:
+                return None
+            try:
+                with self.stats.timed('flush'):
+                    self._store.bulk_log_authn(credentials, users)
+            except AuthnLogWriteError as exc:
+                # the other writes were made, and must not be made again
+                self.logger.error('Failed writing authn log ({!s} of {!s} users), will retry: {!s}'.format(
+                    len(exc.users), len(users), exc))
+                self.stats.incr('write_errors')
+                with self._lock:
+                    self._queue(exc.credentials, exc.users, force = True)
+            except pymongo.errors.PyMongoError as exc:
+                self.logger.error('Failed writing authn log ({!s} users), will retry: {!r}'.format(len(users), exc))
+                self.stats.incr('write_errors')
+                with self._lock:
+                    self._queue(credentials, users, force = True)
+        return None
+
+    def get_stats(self):
+        """
+        Get statistics about the queue.
+
+        :rtype: dict
+        """
+        res = self.stats.to_dict()
+        with self._lock:
+            res['pending_users'] = len(self._users)
+            res['pending_credentials'] = len(self._credentials)
+        return res
 
 
 class UserAuthnInfo(object):
     """
     Interpret data loaded from the AuthnInfoStore.
+
+    :param data: Authn information about the user
+    :param credentials_last_used: Timestamps of last successful use of credentials (None if never used)
+
+    :type data: dict
+    :type credentials_last_used: {bson.ObjectId: datetime.datetime | None} | None
     """
 
-    def __init__(self, data):
+    def __init__(self, data, credentials_last_used = None):
         self._data = data
+        self._credentials_last_used = credentials_last_used or {}
 
     def failures_this_month(self, ts=None):
         """
@@ -440,3 +850,25 @@ class UserAuthnInfo(object):
         :rtype: [bson.ObjectId]
         """
         return self._data.get('last_credential_ids', [])
+
+    def has_credential(self, cred_id):
+        """
+        Check if information about a credential was loaded together with the user.
+
+        :param cred_id: Id of credential
+
+        :type cred_id: bson.ObjectId
+        :rtype: bool
+        """
+        return cred_id in self._credentials_last_used
+
+    def credential_last_used(self, cred_id):
+        """
+        Get the timestamp for when a specific credential was last used successfully.
+
+        :param cred_id: Id of credential
+
+        :type cred_id: bson.ObjectId
+        :rtype: None | datetime.datetime
+        """
+        return self._credentials_last_used.get(cred_id)
@@ -0,0 +1,230 @@
+#
+# Copyright (c) 2016 NORDUnet A/S
+# All rights reserved.
+#
+#   Redistribution and use in source and binary forms, with or
+#   without modification, are permitted provided that the following
+#   conditions are met:
+#
+#     1. Redistributions of source code must retain the above copyright
+#        notice, this list of conditions and the following disclaimer.
+#     2. Redistributions in binary form must reproduce the above
+#        copyright notice, this list of conditions and the following
+#        disclaimer in the documentation and/or other materials provided
+#        with the distribution.
+#     3. Neither the name of the NORDUnet nor the names of its
+#        contributors may be used to endorse or promote products derived
+#        from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS
+# FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE
+# COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT,
+# INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING,
+# BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT
+# LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN
+# ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+#
+# Author : Fredrik Thulin <fredrik@thulin.net>
+#
+"""
+Circuit breakers, making requests fail fast while a backend (VCCS, MongoDB) is
+failing or slow, instead of having every worker thread wait for it.
+"""
+
+import time
+import threading
+from contextlib import contextmanager
+
+import eduid_idp.error
+import eduid_idp.stats
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half_open'
+
+
+class CircuitBreaker(object):
+    """
+    Circuit breaker for calls to a backend.
+
+    After `failure_threshold' consecutive failed calls, the circuit opens. Calls
+    raising one of the `failures' exceptions are failed, and so are calls taking
+    longer than `latency_threshold' seconds. While the circuit is open, calls are
+    rejected with a ServiceError without calling the backend. After `reset_timeout'
+    seconds, a single call is let through to probe the backend (half open). If it
+    succeeds the circuit closes again, otherwise it stays open for another
+    `reset_timeout' seconds.
+
+    Exceptions other than `failures' (that `is_failure' doesn't consider failures
+    either) are passed on, but count as successful calls since the backend evidently
+    responded.
+
+    The state is only changed by calls started in the current state, so calls made
+    before the circuit opened can't close it again without a successful probe.
+
+    :param name: name of the backend, used in logging and statistics
+    :param logger: logging logger instance
+    :param failures: exceptions indicating that the backend is failing
+    :param failure_threshold: number of consecutive failures opening the circuit, 0 to never open it
+    :param latency_threshold: seconds after which a call is considered failed, 0 to disable
+    :param reset_timeout: seconds to keep the circuit open before probing the backend
+    :param is_failure: function checking if other exceptions indicate that the backend is failing
+
+    :type name: str
+    :type logger: logging.Logger
+    :type failures: (type,)
+    :type failure_threshold: int
+    :type latency_threshold: float
+    :type reset_timeout: float
+    :type is_failure: callable | None
+    """
+
+    def __init__(self, name, logger, failures, failure_threshold = 0, latency_threshold = 0, reset_timeout = 30,
+                 is_failure = None):
+        self.name = name
+        self.logger = logger
+        self.stats = eduid_idp.stats.Stats()
+        self._failures = failures
+        self._is_failure = is_failure
+        self._failure_threshold = failure_threshold
+        self._latency_threshold = latency_threshold
+        self._reset_timeout = reset_timeout
+        self._lock = threading.Lock()
+        self._state = CLOSED
+        # incremented on every change of state, to tell if a call was started in the current state
+        self._generation = 0
+        self._consecutive_failures = 0
+        self._opened_at = None
+        self._probing = False
+
+    @property
+    def state(self):
+        """
+        :return: CLOSED, OPEN or HALF_OPEN
+        :rtype: str
+        """
+        with self._lock:
+            return self._state
+
+    @contextmanager
+    def call(self, now = None):
+        """
+        Context manager for calls to the backend.
+
+        :param now: Current time - do not use unless testing!
+
+        :raises eduid_idp.error.ServiceError: when the circuit is open
+        """
+        token = self._before_call(now)
+        _start = time.time()
+        # None if the call was interrupted (e.g. KeyboardInterrupt), and the result is unknown
+        success, counter = None, None
+        try:
+            yield
+        except self._failures:
+            success, counter = False, 'errors'
+            raise
+        except Exception as exc:
+            if self._is_failure is not None and self._is_failure(exc):
+                success, counter = False, 'errors'
+            else:
+                success = True
+            raise
+        else:
+            if self._latency_threshold and time.time() - _start > self._latency_threshold:
+                success, counter = False, 'slow_calls'
+            else:
+                success = True
+        finally:
+            self.stats.observe('call', time.time() - _start)
+            self._after_call(token, success, counter)
+
+    def _before_call(self, now):
+        """
+        Check if a call may be made, and if so if it is the half open probe.
+
+        :return: The generation the call was made in, and whether it is the probe
+        :rtype: (int, bool)
+
+        :raises eduid_idp.error.ServiceError: when the circuit is open
+        """
+        if now is None:
+            now = time.time()
+        with self._lock:
+            if self._state == OPEN and now - self._opened_at >= self._reset_timeout:
+                self._set_state(HALF_OPEN)
+            if self._state == HALF_OPEN and not self._probing:
+                self._probing = True
+                self.stats.incr('probes')
+                return self._generation, True
+            if self._state == CLOSED:
+                return self._generation, False
+        self.stats.incr('rejected')
+        # not logged, since this would happen for every request while a backend is down
+        raise eduid_idp.error.ServiceError('Backend {!s} temporarily unavailable'.format(self.name))
+
+    def _after_call(self, token, success, counter = None):
+        """
+        Record the result of a call.
+
+        :param token: The value returned by _before_call() for this call
+        :param success: The call was successful, None if unknown
+        :param counter: Name of counter to increment for a failed call
+
+        :type token: (int, bool)
+        :type success: bool | None
+        :type counter: str | None
+        """
+        if counter:
+            self.stats.incr(counter)
+        generation, probe = token
+        with self._lock:
+            if probe:
+                self._probing = False
+            if success is None or generation != self._generation:
+                # interrupted calls, and calls started before the last change of state, are ignored
+                return
+            if success:
+                self._consecutive_failures = 0
+                if self._state != CLOSED:
+                    self._set_state(CLOSED)
+                return
+            self._consecutive_failures += 1
+            if self._state == HALF_OPEN or \
+                    (self._failure_threshold and self._consecutive_failures >= self._failure_threshold):
+                self._opened_at = time.time()
+                if self._state != OPEN:
+                    self._set_state(OPEN)
+
+    def _set_state(self, state):
+        """
+        Change state. Must be called with the lock held.
+        """
+        if state == OPEN:
+            self.logger.error('Circuit breaker for {!s} opened after {!s} failed calls, failing fast for {!s} '
+                              'seconds'.format(self.name, self._consecutive_failures, self._reset_timeout))
+            self.stats.incr('opened')
+        elif state == CLOSED:
+            self.logger.info('Circuit breaker for {!s} closed'.format(self.name))
+        else:
+            self.logger.info('Circuit breaker for {!s} half open, probing backend'.format(self.name))
+        self._state = state
+        self._generation += 1
+
+    def get_stats(self):
+        """
+        Get the state of the circuit, counters of failed and rejected calls and a
+        histogram of call latency.
+
+        :rtype: dict
+        """
+        res = self.stats.to_dict()
+        with self._lock:
+            res['state'] = self._state
+            res['consecutive_failures'] = self._consecutive_failures
+        return res
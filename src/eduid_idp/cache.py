@@ -9,15 +9,30 @@
 #          Roland Hedberg
 #
 
+import os
+import sys
 import time
 import uuid
-from collections import deque
+import socket
+import itertools
+import threading
+from collections import deque, OrderedDict
 from hashlib import sha1
 import datetime
 
+import bson
+import redis
+import redis.sentinel
 import pymongo
+try:
+    from pymongo.cursor import CursorType
+    _TAILABLE_AWAIT = {'cursor_type': CursorType.TAILABLE_AWAIT}
+except ImportError:
+    # pymongo < 2.9
+    _TAILABLE_AWAIT = {'tailable': True, 'await_data': True}
 
 from eduid_idp.loginstate import SSOLoginData
+from eduid_idp.stats import Stats, merge_stats
 
 from eduid_common.session.session import SessionManager, Session
 
@@ -46,6 +61,51 @@ class NoOpLock(object):
         pass
 
 
+def _all_slots(cls):
+    """
+    Get the names of all __slots__ of a class, including the ones of base classes.
+
+    :type cls: type
+    :rtype: [str]
+    """
+    res = []
+    for this in cls.__mro__:
+        _slots = this.__dict__.get('__slots__', [])
+        if isinstance(_slots, basestring):
+            _slots = [_slots]
+        res.extend(_slots)
+    return res
+
+
+def _approximate_size(obj, depth = 2):
+    """
+    Approximate the amount of memory used by an object, including the objects
+    it refers to (`depth' levels down).
+
+    This is not an exact measurement, but good enough for enforcing an upper
+    bound on the size of an in-memory cache.
+
+    :param obj: Object to measure
+    :param depth: How many levels of referred objects to include
+
+    :type depth: int
+    :rtype: int
+    """
+    res = sys.getsizeof(obj)
+    if depth > 0:
+        if isinstance(obj, dict):
+            children = obj.values()
+        elif isinstance(obj, (list, tuple, set)):
+            children = obj
+        elif hasattr(obj, '__dict__'):
+            children = obj.__dict__.values()
+        else:
+            children = [getattr(obj, name, None) for name in _all_slots(type(obj))]
+        for this in children:
+            res += _approximate_size(this, depth - 1)
+    return res
+
+
 class ExpiringCache(object):
     """
     Base class of caches with a TTL.
@@ -60,6 +120,28 @@ class ExpiringCache(object):
         self.logger = logger
         self.ttl = ttl
         self.name = name
+        self.stats = Stats()
+
+    def entry_count(self):
+        """
+        Get the number of entrys in the cache.
+
+        :return: Number of entrys, or None if the backend can't tell
+        :rtype: int | None
+        """
+        return None
+
+    def get_stats(self):
+        """
+        Get counters (hits, misses, expiries etc.), the number of entrys and latency
+        histograms for backend operations of this cache. The available counters and
+        histograms depend on the backend.
+
+        :rtype: dict
+        """
+        res = self.stats.to_dict()
+        res['entries'] = self.entry_count()
+        return res
 
     def key(self, something):
         """
@@ -98,6 +180,29 @@ class ExpiringCache(object):
         """
         raise NotImplementedError('delete not implemented in subclass')
 
+    def incr(self, key, counter, value = 1):
+        """
+        Atomically increment a counter associated with an entry in the cache.
+
+        :param key: hash key of entry
+        :param counter: name of counter
+        :param value: value to increment the counter with
+        :return: New value of counter
+        :rtype: int
+        """
+        raise NotImplementedError('incr not implemented in subclass')
+
+    def get_counter(self, key, counter):
+        """
+        Get the value of a counter associated with an entry in the cache.
+
+        :param key: hash key of entry
+        :param counter: name of counter
+        :return: Value of counter, or None if it has not been incremented
+        :rtype: int | None
+        """
+        raise NotImplementedError('get_counter not implemented in subclass')
+
 
 class ExpiringCacheMem(ExpiringCache):
     """
@@ -108,16 +213,42 @@ class ExpiringCacheMem(ExpiringCache):
     site with e.g. load balancers causing uneven traffic patterns, this might not
     work that well and the use of an external cache such as memcache is recommended.
 
+    Every addition of a key is tagged with a generation number, and the expiry queue
+    records the generation together with the key. Queue entries for an earlier
+    generation of a key (i.e. the key has been added again, or deleted) are dropped
+    without touching the data, so each stored value is expired exactly once.
+
+    If `max_entries' and/or `max_bytes' is given, the cache is bounded in size too.
+    When the limit is exceeded, the least recently used entrys are evicted (in addition
+    to the entrys being expired after `ttl' seconds). The size of entrys is approximated
+    using _approximate_size(). In this mode, get() and add() acquire the lock (blocking)
+    since they both re-order the entrys.
+
     :param name: name of cache as string, only used for debugging
     :param logger: logging logger instance
     :param ttl: data time to live in this cache, as seconds (integer)
     :param lock: threading.Lock compatible locking instance
+    :param max_entries: maximum number of entrys in the cache (integer), or None
+    :param max_bytes: maximum approximate size of the entrys in the cache (integer), or None
+    :param on_remove: function called as on_remove(key, info) when an entry is deleted, expired or
+                      evicted (but not when it is replaced using add()). Might be called with the lock held.
     """
 
-    def __init__(self, name, logger, ttl, lock = None):
+    def __init__(self, name, logger, ttl, lock = None, max_entries = None, max_bytes = None, on_remove = None):
         super(ExpiringCacheMem, self).__init__(name, logger, ttl)
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.on_remove = on_remove
+        self._bounded = bool(max_entries or max_bytes)
         self._data = {}
+        if self._bounded:
+            # ordered by most recent use, least recently used first
+            self._data = OrderedDict()
         self._ages = deque()
+        self._generations = {}
+        self._next_generation = itertools.count()
+        self._sizes = {}
+        self.size_bytes = 0
         self.lock = lock
         if self.lock is None:
             self.lock = NoOpLock()
@@ -133,14 +264,60 @@ class ExpiringCacheMem(ExpiringCache):
         :param now: Current time - do not use unless testing!
         :return: None
         """
-        self._data[key] = info
+        _generation = next(self._next_generation)
+        self.stats.incr('adds')
+        if self._bounded:
+            self.lock.acquire()
+            try:
+                # remove any previous value first, to have this key become the most recently used one
+                self._data.pop(key, None)
+                self.size_bytes -= self._sizes.pop(key, 0)
+                self._data[key] = info
+                self._generations[key] = _generation
+                if self.max_bytes:
+                    _size = _approximate_size(info)
+                    self._sizes[key] = _size
+                    self.size_bytes += _size
+                self._evict()
+            finally:
+                self.lock.release()
+        else:
+            self._data[key] = info
+            self._generations[key] = _generation
         # record when this entry shall be purged
         _now = now
         if _now is None:
             _now = int(time.time())
-        self._ages.append((_now, key))
+        self._ages.append((_now, key, _generation))
         self._purge_expired(_now - self.ttl)
 
+    def _evict(self):
+        """
+        Evict least recently used entrys until the cache is within it's size limits.
+
+        Must be called with the lock held. The most recently added entry is never
+        evicted, even if it alone exceeds `max_bytes'.
+
+        :return: None
+        """
+        while len(self._data) > 1 and self._over_limit():
+            _key = next(iter(self._data))
+            self.logger.debug('Evicting {!s} cache entry (size limit reached) : {!s}'.format(self.name, _key))
+            self._remove(_key)
+            self.stats.incr('evictions')
+
+    def _over_limit(self):
+        """
+        Check if the cache currently holds more data than allowed by `max_entries' and `max_bytes'.
+
+        :rtype: bool
+        """
+        if self.max_entries and len(self._data) > self.max_entries:
+            return True
+        if self.max_bytes and self.size_bytes > self.max_bytes:
+            return True
+        return False
+
     def _purge_expired(self, timestamp):
         """
         Purge expired records.
@@ -155,19 +332,47 @@ class ExpiringCacheMem(ExpiringCache):
             # purge any expired records. self._ages have the _data entries listed with oldest first.
             while True:
                 try:
-                    (_exp_ts, _exp_key) = self._ages.popleft()
+                    (_exp_ts, _exp_key, _exp_gen) = self._ages.popleft()
                 except IndexError:
                     break
+                if self._generations.get(_exp_key) != _exp_gen:
+                    # entry was added again (or deleted) after this queue entry was made - drop it
+                    continue
                 if _exp_ts > timestamp:
                     # entry not expired - reinsert in queue and end purging
-                    self._ages.appendleft((_exp_ts, _exp_key))
+                    self._ages.appendleft((_exp_ts, _exp_key, _exp_gen))
                     break
                 self.logger.debug('Purged {!s} cache entry {!s} seconds over limit : {!s}'.format(
                     self.name, timestamp - _exp_ts, _exp_key))
-                self.delete(_exp_key)
+                if self._remove(_exp_key):
+                    self.stats.incr('expiries')
+            if len(self._ages) > 2 * len(self._generations) + 16:
+                self._compact_ages()
         finally:
             self.lock.release()
 
+    def _compact_ages(self):
+        """
+        Remove queue entries for superseded generations from anywhere in the expiry queue.
+
+        Superseded entries at the head of the queue are dropped by _purge_expired(), but
+        a key that is re-added over and over again (e.g. a ticket with an increasing
+        FailCount) would otherwise leave queue entries behind newer, live entries until
+        those expire. Invoked (with the lock held) when the queue has grown to more than
+        twice the number of live entries, making the amortized cost O(1) per add().
+
+        The queue is rotated in place, so entries appended concurrently by add() are kept.
+
+        :return: None
+        """
+        for _ in xrange(len(self._ages)):
+            try:
+                this = self._ages.popleft()
+            except IndexError:
+                break
+            if self._generations.get(this[1]) == this[2]:
+                self._ages.append(this)
+
     def get(self, key):
         """
         Fetch data from cache based on `key'.
@@ -175,13 +380,63 @@ class ExpiringCacheMem(ExpiringCache):
         :param key: hash key to use for lookup
         :returns: Any data found matching `key', or None.
         """
-        return self._data.get(key)
+        if not self._bounded:
+            info = self._data.get(key)
+        else:
+            self.lock.acquire()
+            try:
+                info = self._data.pop(key, None)
+                if info is not None:
+                    # re-insert as the most recently used entry
+                    self._data[key] = info
+            finally:
+                self.lock.release()
+        if info is None:
+            self.stats.incr('misses')
+        else:
+            self.stats.incr('hits')
+        return info
+
+    @property
+    def evictions(self):
+        """
+        Number of entrys evicted because of size limits.
+
+        :rtype: int
+        """
+        return self.stats.get('evictions')
+
+    @property
+    def expiries(self):
+        """
+        Number of entrys expired.
+
+        :rtype: int
+        """
+        return self.stats.get('expiries')
+
+    def entry_count(self):
+        return len(self._data)
+
+    def get_stats(self):
+        res = super(ExpiringCacheMem, self).get_stats()
+        if self.max_bytes:
+            res['bytes'] = self.size_bytes
+        return res
 
     def items(self):
         """
         Return all items from cache.
+
+        In size-bounded mode, this is a copy of the data.
         """
-        return self._data
+        if not self._bounded:
+            return self._data
+        self.lock.acquire()
+        try:
+            return dict(self._data)
+        finally:
+            self.lock.release()
 
     def delete(self, key):
         """
@@ -190,12 +445,191 @@ class ExpiringCacheMem(ExpiringCache):
         :param key: hash key to delete
         :return: True on success
         """
-        try:
-            del self._data[key]
+        if self._bounded:
+            self.lock.acquire()
+            try:
+                res = self._remove(key)
+            finally:
+                self.lock.release()
+        else:
+            res = self._remove(key)
+        if res:
+            self.stats.incr('deletes')
             return True
+        self.logger.debug('Failed deleting key {!r} from {!s} cache (entry did not exist)'.format(
+            key, self.name))
+
+    def _remove(self, key):
+        """
+        Remove an item from the cache, without locking.
+
+        :param key: hash key to remove
+        :return: True if the item existed
+        """
+        self._generations.pop(key, None)
+        self.size_bytes -= self._sizes.pop(key, 0)
+        try:
+            info = self._data.pop(key)
         except KeyError:
-            self.logger.debug('Failed deleting key {!r} from {!s} cache (entry did not exist)'.format(
-                key, self.name))
+            return False
+        if self.on_remove is not None:
+            self.on_remove(key, info)
+        return True
+
+
+class ExpiringCacheShardedMem(ExpiringCache):
+    """
+    In-memory cache split into a number of independently locked ExpiringCacheMem shards.
+
+    The shard used for a key is chosen by hashing the key. Since every shard has its
+    own lock and purges its own expired entrys, worker threads adding data to different
+    shards do not contend for the same lock (and a busy lock no longer means that
+    purging is skipped for the whole cache).
+
+    :param name: name of cache as string, only used for debugging
+    :param logger: logging logger instance
+    :param ttl: data time to live in this cache, as seconds (integer)
+    :param shards: number of shards to use (integer)
+    :param lock_class: threading.Lock compatible class, instantiated once per shard
+    :param max_entries: maximum number of entrys in the cache (integer), or None
+    :param max_bytes: maximum approximate size of the entrys in the cache (integer), or None
+    :param on_remove: function called as on_remove(key, info) when an entry is deleted, expired or evicted
+
+    The size limits are divided evenly between the shards.
+    """
+
+    def __init__(self, name, logger, ttl, shards, lock_class = threading.Lock, max_entries = None,
+                 max_bytes = None, on_remove = None):
+        super(ExpiringCacheShardedMem, self).__init__(name, logger, ttl)
+        if shards < 1:
+            raise ValueError('Number of shards must be at least 1, not {!r}'.format(shards))
+        _max_entries = None
+        if max_entries:
+            _max_entries = max(1, max_entries // shards)
+        _max_bytes = None
+        if max_bytes:
+            _max_bytes = max(1, max_bytes // shards)
+        self._shards = [ExpiringCacheMem('{!s}[{!s}]'.format(name, i), logger, ttl, lock = lock_class(),
+                                         max_entries = _max_entries, max_bytes = _max_bytes,
+                                         on_remove = on_remove)
+                        for i in xrange(shards)]
+
+    def __repr__(self):
+        return '<{!s}: {!s}, {!s} shards>'.format(self.__class__.__name__, self.name, len(self._shards))
+
+    def _shard(self, key):
+        """
+        Get the shard responsible for `key'.
+
+        :param key: Lookup key
+        :rtype: ExpiringCacheMem
+        """
+        return self._shards[hash(key) % len(self._shards)]
+
+    @property
+    def evictions(self):
+        """
+        Number of entrys evicted from all shards because of size limits.
+
+        :rtype: int
+        """
+        return sum([this.evictions for this in self._shards])
+
+    @property
+    def expiries(self):
+        """
+        Number of entrys expired from all shards.
+
+        :rtype: int
+        """
+        return sum([this.expiries for this in self._shards])
+
+    def entry_count(self):
+        return sum([this.entry_count() for this in self._shards])
+
+    def get_stats(self):
+        _shard_stats = [this.get_stats() for this in self._shards]
+        res = merge_stats(_shard_stats)
+        res['entries'] = sum([this['entries'] for this in _shard_stats])
+        if 'bytes' in _shard_stats[0]:
+            res['bytes'] = sum([this['bytes'] for this in _shard_stats])
+        return res
+
+    def add(self, key, info, now = None):
+        """
+        Add entry to the cache.
+
+        Ability to supply current time is only meant for test cases!
+
+        :param key: Lookup key for entry
+        :param info: Value to be stored for 'key'
+        :param now: Current time - do not use unless testing!
+        :return: None
+        """
+        return self._shard(key).add(key, info, now = now)
+
+    def get(self, key):
+        """
+        Fetch data from cache based on `key'.
+
+        :param key: hash key to use for lookup
+        :returns: Any data found matching `key', or None.
+        """
+        return self._shard(key).get(key)
+
+    def items(self):
+        """
+        Return all items from cache.
+
+        Unlike ExpiringCacheMem.items(), this is a copy of the data in all shards.
+        """
+        res = {}
+        for this in self._shards:
+            res.update(this.items())
+        return res
+
+    def delete(self, key):
+        """
+        Delete an item from the cache.
+
+        :param key: hash key to delete
+        :return: True on success
+        """
+        return self._shard(key).delete(key)
+
+
+# Redis clients created by get_redis_client(), keyed by the settings used
+_redis_clients = {}
+_redis_clients_lock = threading.Lock()
+
+
+def get_redis_client(config):
+    """
+    Get a Redis client using the redis_* settings in the IdP configuration.
+
+    The same settings are used by ExpiringCacheCommonSession (through eduid_common).
+    Redis clients are thread safe, so one client (with it's connection pool) is shared
+    by everything in this process using the same settings.
+
+    :param config: IdP configuration data
+
+    :type config: eduid_idp.config.IdPConfig
+    :rtype: redis.StrictRedis
+    """
+    _key = (tuple(config.redis_sentinel_hosts or []), config.redis_sentinel_service_name,
+            config.redis_host, config.redis_port, config.redis_db)
+    with _redis_clients_lock:
+        client = _redis_clients.get(_key)
+        if client is None:
+            if config.redis_sentinel_hosts:
+                _hosts = [(x, config.redis_port) for x in config.redis_sentinel_hosts]
+                _sentinel = redis.sentinel.Sentinel(_hosts, socket_timeout = 0.1)
+                client = _sentinel.master_for(config.redis_sentinel_service_name, redis_class = redis.StrictRedis,
+                                              db = config.redis_db)
+            else:
+                client = redis.StrictRedis(host = config.redis_host, port = config.redis_port, db = config.redis_db)
+            _redis_clients[_key] = client
+        return client
 
 
 class ExpiringCacheCommonSession(ExpiringCache):
@@ -215,6 +649,8 @@ class ExpiringCacheCommonSession(ExpiringCache):
         self._redis_cfg = redis_cfg
 
         self._manager = SessionManager(redis_cfg, ttl = ttl, secret = config.session_app_key)
+        # for counters, which are stored unencrypted next to the sessions
+        self._redis = get_redis_client(config)
 
     def __repr__(self):
         return '<{!s}: {!s}>'.format(self.__class__.__name__, unicode(self))
@@ -239,13 +675,15 @@ class ExpiringCacheCommonSession(ExpiringCache):
         :rtype: Session
         """
         if isinstance(info, SSOLoginData):
-            data = info.to_dict()
-            data['req_info'] = None  # can't serialize this - will be re-created from SAMLRequest
+            # req_info can't be serialized - it will be re-created from the SAMLRequest
+            data = info.to_compact()
         else:
             data = info
         _session_id = bytes(key.decode('hex'))
-        session = self._manager.get_session(session_id = _session_id, data = data)
-        session.commit()
+        self.stats.incr('adds')
+        with self.stats.timed('add'):
+            session = self._manager.get_session(session_id = _session_id, data = data)
+            session.commit()
         return session
 
     def get(self, key):
@@ -261,27 +699,179 @@ class ExpiringCacheCommonSession(ExpiringCache):
         """
         _session_id = bytes(key.decode('hex'))
         try:
-            session = self._manager.get_session(session_id = _session_id)
+            with self.stats.timed('get'):
+                session = self._manager.get_session(session_id = _session_id)
+            self.stats.incr('hits')
             return dict(session)
         except KeyError:
-            pass
+            self.stats.incr('misses')
 
     def delete(self, key):
         """
-        Delete an item from the cache.
+        Delete an item (and it's counters) from the cache, in a single round trip to Redis.
 
         :param key: hash key to delete
 
         :type key: str | unicode
 
-        :return: True on success
+        :return: True on success, False if there was no such entry
         """
         _session_id = bytes(key.decode('hex'))
-        session = self._manager.get_session(session_id = _session_id)
-        if not session:
-            return False
-        session.clear()
-        return True
+        # Only used to get the Redis key of the session - when data is given, the
+        # session is not loaded from Redis
+        session = self._manager.get_session(session_id = _session_id, data = {})
+        pipe = self._redis.pipeline()
+        pipe.delete(session.db_key)
+        pipe.delete(self._counters_key(key))
+        with self.stats.timed('delete'):
+            res = pipe.execute()
+        self.stats.incr('deletes')
+        return bool(res[0])
+
+    def _counters_key(self, key):
+        # all counters of an entry are kept in one Redis hash, so that they can be deleted together
+        return '{!s}:{!s}:counters'.format(self.name, key)
+
+    def incr(self, key, counter, value = 1):
+        """
+        Atomically increment a counter associated with an entry in the cache.
+
+        The counters are kept in separate Redis keys (not in the encrypted session),
+        so incrementing one is a single small write. They expire after `ttl' seconds,
+        just like the entry they are associated with.
+
+        :param key: hash key of entry
+        :param counter: name of counter
+        :param value: value to increment the counter with
+
+        :type key: str | unicode
+        :type counter: str
+        :type value: int
+
+        :return: New value of counter
+        :rtype: int
+        """
+        _counters_key = self._counters_key(key)
+        pipe = self._redis.pipeline()
+        pipe.hincrby(_counters_key, counter, value)
+        pipe.expire(_counters_key, self.ttl)
+        with self.stats.timed('incr'):
+            res = pipe.execute()
+        return int(res[0])
+
+    def get_counter(self, key, counter):
+        """
+        Get the value of a counter associated with an entry in the cache.
+
+        :param key: hash key of entry
+        :param counter: name of counter
+
+        :type key: str | unicode
+        :type counter: str
+
+        :return: Value of counter, or None if it has not been incremented
+        :rtype: int | None
+        """
+        with self.stats.timed('get_counter'):
+            res = self._redis.hget(self._counters_key(key), counter)
+        if res is None:
+            return None
+        return int(res)
+
+
+class ExpiringCacheTiered(ExpiringCache):
+    """
+    Two-tier cache, with a process-local cache (typically ExpiringCacheMem) in front
+    of a shared cache (typically ExpiringCacheCommonSession).
+
+    Writes go to both tiers, and reads are answered from the local tier when possible.
+    On a local miss, data found in the remote tier is passed through `promote' (if set)
+    and added to the local tier, so that subsequent reads in this process are local.
+
+    A key updated in another process will not be seen here until the local entry is
+    deleted or expires, so this is meant for data where requests for a key are mostly
+    handled by the same process (e.g. login state with sticky load balancing).
+
+    :param name: name of cache as string, only used for debugging
+    :param logger: logging logger instance
+    :param ttl: data time to live in this cache, as seconds (integer)
+    :param local: process-local cache
+    :param remote: shared cache
+    :param promote: callable(key, data) returning the value to store in the local tier
+
+    :type local: ExpiringCache
+    :type remote: ExpiringCache
+    """
+
+    def __init__(self, name, logger, ttl, local, remote, promote = None):
+        super(ExpiringCacheTiered, self).__init__(name, logger, ttl)
+        self.local = local
+        self.remote = remote
+        self._promote = promote
+
+    def __repr__(self):
+        return '<{!s}: local={!r}, remote={!r}>'.format(self.__class__.__name__, self.local, self.remote)
+
+    def key(self, something):
+        return self.remote.key(something)
+
+    def entry_count(self):
+        return self.local.entry_count()
+
+    def get_stats(self):
+        res = super(ExpiringCacheTiered, self).get_stats()
+        res['local'] = self.local.get_stats()
+        res['remote'] = self.remote.get_stats()
+        return res
+
+    def add(self, key, info):
+        """
+        Add entry to both tiers of the cache.
+
+        :param key: Lookup key for entry
+        :param info: Value to be stored for 'key'
+        :return: None
+        """
+        self.remote.add(key, info)
+        self.local.add(key, info)
+
+    def get(self, key):
+        """
+        Fetch data from the local tier, or from the remote tier if not found locally.
+
+        :param key: hash key to use for lookup
+        :returns: Any data found matching `key', or None.
+        """
+        res = self.local.get(key)
+        if res is not None:
+            self.stats.incr('local_hits')
+            return res
+        res = self.remote.get(key)
+        if res is None:
+            self.stats.incr('misses')
+            return None
+        self.stats.incr('remote_hits')
+        if self._promote is not None:
+            res = self._promote(key, res)
+        self.local.add(key, res)
+        return res
+
+    def delete(self, key):
+        """
+        Delete an item from both tiers of the cache.
+
+        :param key: hash key to delete
+        :return: True on success
+        """
+        self.local.delete(key)
+        return self.remote.delete(key)
+
+    def incr(self, key, counter, value = 1):
+        # counters are only kept in the remote tier, so that all processes see the same value
+        return self.remote.incr(key, counter, value)
+
+    def get_counter(self, key, counter):
+        return self.remote.get_counter(key, counter)
 
 
 class SSOSessionCache(object):
@@ -297,6 +887,28 @@ class SSOSessionCache(object):
         self._lock = lock
         if self._lock is None:
             self._lock = NoOpLock()
+        self.stats = Stats()
+
+    def entry_count(self):
+        """
+        Get the number of SSO sessions in the cache.
+
+        :return: Number of sessions, or None if the backend can't tell
+        :rtype: int | None
+        """
+        return None
+
+    def get_stats(self):
+        """
+        Get counters (hits, misses etc.), the number of sessions and latency histograms
+        for backend operations of this cache. The available counters and histograms
+        depend on the backend.
+
+        :rtype: dict
+        """
+        res = self.stats.to_dict()
+        res['entries'] = self.entry_count()
+        return res
 
     def remove_session(self, sid):
         """
@@ -350,6 +962,43 @@ class SSOSessionCache(object):
         return str(uuid.uuid4())
 
 
+class _SessionEntry(object):
+    """
+    An SSO session in SSOSessionCacheMem.
+
+    To use as little memory as possible for (potentially) a very large number of
+    sessions, the session data is stored as a tuple of values, and the tuple of
+    keys is shared between all sessions with the same set of keys.
+
+    :param username: Username (user id) of session
+    :param data: Session data
+    :param keysets: Shared tuples of keys
+
+    :type data: dict
+    :type keysets: dict
+    """
+
+    __slots__ = ('username', '_keys', '_values')
+
+    def __init__(self, username, data, keysets):
+        self.username = username
+        _keys = tuple(sorted(data.keys()))
+        self._keys = keysets.setdefault(_keys, _keys)
+        self._values = tuple([data[x] for x in self._keys])
+
+    def __repr__(self):
+        return '<{!s}: username={!r}, data={!r}>'.format(self.__class__.__name__, self.username, self.data)
+
+    @property
+    def data(self):
+        """
+        The session data, as a new dict.
+
+        :rtype: dict
+        """
+        return dict(zip(self._keys, self._values))
+
+
 class SSOSessionCacheMem(SSOSessionCache):
     """
     This cache holds all SSO sessions, meaning information about what users
@@ -358,11 +1007,46 @@ class SSOSessionCacheMem(SSOSessionCache):
 
     Do NOT use this in-memory SSO session cache in a clustered setup -
     only for a (small) single IdP.
+
+    An index of username -> session ids is kept in sync with the session data
+    (on add, remove, expiry and eviction) to make get_sessions_for_user() fast.
+
+    :param logger: logging logger instance
+    :param ttl: SSO session time to live, as seconds (integer)
+    :param lock: threading.Lock compatible locking instance
+    :param shards: number of independently locked shards to use for the session data (integer)
+    :param max_entries: maximum number of SSO sessions to keep (integer), or None
     """
 
-    def __init__(self, logger, ttl, lock = None):
+    def __init__(self, logger, ttl, lock = None, shards = 1, max_entries = None):
         SSOSessionCache.__init__(self, logger, ttl, lock)
-        self.lid2data = ExpiringCacheMem('SSOSession.uid2user', self.logger, self._ttl, lock = self._lock)
+        self._user_sessions = {}
+        self._keysets = {}
+        self._index_lock = threading.Lock()
+        if shards > 1:
+            self.lid2data = ExpiringCacheShardedMem('SSOSession.uid2user', self.logger, self._ttl, shards,
+                                                    max_entries = max_entries,
+                                                    on_remove = self._session_removed)
+        else:
+            self.lid2data = ExpiringCacheMem('SSOSession.uid2user', self.logger, self._ttl, lock = self._lock,
+                                             max_entries = max_entries,
+                                             on_remove = self._session_removed)
+
+    def _session_removed(self, sid, info):
+        """
+        Update the username index when a session is removed from lid2data.
+
+        :param sid: Session identifier as string
+        :param info: The removed entry
+        """
+        username = info.username
+        with self._index_lock:
+            _sids = self._user_sessions.get(username)
+            if _sids is None:
+                return
+            _sids.discard(sid)
+            if not _sids:
+                del self._user_sessions[username]
 
     def remove_session(self, sid):
         self.logger.debug('Purging SSO session, data : {!s}'.format(self.lid2data.get(sid)))
@@ -370,29 +1054,134 @@ class SSOSessionCacheMem(SSOSessionCache):
 
     def add_session(self, username, data):
         _sid = self._create_session_id()
-        self.lid2data.add(_sid, {'username': username,
-                                 'data': data,
-                                 })
+        # Update the index first, so that it never refers to a session that has already been removed
+        with self._index_lock:
+            self._user_sessions.setdefault(username, set()).add(_sid)
+        self.lid2data.add(_sid, _SessionEntry(username, data, self._keysets))
         return _sid
 
     def get_session(self, sid):
         try:
             this = self.lid2data.get(sid)
             if this:
-                return this['data']
+                return this.data
         except KeyError:
             self.logger.debug('Failed looking up SSO session with session id={!r}'.format(sid))
             raise
 
     def get_sessions_for_user(self, username):
-        res = []
-        for _key, _val in self.lid2data.items():
-            # Traversing all of lid2data could be a bit slow, but any non-trivial
-            # setup of eduid-IdP is expected to use another backend anyways. In-memory
-            # backend won't work well with multiple IdP:s anyway (think log in to one IdP,
-            # log out to another).
-            if _val.get('username') == username:
-                res.append(_key)
+        with self._index_lock:
+            res = list(self._user_sessions.get(username, []))
+        self.logger.debug('Found SSO sessions for user {!r}: {!r}'.format(username, res))
+        return res
+
+    def get_stats(self):
+        # all the interesting counters (hits, misses, expiries etc.) are in lid2data
+        return self.lid2data.get_stats()
+
+
+class SSOSessionCacheRedis(SSOSessionCache):
+    """
+    This is a Redis version of SSOSessionCache().
+
+    Sessions are stored (BSON encoded, to preserve ObjectIds) with a native Redis
+    TTL, so there is no need to expire old sessions. The session ids of each user
+    are kept in a Redis set, with the same TTL as the most recently added session
+    of the user.
+
+    :param logger: logging logger instance
+    :param ttl: SSO session time to live, as seconds (integer)
+    :param lock: threading.Lock compatible locking instance
+    :param config: IdP configuration data, used to connect to Redis unless `client' is given
+    :param client: Redis client to use (e.g. for testing)
+    :param key_prefix: prefix for all keys stored in Redis
+
+    :type config: eduid_idp.config.IdPConfig | None
+    :type client: redis.StrictRedis | None
+    :type key_prefix: str
+    """
+
+    def __init__(self, logger, ttl, lock = None, config = None, client = None, key_prefix = 'sso_session'):
+        SSOSessionCache.__init__(self, logger, ttl, lock)
+        if client is None:
+            client = get_redis_client(config)
+        self._redis = client
+        self._prefix = key_prefix
+
+    def __repr__(self):
+        return '<{!s}: {!r}>'.format(self.__class__.__name__, self._redis)
+
+    def _session_key(self, sid):
+        return '{!s}:{!s}'.format(self._prefix, sid)
+
+    def _user_key(self, username):
+        return '{!s}_user:{!s}'.format(self._prefix, username)
+
+    def _load(self, sid):
+        """
+        Load a stored session document from Redis.
+
+        :param sid: Session identifier as string
+        :return: Dict with 'username' and 'data', or None if not found
+        :rtype: dict | None
+        """
+        with self.stats.timed('get'):
+            raw = self._redis.get(self._session_key(sid))
+        if raw is None:
+            return None
+        return bson.BSON(raw).decode()
+
+    def remove_session(self, sid):
+        _doc = self._load(sid)
+        if _doc is None:
+            self.logger.debug('Failed removing SSO session with id={!r} (not found)'.format(sid))
+            return False
+        pipe = self._redis.pipeline()
+        pipe.delete(self._session_key(sid))
+        pipe.srem(self._user_key(_doc['username']), sid)
+        with self.stats.timed('remove'):
+            res = pipe.execute()
+        self.stats.incr('removes')
+        return res[0]  # number of deleted keys
+
+    def add_session(self, username, data):
+        _sid = self._create_session_id()
+        _doc = {'username': username,
+                'data': data,
+                }
+        _user_key = self._user_key(username)
+        pipe = self._redis.pipeline()
+        pipe.setex(self._session_key(_sid), self._ttl, bson.BSON.encode(_doc))
+        pipe.sadd(_user_key, _sid)
+        pipe.expire(_user_key, self._ttl)
+        with self.stats.timed('add'):
+            pipe.execute()
+        self.stats.incr('adds')
+        return _sid
+
+    def get_session(self, sid):
+        _doc = self._load(sid)
+        if _doc is None:
+            self.stats.incr('misses')
+            return None
+        self.stats.incr('hits')
+        return _doc['data']
+
+    def get_sessions_for_user(self, username):
+        _user_key = self._user_key(username)
+        with self.stats.timed('get_user'):
+            _sids = list(self._redis.smembers(_user_key))
+            if not _sids:
+                return []
+            # The set might refer to sessions that have expired
+            pipe = self._redis.pipeline()
+            for this in _sids:
+                pipe.exists(self._session_key(this))
+            _exists = pipe.execute()
+        res = [sid for (sid, exists) in zip(_sids, _exists) if exists]
+        _expired = [sid for (sid, exists) in zip(_sids, _exists) if not exists]
+        if _expired:
+            self._redis.srem(_user_key, *_expired)
         self.logger.debug('Found SSO sessions for user {!r}: {!r}'.format(username, res))
         return res
 
@@ -401,16 +1190,60 @@ class SSOSessionCacheMDB(SSOSessionCache):
     """
     This is a MongoDB version of SSOSessionCache().
 
-    Expiration is done using simple non-blocking delete-querys on an indexed date-field.
-    A simple timestamp is used to not invoke expiration more often than once every
-    `expiration_freq' seconds.
+    By default, expiration is done using simple non-blocking delete-querys on an indexed
+    date-field when sessions are added. A simple timestamp is used to not invoke expiration
+    more often than once every `expiration_freq' seconds.
+
+    To keep expiration out of the login request, either (or both) of
+
+      ttl_index: Let MongoDB expire the sessions natively, using an expireAfterSeconds
+                 index on created_ts. MongoDB removes expired documents about once a minute.
+      reaper_interval: Run expire_old_sessions() every `reaper_interval' seconds in a
+                       background thread (SSOSessionReaper). Only the IdP process holding
+                       a cluster-wide lease will actually expire sessions.
+
+    can be used.
+
+    With `local_cache_ttl', sessions looked up in MongoDB are kept in a small per-process
+    cache for that many seconds, so that a user visiting several SPs in a short time
+    does not cause a MongoDB query for every visit. Since sessions are never modified once
+    created, the only thing that can make the local cache stale is removal of sessions.
+    remove_session() invalidates the local cache of this process, and with
+    `invalidation_channel' other processes are notified through a capped collection
+    (sso_session_invalidations) that they tail in a background thread.
+
+    :param uri: MongoDB connection URI
+    :param logger: logging logger instance
+    :param ttl: SSO session time to live, as seconds (integer)
+    :param lock: threading.Lock compatible locking instance
+    :param expiration_freq: minimum number of seconds between invocations of inline expiration
+    :param conn: MongoDB connection to use instead of connecting to `uri'
+    :param db_name: MongoDB database name
+    :param ttl_index: use a MongoDB TTL index to expire sessions (boolean)
+    :param reaper_interval: seconds between background expiration runs, or 0 to disable
+    :param local_cache_ttl: seconds to cache sessions in this process, or 0 to disable
+    :param local_cache_max_entries: maximum number of sessions to cache in this process
+    :param invalidation_channel: notify other processes about removed sessions (boolean)
     """
 
     def __init__(self, uri, logger, ttl, lock = None, expiration_freq = 60, conn = None, db_name = 'eduid_idp',
-                 **kwargs):
+                 ttl_index = False, reaper_interval = 0, local_cache_ttl = 0, local_cache_max_entries = 10000,
+                 invalidation_channel = False, **kwargs):
         SSOSessionCache.__init__(self, logger, ttl, lock)
         self._expiration_freq = expiration_freq
         self._last_expire_at = None
+        self._ttl_index = ttl_index
+        self._inline_expiration = not ttl_index and not reaper_interval
+        self.reaper = None
+        self.invalidation_listener = None
+        self._invalidations = None
+        self._local_cache = None
+        # incremented on every invalidation, to detect invalidations made during a lookup in get_session()
+        self._invalidation_generation = 0
+        self._invalidation_lock = threading.Lock()
+        if local_cache_ttl:
+            self._local_cache = ExpiringCacheMem('SSOSession.local', self.logger, local_cache_ttl,
+                                                 lock = threading.Lock(), max_entries = local_cache_max_entries)
 
         if conn is not None:
             self.connection = conn
@@ -427,7 +1260,7 @@ class SSOSessionCacheMDB(SSOSessionCache):
         self.sso_sessions = self.db.sso_sessions
         for this in xrange(2):
             try:
-                self.sso_sessions.ensure_index('created_ts', name = 'created_ts_idx', unique = False)
+                self._ensure_created_ts_index()
                 self.sso_sessions.ensure_index('session_id', name = 'session_id_idx', unique = True)
                 self.sso_sessions.ensure_index('username', name = 'username_idx', unique = False)
                 break
@@ -435,9 +1268,107 @@ class SSOSessionCacheMDB(SSOSessionCache):
                 if this == 1:
                     raise
                 self.logger.error('Failed ensuring mongodb index, retrying ({!r})'.format(e))
+        if reaper_interval:
+            self.reaper = SSOSessionReaper(self, reaper_interval, self.logger)
+            self.reaper.start()
+        if invalidation_channel:
+            try:
+                self.db.create_collection('sso_session_invalidations', capped = True, size = 1024 * 1024)
+            except pymongo.errors.CollectionInvalid:
+                # already exists
+                pass
+            self._invalidations = self.db.sso_session_invalidations
+            if self._local_cache is not None:
+                self.invalidation_listener = SSOSessionInvalidationListener(self._invalidations,
+                                                                            self._invalidate_local,
+                                                                            self.logger)
+                self.invalidation_listener.start()
+
+    @property
+    def local_cache_hits(self):
+        """
+        Number of get_session() calls answered from the local cache.
+
+        :rtype: int
+        """
+        return self.stats.get('local_cache_hits')
+
+    @property
+    def local_cache_misses(self):
+        """
+        Number of get_session() calls not answered from the local cache.
+
+        :rtype: int
+        """
+        return self.stats.get('local_cache_misses')
+
+    @property
+    def local_cache_hit_rate(self):
+        """
+        The fraction of get_session() calls answered from the local cache.
+
+        :rtype: float
+        """
+        _total = self.local_cache_hits + self.local_cache_misses
+        if not _total:
+            return 0.0
+        return float(self.local_cache_hits) / _total
+
+    def _ensure_created_ts_index(self):
+        """
+        Make sure there is an index on created_ts, with or without MongoDB native
+        expiration (expireAfterSeconds) depending on the `ttl_index' setting.
+
+        MongoDB only allows one index per key pattern, so an existing index of the
+        wrong kind is dropped first, and the expireAfterSeconds of an existing TTL
+        index is updated if the SSO session lifetime has changed.
+
+        :return: None
+        """
+        _name = 'created_ts_idx'
+        _kwargs = {}
+        if self._ttl_index:
+            _name = 'created_ts_ttl_idx'
+            _kwargs['expireAfterSeconds'] = self._ttl
+        for (this, info) in self.sso_sessions.index_information().items():
+            if [x[0] for x in info.get('key', [])] != ['created_ts']:
+                continue
+            if this != _name:
+                self.logger.info('Dropping index {!r} on SSO session collection'.format(this))
+                self.sso_sessions.drop_index(this)
+            elif self._ttl_index and info.get('expireAfterSeconds') != self._ttl:
+                self.logger.info('Changing expireAfterSeconds of index {!r} to {!r}'.format(this, self._ttl))
+                self.db.command('collMod', self.sso_sessions.name,
+                                index = {'keyPattern': {'created_ts': 1},
+                                         'expireAfterSeconds': self._ttl,
+                                         })
+        self.sso_sessions.ensure_index('created_ts', name = _name, unique = False, **_kwargs)
+
+    def _invalidate_local(self, sid):
+        """
+        Remove a session from the local cache, and keep any get_session() in progress
+        from adding it to the local cache again.
+
+        :param sid: Session id
+        """
+        if self._local_cache is None:
+            return
+        with self._invalidation_lock:
+            self._invalidation_generation += 1
+            self._local_cache.delete(sid)
 
     def remove_session(self, sid):
-        res = self.sso_sessions.remove({'session_id': sid}, w = 1, getLastError = True)
+        self._invalidate_local(sid)
+        with self.stats.timed('remove'):
+            res = self.sso_sessions.remove({'session_id': sid}, w = 1, getLastError = True)
+        # a get_session() started during the remove might have found the session in the
+        # database and cached it locally, since the generation didn't change while it ran
+        self._invalidate_local(sid)
+        self.stats.incr('removes')
+        if self._invalidations is not None:
+            self._invalidations.insert({'session_id': sid,
+                                        'ts': datetime.datetime.utcnow(),
+                                        })
         try:
             return res['n']  # number of deleted records
         except (KeyError, TypeError):
@@ -446,21 +1377,42 @@ class SSOSessionCacheMDB(SSOSessionCache):
 
     def add_session(self, username, data):
         _ts = time.time()
-        isodate = datetime.datetime.fromtimestamp(_ts, None)
+        # MongoDB TTL indexes require created_ts to be in UTC
+        isodate = datetime.datetime.utcfromtimestamp(_ts)
         _sid = self._create_session_id()
         _doc = {'session_id': _sid,
                 'username': username,
                 'data': data,
                 'created_ts': isodate,
                 }
-        self.sso_sessions.insert(_doc)
-        self.expire_old_sessions()
+        with self.stats.timed('add'):
+            self.sso_sessions.insert(_doc)
+        self.stats.incr('adds')
+        if self._inline_expiration:
+            self.expire_old_sessions()
         return _sid
 
     def get_session(self, sid):
+        if self._local_cache is not None:
+            data = self._local_cache.get(sid)
+            if data is not None:
+                self.stats.incr('local_cache_hits')
+                return data
+            self.stats.incr('local_cache_misses')
+        _generation = self._invalidation_generation
         try:
-            res = self.sso_sessions.find_one({'session_id': sid})
-            if res:
+            with self.stats.timed('get'):
+                res = self.sso_sessions.find_one({'session_id': sid})
+            if not res:
+                self.stats.incr('misses')
+            else:
+                self.stats.incr('hits')
+                if self._local_cache is not None:
+                    # Sessions not found are not cached, since they might be in the process of being created.
+                    # If any session was invalidated during the lookup, it might have been this one.
+                    with self._invalidation_lock:
+                        if _generation == self._invalidation_generation:
+                            self._local_cache.add(sid, res['data'])
                 return res['data']
         except KeyError:
             self.logger.debug('Failed looking up SSO session with id={!r}'.format(sid))
@@ -488,6 +1440,142 @@ class SSOSessionCacheMDB(SSOSessionCache):
             if self._last_expire_at > _ts - self._expiration_freq:
                 return False
         self._last_expire_at = _ts
-        isodate = datetime.datetime.fromtimestamp(_ts, None)
-        self.sso_sessions.remove({'created_ts': {'$lt': isodate}})
+        isodate = datetime.datetime.utcfromtimestamp(_ts)
+        with self.stats.timed('expire'):
+            self.sso_sessions.remove({'created_ts': {'$lt': isodate}})
         return True
+
+    def entry_count(self):
+        with self.stats.timed('count'):
+            return self.sso_sessions.count()
+
+
+class SSOSessionReaper(threading.Thread):
+    """
+    Background thread removing expired SSO sessions from MongoDB, to keep the
+    delete-querys out of the login request.
+
+    To not have every IdP process in a cluster run the same delete-query, a lease
+    is taken in the `sso_session_leases' collection before expiring sessions. The
+    process holding the lease renews it on every run. Should it stop doing so, the
+    lease expires after three intervals and another process takes over.
+
+    :param cache: SSO session cache to expire sessions in
+    :param interval: seconds between expiration runs
+    :param logger: logging logger instance
+    :param lease_name: name of the cluster-wide lease
+
+    :type cache: SSOSessionCacheMDB
+    :type interval: int
+    :type logger: logging.Logger
+    :type lease_name: str
+    """
+
+    def __init__(self, cache, interval, logger, lease_name = 'sso_session_reaper'):
+        threading.Thread.__init__(self, name = 'SSOSessionReaper')
+        self.daemon = True
+        self.logger = logger
+        self._cache = cache
+        self._interval = interval
+        self._lease_name = lease_name
+        self._holder = '{!s}:{!s}:{!s}'.format(socket.gethostname(), os.getpid(), uuid.uuid4())
+        self._leases = cache.db.sso_session_leases
+        self._stop_event = threading.Event()
+
+    def run(self):
+        while not self._stop_event.wait(self._interval):
+            try:
+                if self.acquire_lease():
+                    self._cache.expire_old_sessions(force = True)
+            except pymongo.errors.PyMongoError as exc:
+                # keep the reaper alive through MongoDB problems, and try again next interval
+                self.logger.error('Failed expiring SSO sessions: {!r}'.format(exc))
+
+    def stop(self):
+        """
+        Make the reaper thread exit before the next expiration run.
+        """
+        self._stop_event.set()
+
+    def acquire_lease(self, now = None):
+        """
+        Acquire (or renew) the cluster-wide lease allowing this process to expire sessions.
+
+        :param now: Current time - do not use unless testing!
+        :return: True if this process holds the lease
+
+        :type now: datetime.datetime | None
+        :rtype: bool
+        """
+        if now is None:
+            now = datetime.datetime.utcnow()
+        expires_at = now + datetime.timedelta(seconds = self._interval * 3)
+        try:
+            # If the lease exists, but is held by someone else and hasn't expired, the query
+            # does not match and the upsert fails with a duplicate key error.
+            self._leases.find_and_modify(
+                query = {'_id': self._lease_name,
+                         '$or': [{'holder': self._holder},
+                                 {'expires_at': {'$lt': now}},
+                                 ],
+                         },
+                update = {'$set': {'holder': self._holder,
+                                   'expires_at': expires_at,
+                                   },
+                          },
+                upsert = True, new = True)
+        except pymongo.errors.OperationFailure as exc:
+            if exc.code not in [11000, 11001]:
+                raise
+            return False
+        return True
+
+
+class SSOSessionInvalidationListener(threading.Thread):
+    """
+    Background thread tailing the capped collection where SSOSessionCacheMDB.remove_session()
+    publishes the ids of removed sessions, and invalidating them in the local session cache.
+
+    Invalidations are idempotent, so after a lost cursor the collection is tailed again
+    starting a little before the last seen invalidation rather than risking to miss one.
+
+    :param collection: capped MongoDB collection to tail
+    :param invalidate: function to call with the session id of every removed session
+    :param logger: logging logger instance
+    :param retry_interval: seconds to wait before re-tailing the collection
+
+    :type collection: pymongo.collection.Collection
+    :type invalidate: callable
+    :type logger: logging.Logger
+    :type retry_interval: int
+    """
+
+    def __init__(self, collection, invalidate, logger, retry_interval = 1):
+        threading.Thread.__init__(self, name = 'SSOSessionInvalidationListener')
+        self.daemon = True
+        self.logger = logger
+        self._collection = collection
+        self._invalidate = invalidate
+        self._retry_interval = retry_interval
+        self._stop_event = threading.Event()
+
+    def run(self):
+        _last_ts = datetime.datetime.utcnow()
+        while not self._stop_event.is_set():
+            try:
+                _since = _last_ts - datetime.timedelta(seconds = 1)
+                cursor = self._collection.find({'ts': {'$gte': _since}}, **_TAILABLE_AWAIT)
+                while cursor.alive and not self._stop_event.is_set():
+                    for this in cursor:
+                        self._invalidate(this['session_id'])
+                        _last_ts = max(_last_ts, this['ts'])
+            except pymongo.errors.PyMongoError as exc:
+                self.logger.error('Failed reading SSO session invalidations: {!r}'.format(exc))
+            # the cursor dies if the collection is empty, or after connection problems
+            self._stop_event.wait(self._retry_interval)
+
+    def stop(self):
+        """
+        Make the listener thread exit.
+        """
+        self._stop_event.set()
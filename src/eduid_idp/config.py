@@ -82,38 +82,123 @@ _CONFIG_DEFAULTS = {'debug': False,  # overwritten in IdPConfig.__init__()
                     'redis_port': '6379',
                     'redis_db': '0',
                     'session_app_key': None,
+                    'memory_cache_shards': '1',  # number of independently locked shards for in-memory caches
+                    'login_state_max_entries': '0',  # max number of in-memory login states, 0 for unlimited
+                    'login_state_max_bytes': '0',    # max approx. size of in-memory login states, 0 for unlimited
+                    'sso_session_max_entries': '0',  # max number of in-memory SSO sessions, 0 for unlimited
+                    'sso_session_mongo_ttl_index': '0',  # '1' to have MongoDB expire SSO sessions natively
+                    'sso_session_reaper_interval': '0',  # seconds between background SSO session expiry, 0 to disable
+                    'sso_session_local_cache_ttl': '0',  # seconds to cache MongoDB SSO sessions in-process, 0 to disable
+                    'sso_session_invalidation_channel': '0',  # '1' to invalidate SSO sessions cluster-wide
+                    'sso_session_redis': '0',  # '1' to store SSO sessions in Redis (see redis_host)
+                    'user_cache_ttl': '0',  # seconds to cache users loaded from the userdb, 0 to disable
+                    'user_cache_negative_ttl': '0',  # seconds to cache unknown usernames, 0 to disable
+                    'user_cache_max_entries': '10000',  # max number of cached users (and unknown usernames)
+                    'userdb_projection': '0',  # '1' to only load the parts of user documents used by the IdP
+                    'release_policy_cache_ttl': '3600',  # seconds to remember the attribute release policy of SPs
+                    'authn_log_flush_interval': '0',  # seconds between writes of authn results, 0 to write directly
+                    'authn_log_max_pending': '10000',  # max number of users with authn results waiting to be written
+                    'vccs_concurrent_verify': '0',  # '1' to check all of a users passwords with VCCS at the same time
+                    'vccs_pool_size': '0',  # max number of kept-alive connections to VCCS, 0 for a new one per request
+                    'vccs_timeout': '5',  # seconds to wait for VCCS when using kept-alive connections
+                    'breaker_failure_threshold': '0',  # failed calls to a backend before failing fast, 0 to disable
+                    'breaker_latency_threshold': '2.5',  # seconds after which a call to a backend counts as failed
+                    'breaker_reset_timeout': '10',  # seconds to fail fast before trying a failing backend again
                     }
 
 _CONFIG_SECTION = 'eduid_idp'
 
 
+class setting(object):
+    """
+    Decorator for IdPConfig settings, used like @property.
+
+    The value is parsed from the INI-file only once, and is then stored in the
+    instance so that all subsequent reads are plain attribute lookups.
+    """
+
+    def __init__(self, func):
+        self.func = func
+        self.__name__ = func.__name__
+        self.__doc__ = func.__doc__
+
+    def __get__(self, obj, objtype = None):
+        if obj is None:
+            return self
+        value = self.func(obj)
+        obj.__dict__[self.__name__] = value
+        return value
+
+
 class IdPConfig(object):
 
     """
     Class holding IdP application configuration.
 
-    Loads configuration from an INI-file at instantiation.
+    Loads configuration from an INI-file at instantiation. All settings are parsed
+    (and thereby validated) once, when the configuration is loaded. After that the
+    instance is read-only, and reading settings is as cheap as reading any attribute.
 
     :param filename: string, INI-file name
     :param debug: boolean, default debug value
     :param defaults: None or a dict with default values
-    :raise ValueError: if INI-file can't be parsed
+    :raise ValueError: if INI-file can't be parsed, or contains invalid values
     """
 
     def __init__(self, filename, debug, defaults=None):
-        self._parsed_content_packages = None
-        self._parsed_status_test_usernames = None
-        self._parsed_redis_sentinel_hosts = None
         self.section = _CONFIG_SECTION
-        _defaults = defaults or _CONFIG_DEFAULTS
+        self.filename = filename
+        self._debug = debug
+        self._defaults = defaults
+        # copy the defaults, to not modify the dict passed to us (or _CONFIG_DEFAULTS)
+        _defaults = dict(defaults or _CONFIG_DEFAULTS)
         _defaults['debug'] = str(debug)
         cfgdir = os.path.dirname(filename)
         _defaults['pysaml2_config'] = os.path.join(cfgdir, _defaults['pysaml2_config'])
         self.config = ConfigParser.ConfigParser(_defaults)
         if not self.config.read([filename]):
             raise ValueError("Failed loading config file {!r}".format(filename))
+        self._parse_settings()
+        self._frozen = True
+
+    def reload(self):
+        """
+        Load the configuration again, from the same INI-file and with the same defaults.
+
+        This instance is not modified. To use the new configuration, replace all
+        references to this instance with the returned one.
+
+        :return: New configuration
+        :rtype: IdPConfig
+        :raise ValueError: if INI-file can't be parsed, or contains invalid values
+        """
+        return IdPConfig(self.filename, self._debug, self._defaults)
 
-    @property
+    def _parse_settings(self):
+        """
+        Parse all settings, so that invalid values are detected right away instead of
+        when they are first used.
+
+        :raise ValueError: if a setting has an invalid value
+        """
+        for name in dir(self.__class__):
+            if not isinstance(getattr(self.__class__, name), setting):
+                continue
+            try:
+                getattr(self, name)
+            except ConfigParser.NoOptionError:
+                # settings without a default value are only required if used
+                pass
+            except ValueError as exc:
+                raise ValueError('Bad value for setting {!r} in config file {!r}: {!s}'.format(
+                    name, self.filename, exc))
+
+    def __setattr__(self, name, value):
+        if self.__dict__.get('_frozen'):
+            raise AttributeError('IdPConfig is read-only (tried to set {!r})'.format(name))
+        object.__setattr__(self, name, value)
+
+    @setting
     def num_threads(self):
         """
         Number of worker threads to start (integer).
@@ -125,7 +210,7 @@ class IdPConfig(object):
         """
         return self.config.getint(self.section, 'num_threads')
 
-    @property
+    @setting
     def logdir(self):
         """
         Path to CherryPy logfiles (string). Something like '/var/log/idp' maybe.
@@ -135,7 +220,7 @@ class IdPConfig(object):
             res = None
         return res
 
-    @property
+    @setting
     def logfile(self):
         """
         Path to application logfile. Something like '/var/log/idp/eduid_idp.log' maybe.
@@ -145,7 +230,7 @@ class IdPConfig(object):
             res = None
         return res
 
-    @property
+    @setting
     def syslog_socket(self):
         """
         Syslog socket to log to (string). Something like '/dev/log' maybe.
@@ -155,42 +240,42 @@ class IdPConfig(object):
             res = None
         return res
 
-    @property
+    @setting
     def debug(self):
         """
         Set to True to log debug messages (boolean).
         """
         return self.config.getboolean(self.section, 'debug')
 
-    @property
+    @setting
     def syslog_debug(self):
         """
         Set to True to log debug messages to syslog (also requires syslog_socket) (boolean).
         """
         return self.config.getboolean(self.section, 'syslog_debug')
 
-    @property
+    @setting
     def listen_addr(self):
         """
         IP address to listen on.
         """
         return self.config.get(self.section, 'listen_addr')
 
-    @property
+    @setting
     def listen_port(self):
         """
         The port the IdP authentication should listen on (integer).
         """
         return self.config.getint(self.section, 'listen_port')
 
-    @property
+    @setting
     def pysaml2_config(self):
         """
         pysaml2 configuration file. Separate config file with SAML related parameters.
         """
         return self.config.get(self.section, 'pysaml2_config')
 
-    @property
+    @setting
     def fticks_secret_key(self):
         """
         SAML F-TICKS user anonymization key. If this is set, the IdP will log FTICKS data
@@ -198,70 +283,70 @@ class IdPConfig(object):
         """
         return self.config.get(self.section, 'fticks_secret_key')
 
-    @property
+    @setting
     def fticks_format_string(self):
         """
         Get SAML F-TICKS format string.
         """
         return self.config.get(self.section, 'fticks_format_string')
 
-    @property
+    @setting
     def static_dir(self):
         """
         Directory with static files to be served.
         """
         return self.config.get(self.section, 'static_dir')
 
-    @property
+    @setting
     def ssl_adapter(self):
         """
         CherryPy SSL adapter class to use (must be one of cherrypy.wsgiserver.ssl_adapters)
         """
         return self.config.get(self.section, 'ssl_adapter')
 
-    @property
+    @setting
     def server_cert(self):
         """
         SSL certificate filename (None == SSL disabled)
         """
         return self.config.get(self.section, 'server_cert')
 
-    @property
+    @setting
     def server_key(self):
         """
         SSL private key filename (None == SSL disabled)
         """
         return self.config.get(self.section, 'server_key')
 
-    @property
+    @setting
     def cert_chain(self):
         """
         SSL certificate chain filename
         """
         return self.config.get(self.section, 'cert_chain')
 
-    @property
+    @setting
     def mongo_uri(self):
         """
         MongoDB connection URI (string). See MongoDB documentation for details.
         """
         return self.config.get(self.section, 'mongo_uri')
 
-    @property
+    @setting
     def userdb_mongo_database(self):
         """
         UserDB database name.
         """
         return self.config.get(self.section, 'userdb_mongo_database')
 
-    @property
+    @setting
     def sso_session_mongo_uri(self):
         """
         MongoDB connection URI (string) for PySAML2 SSO sessions.
         """
         return self.config.get(self.section, 'sso_session_mongo_uri')
 
-    @property
+    @setting
     def sso_session_lifetime(self):
         """
         Lifetime of SSO session (in minutes).
@@ -275,14 +360,14 @@ class IdPConfig(object):
         """
         return self.config.getint(self.section, 'sso_session_lifetime')
 
-    @property
+    @setting
     def raven_dsn(self):
         """
         Raven DSN (string) for logging exceptions to Sentry.
         """
         return self.config.get(self.section, 'raven_dsn')
 
-    @property
+    @setting
     def content_packages(self):
         """
         Get list of tuples with packages and paths to content resources, such as login.html.
@@ -293,18 +378,17 @@ class IdPConfig(object):
 
         :return: list of (pkg, path) tuples
         """
-        if self._parsed_content_packages:
-            return self._parsed_content_packages
         value = self.config.get(self.section, 'content_packages')
         res = []
+        if not value:
+            return res
         for this in value.split(','):
             this = this.strip()
             name, _sep, path, = this.partition(':')
             res.append((name, path))
-        self._parsed_content_packages = res
         return res
 
-    @property
+    @setting
     def verify_request_signatures(self):
         """
         Verify request signatures, if they exist.
@@ -315,7 +399,7 @@ class IdPConfig(object):
         res = self.config.get(self.section, 'verify_request_signatures')
         return bool(int(res))
 
-    @property
+    @setting
     def status_test_usernames(self):
         """
         Get list of usernames valid for use with the /status URL.
@@ -326,63 +410,60 @@ class IdPConfig(object):
 
         :rtype: list[string]
         """
-        if self._parsed_status_test_usernames:
-            return self._parsed_status_test_usernames
         value = self.config.get(self.section, 'status_test_usernames')
         res = []
         if value:
             res = [x.strip() for x in value.split(',')]
-        self._parsed_status_test_usernames = res
         return res
 
-    @property
+    @setting
     def signup_link(self):
         """
         URL (string) for use in simple templating of login.html.
         """
         return self.config.get(self.section, 'signup_link')
 
-    @property
+    @setting
     def dashboard_link(self):
         """
         URL (string) for use in simple templating of forbidden.html.
         """
         return self.config.get(self.section, 'dashboard_link')
 
-    @property
+    @setting
     def password_reset_link(self):
         """
         URL (string) for use in simple templating of login.html.
         """
         return self.config.get(self.section, 'password_reset_link')
 
-    @property
+    @setting
     def student_link(self):
         """
             URL (string) for use in simple templating of base.
             """
         return self.config.get(self.section, 'student_link')
 
-    @property
+    @setting
     def technicians_link(self):
         return self.config.get(self.section, 'technicians_link')
 
-    @property
+    @setting
     def staff_link(self):
         return self.config.get(self.section, 'staff_link')
 
-    @property
+    @setting
     def faq_link(self):
         return self.config.get(self.section, 'faq_link')
 
-    @property
+    @setting
     def default_language(self):
         """
         Default language code to use when looking for web pages ('en').
         """
         return self.config.get(self.section, 'default_language')
 
-    @property
+    @setting
     def base_url(self):
         """
         Base URL of the IdP. The default base URL is constructed from the
@@ -392,7 +473,7 @@ class IdPConfig(object):
         """
         return self.config.get(self.section, 'base_url')
 
-    @property
+    @setting
     def default_eppn_scope(self):
         """
         The scope to append to any unscoped eduPersonPrincipalName
@@ -400,7 +481,7 @@ class IdPConfig(object):
         """
         return self.config.get(self.section, 'default_eppn_scope')
 
-    @property
+    @setting
     def max_authn_failures_per_month(self):
         """
         Disallow login for a user after N failures in a given month.
@@ -409,7 +490,7 @@ class IdPConfig(object):
         """
         return self.config.getint(self.section, 'max_authn_failures_per_month')
 
-    @property
+    @setting
     def login_state_ttl(self):
         """
         Lifetime of state kept in IdP login phase.
@@ -420,7 +501,7 @@ class IdPConfig(object):
         """
         return self.config.getint(self.section, 'login_state_ttl')
 
-    @property
+    @setting
     def default_scoped_affiliation(self):
         """
         Add a default eduPersonScopedAffiliation if none is returned from the
@@ -428,7 +509,7 @@ class IdPConfig(object):
         """
         return self.config.get(self.section, 'default_scoped_affiliation')
 
-    @property
+    @setting
     def vccs_url(self):
         """
         URL to use with VCCS client. BCP is to have an nginx or similar on
@@ -437,14 +518,14 @@ class IdPConfig(object):
         """
         return self.config.get(self.section, 'vccs_url')
 
-    @property
+    @setting
     def insecure_cookies(self):
         """
         Set to True to NOT set HTTP Cookie 'secure' flag (boolean).
         """
         return self.config.getboolean(self.section, 'insecure_cookies')
 
-    @property
+    @setting
     def actions_auth_shared_secret(self):
         """
         Secret shared with the actions app to convince it
@@ -452,21 +533,21 @@ class IdPConfig(object):
         """
         return self.config.get(self.section, 'actions_auth_shared_secret')
 
-    @property
+    @setting
     def actions_app_uri(self):
         """
         URI of the actions app.
         """
         return self.config.get(self.section, 'actions_app_uri')
 
-    @property
+    @setting
     def tou_version(self):
         """
         The current version of the terms of use agreement.
         """
         return self.config.get(self.section, 'tou_version')
 
-    @property
+    @setting
     def redis_sentinel_hosts(self):
         """
         Redis sentinel hosts, comma separated
@@ -475,46 +556,260 @@ class IdPConfig(object):
 
         :rtype: [string]
         """
-        if self._parsed_redis_sentinel_hosts:
-            return self._parsed_redis_sentinel_hosts
         value = self.config.get(self.section, 'redis_sentinel_hosts')
         res = []
         if value:
             res = [x.strip() for x in value.split(',')]
-        self._parsed_redis_sentinel_hosts = res
         return res
 
-    @property
+    @setting
     def redis_host(self):
         """
         The Redis host to use for session storage.
         """
         return self.config.get(self.section, 'redis_host')
 
-    @property
+    @setting
     def redis_port(self):
         """
         The port of the Redis server (integer).
         """
         return self.config.getint(self.section, 'redis_port')
 
-    @property
+    @setting
     def redis_sentinel_service_name(self):
         """
         The Redis sentinel 'service name'.
         """
         return self.config.get(self.section, 'redis_sentinel_service_name')
 
-    @property
+    @setting
     def redis_db(self):
         """
         The Redis database number (integer).
         """
         return self.config.getint(self.section, 'redis_db')
 
-    @property
+    @setting
     def session_app_key(self):
         """
         The Redis session encrypted application key.
         """
         return self.config.get(self.section, 'session_app_key')
+
+    @setting
+    def memory_cache_shards(self):
+        """
+        Number of independently locked shards to split the in-memory login state
+        (IdP ticket) and SSO session caches into (integer).
+
+        With many worker threads (num_threads), a single lock per cache becomes a
+        point of contention. Using more shards than one reduces that contention.
+        """
+        return self.config.getint(self.section, 'memory_cache_shards')
+
+    @setting
+    def login_state_max_entries(self):
+        """
+        Maximum number of login states (IdP tickets) to keep in memory (integer).
+
+        When the limit is reached, the least recently used login state is evicted.
+        Zero means no limit (login states are only removed when login_state_ttl
+        has passed). When login states are stored in Redis, this limits the
+        process-local cache of login states in front of Redis.
+        """
+        return self.config.getint(self.section, 'login_state_max_entries')
+
+    @setting
+    def login_state_max_bytes(self):
+        """
+        Maximum approximate size, in bytes, of the login states (IdP tickets) kept
+        in memory (integer).
+
+        When the limit is reached, the least recently used login state is evicted.
+        Zero means no limit. When login states are stored in Redis, this limits the
+        process-local cache of login states in front of Redis.
+        """
+        return self.config.getint(self.section, 'login_state_max_bytes')
+
+    @setting
+    def sso_session_max_entries(self):
+        """
+        Maximum number of SSO sessions to keep in memory (integer).
+
+        When the limit is reached, the least recently used SSO session is evicted.
+        Zero means no limit. Only applicable to the in-memory SSO session cache.
+        """
+        return self.config.getint(self.section, 'sso_session_max_entries')
+
+    @setting
+    def sso_session_mongo_ttl_index(self):
+        """
+        Set to True to have MongoDB expire SSO sessions using a TTL index (boolean),
+        instead of the IdP removing expired sessions when new ones are added.
+
+        Only applicable when sso_session_mongo_uri is set.
+        """
+        return self.config.getboolean(self.section, 'sso_session_mongo_ttl_index')
+
+    @setting
+    def sso_session_reaper_interval(self):
+        """
+        Interval, in seconds, for a background thread removing expired SSO sessions
+        from MongoDB (integer). Zero disables the background thread.
+
+        MongoDB TTL indexes are only processed about once a minute. This can be used
+        in deployments that require more timely expiry. Only one IdP process in a
+        cluster will remove sessions at any one time.
+
+        Only applicable when sso_session_mongo_uri is set.
+        """
+        return self.config.getint(self.section, 'sso_session_reaper_interval')
+
+    @setting
+    def sso_session_local_cache_ttl(self):
+        """
+        Number of seconds to cache SSO sessions loaded from MongoDB in the IdP process
+        (integer). Zero disables the local cache.
+
+        Keep this short. Removed (logged out) SSO sessions might be found in the local
+        cache of other IdP processes until it expires, unless sso_session_invalidation_channel
+        is enabled.
+
+        Only applicable when sso_session_mongo_uri is set.
+        """
+        return self.config.getint(self.section, 'sso_session_local_cache_ttl')
+
+    @setting
+    def sso_session_invalidation_channel(self):
+        """
+        Set to True to notify all IdP processes when an SSO session is removed, so that
+        they can remove it from their local cache (boolean).
+
+        Only applicable when sso_session_mongo_uri is set.
+        """
+        return self.config.getboolean(self.section, 'sso_session_invalidation_channel')
+
+    @setting
+    def sso_session_redis(self):
+        """
+        Set to True to store SSO sessions in Redis (boolean), using the same
+        Redis settings (redis_host, redis_sentinel_hosts etc.) as the login state.
+
+        Takes precedence over sso_session_mongo_uri.
+        """
+        return self.config.getboolean(self.section, 'sso_session_redis')
+
+    @setting
+    def user_cache_ttl(self):
+        """
+        Number of seconds to cache users loaded from the userdb in each IdP process
+        (integer). Avoids looking up the user in the database on every request from
+        a user with an SSO session. Changes to users are not seen by the IdP until the
+        cached user expires, so keep this short. 0 to disable.
+        """
+        return self.config.getint(self.section, 'user_cache_ttl')
+
+    @setting
+    def user_cache_negative_ttl(self):
+        """
+        Number of seconds to remember that a username was not found in the userdb
+        (integer). Keeps e.g. password guessing against non-existing accounts from
+        reaching the database. 0 to disable.
+        """
+        return self.config.getint(self.section, 'user_cache_negative_ttl')
+
+    @setting
+    def user_cache_max_entries(self):
+        """
+        Maximum number of users (and unknown usernames) to cache in each IdP process
+        (integer). 0 for unlimited.
+        """
+        return self.config.getint(self.section, 'user_cache_max_entries')
+
+    @setting
+    def userdb_projection(self):
+        """
+        Only load the parts of user documents in the userdb that the IdP uses (SAML
+        attributes, password credentials, NINs) instead of complete documents (boolean).
+        """
+        return self.config.getboolean(self.section, 'userdb_projection')
+
+    @setting
+    def release_policy_cache_ttl(self):
+        """
+        Number of seconds to remember which attributes may be released to an SP, and
+        in what name format (integer). The cache is emptied when the metadata is
+        reloaded (on SIGHUP). 0 to disable.
+        """
+        return self.config.getint(self.section, 'release_policy_cache_ttl')
+
+    @setting
+    def authn_log_flush_interval(self):
+        """
+        Number of seconds between writes of authentication results (last used
+        credentials, failure counts) to the database by a background thread (integer).
+        0 to write them as part of the login request instead.
+        """
+        return self.config.getint(self.section, 'authn_log_flush_interval')
+
+    @setting
+    def authn_log_max_pending(self):
+        """
+        Maximum number of users to queue authentication results for, between writes
+        to the database (integer). Results for further users are written directly.
+        """
+        return self.config.getint(self.section, 'authn_log_max_pending')
+
+    @setting
+    def vccs_concurrent_verify(self):
+        """
+        Check all password credentials of a user with VCCS at the same time, instead
+        of one at a time (boolean). Makes a failed login take one round trip to VCCS
+        instead of one per credential, at the cost of more requests to VCCS for
+        successful logins of users with more than one password. The number of parallel
+        requests is limited to vccs_pool_size (or 5, without a connection pool).
+        """
+        return self.config.getboolean(self.section, 'vccs_concurrent_verify')
+
+    @setting
+    def vccs_pool_size(self):
+        """
+        Maximum number of kept-alive connections from each IdP process to VCCS
+        (integer). 0 to have the VCCS client make a new connection for every request.
+        Should be at least num_threads, or requests will wait for a free connection.
+        """
+        return self.config.getint(self.section, 'vccs_pool_size')
+
+    @setting
+    def vccs_timeout(self):
+        """
+        Number of seconds to wait for a connection to VCCS to become available, and
+        for VCCS to respond (float). Only used with vccs_pool_size.
+        """
+        return self.config.getfloat(self.section, 'vccs_timeout')
+
+    @setting
+    def breaker_failure_threshold(self):
+        """
+        Number of consecutive failed (or slow) calls to a backend (VCCS, the userdb or
+        the authn info database) after which requests needing that backend are failed
+        right away, instead of waiting for it (integer). 0 to never fail fast.
+        """
+        return self.config.getint(self.section, 'breaker_failure_threshold')
+
+    @setting
+    def breaker_latency_threshold(self):
+        """
+        Number of seconds after which a call to a backend counts as failed, even
+        if it succeeds (float). 0 to only count errors.
+        """
+        return self.config.getfloat(self.section, 'breaker_latency_threshold')
+
+    @setting
+    def breaker_reset_timeout(self):
+        """
+        Number of seconds to fail fast, before letting a request through to probe
+        if a failing backend has recovered (float).
+        """
+        return self.config.getfloat(self.section, 'breaker_reset_timeout')
@@ -106,10 +106,12 @@ the SSO session using the `idpauthn' cookie sent by the users browser and only s
 
 import os
 import sys
+import copy
 import pprint
 import logging
 import argparse
 import threading
+from collections import namedtuple
 
 import cherrypy
 import simplejson
@@ -141,6 +143,43 @@ except ImportError:
 default_config_file = "/opt/eduid/IdP/conf/idp.ini"
 default_debug = False
 
+# Settings only used at startup, which can't be changed using reload_config().
+# The storage TTL of SSO sessions is set from sso_session_lifetime at startup.
+_RESTART_REQUIRED_SETTINGS = ['num_threads', 'listen_addr', 'listen_port', 'ssl_adapter', 'server_cert',
+                              'server_key', 'cert_chain', 'debug', 'logdir', 'logfile', 'syslog_socket',
+                              'syslog_debug', 'raven_dsn', 'sso_session_lifetime',
+                              'mongo_uri', 'userdb_mongo_database', 'vccs_url', 'sso_session_mongo_uri',
+                              'sso_session_redis', 'sso_session_mongo_ttl_index', 'sso_session_reaper_interval',
+                              'sso_session_local_cache_ttl', 'sso_session_invalidation_channel',
+                              'sso_session_max_entries', 'memory_cache_shards', 'login_state_ttl',
+                              'login_state_max_entries', 'login_state_max_bytes', 'redis_sentinel_hosts',
+                              'redis_sentinel_service_name', 'redis_host', 'redis_port', 'redis_db',
+                              'session_app_key', 'authn_log_flush_interval', 'authn_log_max_pending',
+                              'vccs_concurrent_verify', 'vccs_pool_size', 'vccs_timeout',
+                              'breaker_failure_threshold', 'breaker_latency_threshold', 'breaker_reset_timeout',
+                              ]
+
+
+# The configuration, and the objects depending on it, which are replaced as a unit by reload_config()
+_Snapshot = namedtuple('_Snapshot', ['config', 'IDP', 'AUTHN_BROKER', 'userdb', 'authn'])
+
+
+def _snapshot_property(name):
+    """
+    Make a property for an attribute of IdPApplication._snapshot.
+
+    :param name: Name of the attribute
+    :type name: str
+    :rtype: property
+    """
+    def _get(self):
+        return getattr(self._snapshot, name)
+
+    def _set(self, value):
+        self._snapshot = self._snapshot._replace(**{name: value})
+
+    return property(_get, _set, doc = 'The current {!s} (see reload_config())'.format(name))
+
 
 def parse_args():
     """
@@ -180,6 +219,13 @@ class IdPApplication(object):
     :type config: eduid_idp.config.IdPConfig
     """
 
+    _snapshot = _Snapshot(None, None, None, None, None)
+    config = _snapshot_property('config')
+    IDP = _snapshot_property('IDP')
+    AUTHN_BROKER = _snapshot_property('AUTHN_BROKER')
+    userdb = _snapshot_property('userdb')
+    authn = _snapshot_property('authn')
+
     def __init__(self, logger, config):
         self.logger = logger
         self.config = config
@@ -225,34 +271,153 @@ class IdPApplication(object):
 
         :return:
         """
+        _session_ttl = self.config.sso_session_lifetime * 60
+        if self.config.sso_session_redis:
+            _SSOSessions = eduid_idp.cache.SSOSessionCacheRedis(self.logger, _session_ttl, config = self.config)
+        elif self.config.sso_session_mongo_uri:
+            _SSOSessions = eduid_idp.cache.SSOSessionCacheMDB(
+                self.config.sso_session_mongo_uri, self.logger, _session_ttl,
+                ttl_index = self.config.sso_session_mongo_ttl_index,
+                reaper_interval = self.config.sso_session_reaper_interval,
+                local_cache_ttl = self.config.sso_session_local_cache_ttl,
+                invalidation_channel = self.config.sso_session_invalidation_channel)
+        else:
+            _SSOSessions = eduid_idp.cache.SSOSessionCacheMem(self.logger, _session_ttl, threading.Lock(),
+                                                              shards = self.config.memory_cache_shards,
+                                                              max_entries = self.config.sso_session_max_entries)
+
+        self.IDP = self._load_pysaml2(self.config, _SSOSessions)
+
+        _my_id = self.IDP.config.entityid
+        self.AUTHN_BROKER = eduid_idp.assurance.init_AuthnBroker(_my_id)
+        _login_state_ttl = (self.config.login_state_ttl + 1) * 60
+        self.IDP.ticket = SSOLoginDataCache(self.IDP, 'TicketCache', self.logger, _login_state_ttl,
+                                            self.config, threading.Lock())
+
+    def _load_pysaml2(self, config, sso_sessions, reload = False):
+        """
+        Load the pysaml2 configuration and create a pysaml2 server.
+
+        :param config: IdP configuration data
+        :param sso_sessions: SSO session cache
+        :param reload: Re-load the pysaml2 configuration module even if it is already loaded
+
+        :type config: eduid_idp.config.IdPConfig
+        :type sso_sessions: eduid_idp.cache.SSOSessionCache
+        :type reload: bool
+        :rtype: server.Server
+        """
         old_path = sys.path
-        cfgfile = self.config.pysaml2_config
+        cfgfile = config.pysaml2_config
         cfgdir = os.path.dirname(cfgfile)
         if cfgdir:
             # add directory part to sys.path, since pysaml2 'import's it's config
             sys.path = [cfgdir] + sys.path
-            cfgfile = os.path.basename(self.config.pysaml2_config)
-
-        _session_ttl = self.config.sso_session_lifetime * 60
-        if self.config.sso_session_mongo_uri:
-            _SSOSessions = eduid_idp.cache.SSOSessionCacheMDB(self.config.sso_session_mongo_uri,
-                                                              self.logger, _session_ttl)
-        else:
-            _SSOSessions = eduid_idp.cache.SSOSessionCacheMem(self.logger, _session_ttl, threading.Lock())
+            cfgfile = os.path.basename(config.pysaml2_config)
+        if reload:
+            # pysaml2 uses importlib.import_module(), which will return the already loaded module
+            sys.modules.pop(os.path.splitext(cfgfile)[0], None)
 
         _path = sys.path[0]
         self.logger.debug("Loading PySAML2 server using cfgfile {!r} and path {!r}".format(cfgfile, _path))
         try:
-            self.IDP = server.Server(cfgfile, cache = _SSOSessions)
+            IDP = server.Server(cfgfile, cache = sso_sessions)
         finally:
             # restore path
             sys.path = old_path
+        _policy = IDP.config.getattr('policy', 'idp')
+        if _policy is not None and config.release_policy_cache_ttl:
+            # The metadata is loaded again together with the pysaml2 configuration, so a new
+            # CachingPolicy (without cached data) has to be used whenever this function is called
+            IDP.config.setattr('idp', 'policy', eduid_idp.policy.CachingPolicy(_policy, self.logger,
+                                                                                config.release_policy_cache_ttl))
+        return IDP
+
+    def reload_config(self):
+        """
+        Re-load the IdP configuration and the pysaml2 configuration (e.g. on SIGHUP).
 
-        _my_id = self.IDP.config.entityid
-        self.AUTHN_BROKER = eduid_idp.assurance.init_AuthnBroker(_my_id)
-        _login_state_ttl = (self.config.login_state_ttl + 1) * 60
-        self.IDP.ticket = SSOLoginDataCache(self.IDP, 'TicketCache', self.logger, _login_state_ttl,
-                                            self.config, threading.Lock())
+        The new configuration is loaded and validated completely before anything is
+        changed. A new snapshot of the configuration and the objects depending on it
+        (pysaml2 server, login state cache wrapper, user database and authn) is then
+        built and published by a single assignment of self._snapshot. Requests already
+        being processed keep using the snapshot they started with (see pinned()). The
+        SSO session and login state caches, and connections to backends, are shared
+        with the new snapshot, so no one has to log in again.
+
+        Settings only used at startup (see _RESTART_REQUIRED_SETTINGS) still require a restart.
+
+        :return: True on success, False if the new configuration could not be loaded
+        :rtype: bool
+        """
+        self.logger.info("Reloading configuration from {!r}".format(self.config.filename))
+        current = self._snapshot
+        try:
+            config = current.config.reload()
+            IDP = self._load_pysaml2(config, current.IDP.cache, reload = True)
+            authn_broker = eduid_idp.assurance.init_AuthnBroker(IDP.config.entityid)
+        except Exception:
+            self.logger.exception("Failed reloading configuration, keeping the current configuration")
+            return False
+
+        _changed = [x for x in _RESTART_REQUIRED_SETTINGS if getattr(config, x) != getattr(current.config, x)]
+        if _changed:
+            self.logger.warning("Changes to these settings require a restart: {!s}".format(', '.join(_changed)))
+
+        IDP.ticket = current.IDP.ticket.with_config(IDP, config)
+        # the new user database has an empty cache, which also gives operators a way to flush all cached users
+        userdb = current.userdb.with_config(config)
+        authn = current.authn.with_config(config, userdb)
+        self._snapshot = _Snapshot(config = config,
+                                   IDP = IDP,
+                                   AUTHN_BROKER = authn_broker,
+                                   userdb = userdb,
+                                   authn = authn,
+                                   )
+        self.logger.info("Configuration reloaded")
+        return True
+
+    def pinned(self):
+        """
+        Get a copy of the application that keeps using the current configuration snapshot,
+        even if reload_config() is called while it is in use. The request handlers use this,
+        so that every request is processed using a single configuration.
+
+        :rtype: IdPApplication
+        """
+        return copy.copy(self)
+
+    def get_stats(self):
+        """
+        Get statistics (hits, misses, expiries, evictions and latency histograms) for the
+        login state, SSO session and attribute release policy caches, the authn log queue,
+        the VCCS connection pool and the state of the backend circuit breakers.
+
+        :rtype: dict
+        """
+        res = {'login_state': self.IDP.ticket.get_stats(),
+               'sso_sessions': self.IDP.cache.get_stats(),
+               }
+        _policy = self.IDP.config.getattr('policy', 'idp')
+        if isinstance(_policy, eduid_idp.policy.CachingPolicy):
+            res['release_policy'] = _policy.get_stats()
+        if self.authn.authn_log:
+            res['authn_log'] = self.authn.authn_log.get_stats()
+        if isinstance(self.authn.auth_client, eduid_idp.vccs.PooledVCCSClient):
+            res['vccs'] = self.authn.auth_client.get_stats()
+        res['breakers'] = {}
+        for this in [self.userdb.breaker, self.authn.vccs_breaker, self.authn.authn_store_breaker]:
+            res['breakers'][this.name] = this.get_stats()
+        return res
+
+    def stop(self):
+        """
+        Write anything still queued to the database, on shutdown.
+
+        :return: None
+        """
+        self.logger.info("eduid-IdP server stopping")
+        self.authn.stop()
 
     @cherrypy.expose
     def sso(self, *_args, **_kwargs):
@@ -261,12 +426,13 @@ class IdPApplication(object):
         path = cherrypy.request.path_info.lstrip('/').split('/')
         self.logger.debug("<application> PATH: %s" % path)
 
-        session = self._lookup_sso_session()
+        app = self.pinned()
+        session = app._lookup_sso_session()
 
         if path[1] == 'post':
-            return SSO(session, self._my_start_response, self).post()
+            return SSO(session, app._my_start_response, app).post()
         if path[1] == 'redirect':
-            return SSO(session, self._my_start_response, self).redirect()
+            return SSO(session, app._my_start_response, app).redirect()
 
         raise eduid_idp.error.NotFound(logger = self.logger)
 
@@ -277,15 +443,16 @@ class IdPApplication(object):
         path = cherrypy.request.path_info.lstrip('/').split('/')
         self.logger.debug("<application> PATH: %s" % path)
 
-        session = self._lookup_sso_session()
+        app = self.pinned()
+        session = app._lookup_sso_session()
 
         if path[1] == 'post':
-            return SLO(session, self._my_start_response, self).post()
+            return SLO(session, app._my_start_response, app).post()
         if path[1] == 'redirect':
-            return SLO(session, self._my_start_response, self).redirect()
+            return SLO(session, app._my_start_response, app).redirect()
         if path[1] == 'soap':
             # SOAP is commonly used for SLO
-            return SLO(session, self._my_start_response, self).soap()
+            return SLO(session, app._my_start_response, app).soap()
 
         raise eduid_idp.error.NotFound(logger = self.logger)
 
@@ -293,7 +460,8 @@ class IdPApplication(object):
     def verify(self, *_args, **_kwargs):
         self.logger.debug("\n\n")
         self.logger.debug("--- Verify ---")
-        if self._lookup_sso_session():
+        app = self.pinned()
+        if app._lookup_sso_session():
             # If an already logged in user presses 'back' or similar, we can't really expect to
             # manage to log them in again (think OTPs) and just continue 'back' to the SP.
             # However, with forceAuthn, this is exactly what happens so maybe it isn't really
@@ -301,7 +469,7 @@ class IdPApplication(object):
             #raise eduid_idp.error.LoginTimeout("Already logged in - can't verify credentials again",
             #                                   logger = self.logger)
             self.logger.debug("User is already logged in - verifying credentials again might not work")
-        return eduid_idp.login.do_verify(idp_app = self)
+        return eduid_idp.login.do_verify(idp_app = app)
 
     @cherrypy.expose
     def static(self, *_args, **_kwargs):
@@ -336,16 +504,17 @@ class IdPApplication(object):
         if 'username' not in parsed or 'password' not in parsed:
             raise eduid_idp.error.BadRequest(logger = self.logger)
 
-        if parsed['username'] not in self.config.status_test_usernames \
-                and self.config.status_test_usernames != ['*']:
+        app = self.pinned()
+        if parsed['username'] not in app.config.status_test_usernames \
+                and app.config.status_test_usernames != ['*']:
             self.logger.debug("Username {!r} in status request is not on the list "
                               "of permitted usernames : {!r}".format(parsed['username'],
-                                                                     self.config.status_test_usernames))
+                                                                     app.config.status_test_usernames))
             raise eduid_idp.error.Forbidden(logger = self.logger)
 
         response = {'status': 'FAIL'}
 
-        user = self.authn.verify_username_and_password(parsed)
+        user = app.authn.verify_username_and_password(parsed)
         if user:
             response = {'status': 'OK',
                         'testuser_name': user.display_name,
@@ -650,7 +819,11 @@ def main(myname = 'eduid-IdP', args = None, logger = None):
     cherrypy.log.access_log.propagate = False
     cherrypy.config.update(cherry_conf)
 
-    cherrypy.quickstart(IdPApplication(logger, config))
+    idp_app = IdPApplication(logger, config)
+    # Reload the configuration on SIGHUP, instead of the CherryPy default (restart or exit)
+    cherrypy.engine.signal_handler.handlers['SIGHUP'] = idp_app.reload_config
+    cherrypy.engine.subscribe('stop', idp_app.stop)
+    cherrypy.quickstart(idp_app)
 
 if __name__ == '__main__':
     try:
@@ -63,6 +63,13 @@ def check_for_pending_actions(idp_app, user, ticket):
         idp_app.logger.info("This IdP is not initialized for special actions")
         return
 
+    # The user from the SSO session might be cached, and not show actions (e.g. accepting
+    # the ToU) that were just completed in the actions app. The add_actions plugins might
+    # also use any part of the user, so load the full user document.
+    _user = idp_app.userdb.lookup_user(user.user_id, use_cache = False, projection = False)
+    if _user is not None:
+        user = _user
+
     # Add any actions that may depend on the login data
     add_idp_initiated_actions(idp_app, user, ticket)
 
@@ -35,9 +35,48 @@
 """
 User and user database module.
 """
+import re
+import copy
 import pprint
+import logging
+import weakref
+import threading
+from functools import partial
 
+import bson
+import pymongo
+
+import eduid_idp.cache
+import eduid_idp.breaker
 from eduid_userdb import UserDB, User
+from eduid_userdb.exceptions import MultipleUsersReturned
+
+# usernames looking like this are user ids (the string form of an ObjectId)
+_USER_ID_RE = re.compile('^[0-9a-f]{24}$')
+
+# The parts of user documents used by the IdP, loaded when the userdb_projection setting is enabled.
+# Both old (eduid_am) and new style names are listed for fields that have been renamed.
+# The user is also passed to the eduid_actions add_actions plugins (see idp_actions.py), so the
+# fields they use (e.g. 'tou' for the ToU plugin) must be included, although the actions check
+# loads the full user document.
+_IDP_USER_FIELDS = ['_id',
+                    'eduPersonPrincipalName',
+                    'displayName',
+                    'givenName',
+                    'sn',
+                    'surname',
+                    'mail',
+                    'mailAliases',
+                    'norEduPersonNIN',
+                    'nins',
+                    'eduPersonEntitlement',
+                    'entitlements',
+                    'preferredLanguage',
+                    'passwords',
+                    'tou',
+                    'terminated',
+                    'modified_ts',
+                    ]
 
 # default list of SAML attributes to release
 _SAML_ATTRIBUTES = ['displayName',
@@ -76,20 +115,136 @@ class IdPUser(User):
         :return: SAML attributes
         :rtype: dict
         """
-        attributes_in = self.to_dict(old_userdb_format = True)
+        if filter_attributes is _SAML_ATTRIBUTES:
+            _release = get_attribute_release(config, logger)
+        else:
+            _release = AttributeRelease(config, logger, filter_attributes = filter_attributes, memo_size = 0)
+        return _release.get_attributes(self)
+
+
+class AttributeRelease(object):
+    """
+    Compiled pipeline turning IdPUsers into SAML attributes.
+
+    The configuration dependent parts of the pipeline are set up once, when this
+    object is created. The attributes of a user are memoized per version of the
+    user document (user id and modified_ts), so that repeated logins by the same
+    user don't have to convert the user to SAML attributes again.
+
+    :param config: IdP config
+    :param logger: logging logger
+    :param filter_attributes: SAML attributes to include
+    :param memo_size: Number of users to memoize attributes for, 0 to disable
+    :param memo_ttl: Number of seconds to memoize attributes
+
+    :type config: eduid_idp.config.IdPConfig
+    :type logger: logging.Logger
+    :type filter_attributes: [str | unicode]
+    :type memo_size: int
+    :type memo_ttl: int
+    """
+
+    def __init__(self, config, logger, filter_attributes = _SAML_ATTRIBUTES, memo_size = 10000, memo_ttl = 600):
+        self.logger = logger
+        self._filter_attributes = list(filter_attributes)
+        self._steps = []
+        if config.default_eppn_scope:
+            self._steps.append(partial(_make_scoped_eppn, scope = config.default_eppn_scope))
+        if config.default_scoped_affiliation:
+            self._steps.append(partial(_add_scoped_affiliation, affiliation = config.default_scoped_affiliation))
+        self._memo = None
+        if memo_size:
+            self._memo = eduid_idp.cache.ExpiringCacheMem('AttributeRelease', logger, memo_ttl, threading.Lock(),
+                                                          max_entries = memo_size)
+
+    def get_attributes(self, user):
+        """
+        Return a list of SAML attributes for a user.
+
+        :param user: The user in question
+        :type user: IdPUser
+
+        :return: SAML attributes
+        :rtype: dict
+        """
+        _key = None
+        _modified_ts = getattr(user, 'modified_ts', None)
+        if self._memo is not None and _modified_ts is not None:
+            _key = '{!s}:{!s}'.format(user.user_id, _modified_ts)
+            attributes = self._memo.get(_key)
+            if attributes is not None:
+                return _copy_attributes(attributes)
+        attributes = self._make_attributes(user)
+        if _key is not None:
+            self._memo.add(_key, attributes)
+        return _copy_attributes(attributes)
+
+    def _make_attributes(self, user):
+        """
+        Run the pipeline, to produce SAML attributes for a user.
+
+        :type user: IdPUser
+        :rtype: dict
+        """
+        attributes_in = user.to_dict(old_userdb_format = True)
         attributes = {}
-        for approved in filter_attributes:
+        for approved in self._filter_attributes:
             if approved in attributes_in:
                 attributes[approved] = attributes_in.pop(approved)
-        logger.debug('Discarded non-attributes:\n{!s}'.format(pprint.pformat(attributes_in)))
-        attributes1 = _make_scoped_eppn(attributes, config)
-        attributes2 = _add_scoped_affiliation(attributes1, config)
-        attributes = _add_eduperson_assurance(attributes2, self)
-        return attributes
+        if self.logger.isEnabledFor(logging.DEBUG):
+            self.logger.debug('Discarded non-attributes:\n{!s}'.format(pprint.pformat(attributes_in)))
+        for step in self._steps:
+            attributes = step(attributes)
+        return _add_eduperson_assurance(attributes, user)
+
+
+# AttributeRelease instances for IdPConfig instances, so that a new one is set up on configuration reload
+_attribute_releases = weakref.WeakKeyDictionary()
+_attribute_releases_lock = threading.Lock()
+
+
+def get_attribute_release(config, logger):
+    """
+    Get the AttributeRelease (with the default list of SAML attributes) for a configuration.
+
+    :param config: IdP config
+    :param logger: logging logger
+
+    :type config: eduid_idp.config.IdPConfig
+    :type logger: logging.Logger
+    :rtype: AttributeRelease
+    """
+    with _attribute_releases_lock:
+        res = _attribute_releases.get(config)
+        if res is None:
+            res = AttributeRelease(config, logger)
+            _attribute_releases[config] = res
+        return res
+
+
+def _copy_attributes(attributes):
+    """
+    Copy SAML attributes, so that the memoized ones are not modified by the caller.
+
+    :type attributes: dict
+    :rtype: dict
+    """
+    return dict([(k, list(v) if isinstance(v, list) else v) for (k, v) in attributes.items()])
 
 
 class IdPUserDb(object):
     """
+    Load users from the userdb.
+
+    Users can be cached in-process (see the user_cache_* settings), keyed by the
+    username used in the lookup, as well as by the user id and eppn of the user found.
+    Usernames not found can be cached too (negative caching). The cached IdPUser
+    instances are shared, and must not be modified.
+
+    Users are modified by other applications (e.g. password resets, accepting the ToU
+    in the actions app), so a cached user can be up to `user_cache_ttl' seconds old.
+    Where that matters (verifying credentials, checking for pending actions) the user
+    is looked up with use_cache = False, which also refreshes the cache.
 
     :param logger: logging logger
     :param config: IdP config
@@ -106,28 +261,229 @@ class IdPUserDb(object):
         if userdb is None:
             userdb = UserDB(config.mongo_uri, db_name=config.userdb_mongo_database, user_class=IdPUser)
         self.userdb = userdb
+        self.breaker = eduid_idp.breaker.CircuitBreaker('userdb', logger, (pymongo.errors.ConnectionFailure,),
+                                                        failure_threshold = config.breaker_failure_threshold,
+                                                        latency_threshold = config.breaker_latency_threshold,
+                                                        reset_timeout = config.breaker_reset_timeout)
+        self.clear_cache()
+
+    def with_config(self, config):
+        """
+        Get a copy of this IdPUserDb using another configuration (see IdPApplication.reload_config()).
+
+        The copy has an empty user cache, but shares the userdb and circuit breaker with this instance.
+
+        :param config: IdP configuration data
+        :type config: eduid_idp.config.IdPConfig
+        :rtype: IdPUserDb
+        """
+        res = copy.copy(self)
+        res.config = config
+        res.clear_cache()
+        return res
 
-    def lookup_user(self, username):
+    def clear_cache(self):
+        """
+        Forget all cached users and unknown usernames.
         """
-        Load IdPUser from userdb.
+        self._cache = None
+        self._negative_cache = None
+        _max_entries = self.config.user_cache_max_entries
+        if self.config.user_cache_ttl:
+            self._cache = eduid_idp.cache.ExpiringCacheMem('IdPUserDb.users', self.logger,
+                                                           self.config.user_cache_ttl, threading.Lock(),
+                                                           max_entries = _max_entries)
+        if self.config.user_cache_negative_ttl:
+            self._negative_cache = eduid_idp.cache.ExpiringCacheMem('IdPUserDb.unknown', self.logger,
+                                                                    self.config.user_cache_negative_ttl,
+                                                                    threading.Lock(),
+                                                                    max_entries = _max_entries)
+
+    def invalidate(self, username):
+        """
+        Forget the cached result of looking up a username (or user id).
+
+        Use this when a user has been created, to not have to wait for a negative
+        cache entry to expire.
+
+        :param username: string or ObjectId
+        """
+        _key = _cache_key(username)
+        if self._cache is not None:
+            self._cache.delete(_key)
+        if self._negative_cache is not None:
+            self._negative_cache.delete(_key)
+
+    def invalidate_user(self, user):
+        """
+        Forget all cached entrys for a user, e.g. when the user has been modified.
+
+        :param user: User
+        :type user: IdPUser
+        """
+        if self._cache is None:
+            return
+        for _key in [user.user_id, user.eppn] + [x.email for x in user.mail_addresses.to_list()]:
+            self._cache.delete(_cache_key(_key))
+
+    def lookup_user(self, username, use_cache = True, projection = True):
+        """
+        Load IdPUser from userdb (or the cache).
 
         :param username: string
+        :param use_cache: False to always load the user from the userdb
+        :param projection: False to load the full user document even with userdb_projection
         :return: user found in database
         :rtype: IdPUser | None
         """
-        _user = None
-        if isinstance(username, str) or isinstance(username, unicode):
-            if '@' in username:
-                _user = self.userdb.get_user_by_mail(username.lower(), raise_on_missing=False)
-            if not _user:
-                _user = self.userdb.get_user_by_eppn(username.lower(), raise_on_missing=False)
-        if not _user:
-            # username will be ObjectId if this is a lookup using an existing SSO session
-            _user = self.userdb.get_user_by_id(username, raise_on_missing=False)
+        _key = _cache_key(username)
+        if use_cache:
+            if self._cache is not None:
+                _user = self._cache.get(_key)
+                if _user is not None:
+                    return _user
+            if self._negative_cache is not None and self._negative_cache.get(_key):
+                self.logger.debug('Username {!r} is cached as not found in the userdb'.format(username))
+                return None
+        _user = self._lookup_user(username, projection = projection)
+        if not _user and self._cache is not None:
+            self._cache.delete(_key)
+        if _user:
+            if self._cache is not None:
+                self._cache.add(_key, _user)
+                self._cache.add(_cache_key(_user.user_id), _user)
+                if _user.eppn:
+                    self._cache.add(_cache_key(_user.eppn), _user)
+        elif self._negative_cache is not None:
+            self._negative_cache.add(_key, True)
         return _user
 
+    def _lookup_user(self, username, projection = True):
+        """
+        Load IdPUser from userdb, using a single query.
+
+        The kind of username is determined before querying the database:
+
+          - user ids (ObjectId, which is used for lookups from SSO sessions) are looked up by id
+          - usernames with an '@' might be either e-mail addresses or scoped eppns, so a single
+            query for both is made. Like get_user_by_mail() followed by get_user_by_eppn(),
+            a user with a matching e-mail address has precedence, and more than one user with
+            a matching e-mail address is an error.
+          - other usernames are looked up as eppn
+
+        :param username: string or ObjectId
+        :param projection: False to load the full user document even with userdb_projection
+        :return: user found in database
+        :rtype: IdPUser | None
+
+        :raises MultipleUsersReturned: when more than one user has the e-mail address
+        """
+        _username = None
+        if not isinstance(username, basestring):
+            spec = {'_id': username}
+        elif _USER_ID_RE.match(username.lower()):
+            spec = {'_id': bson.ObjectId(username.lower())}
+        elif '@' not in username:
+            spec = {'eduPersonPrincipalName': username.lower()}
+        else:
+            _username = username.lower()
+            spec = {'$or': [{'mail': _username},
+                            {'mailAliases': {'$elemMatch': {'email': _username,
+                                                            'verified': True,
+                                                            }}},
+                            {'eduPersonPrincipalName': _username},
+                            ]}
+        _users = self._find_users(spec, projection = projection)
+        if _username is not None:
+            _mail_users = [x for x in _users if _has_mail_address(x, _username)]
+            if len(_mail_users) > 1:
+                raise MultipleUsersReturned('More than one user with e-mail address {!r}'.format(_username))
+            if _mail_users:
+                return _mail_users[0]
+        if not _users:
+            return None
+        return _users[0]
+
+    def _find_users(self, spec, projection = True):
+        """
+        Find users in the userdb.
+
+        With the userdb_projection setting, only the parts of the user documents that
+        the IdP uses are loaded, which makes the IdPUser instances smaller and faster
+        to load. Such an IdPUser must never be written back to the database.
+
+        :param spec: MongoDB query
+        :param projection: False to load the full user documents even with userdb_projection
+        :type spec: dict
+        :type projection: bool
+        :rtype: [IdPUser]
+
+        :raises eduid_idp.error.ServiceError: when the userdb is failing (see self.breaker)
+        """
+        _fields = None
+        if projection and self.config.userdb_projection:
+            _fields = _IDP_USER_FIELDS
+        with self.breaker.call():
+            return _query_userdb(self.userdb, spec, _fields)
+
+
+def _query_userdb(userdb, spec, fields = None):
+    """
+    Query the userdb.
+
+    eduid_userdb has no public API for arbitrary queries (like the $or used to look users
+    up by e-mail address or eppn in a single query), or for loading only some fields of
+    the user documents. This function is the only place where the two eduid_userdb.UserDB
+    internals used for that are accessed: _get_user_by_filter() and the collection _coll.
+    TestUserDBInternals (tests/test_idPUserDb.py) checks that they still exist in the
+    installed eduid_userdb.
+
+    :param userdb: User database
+    :param spec: MongoDB query
+    :param fields: Fields to load (a projection), or None to load complete user documents
+
+    :type userdb: eduid_userdb.UserDB
+    :type spec: dict
+    :type fields: [str] | None
+    :rtype: [IdPUser]
+    """
+    if fields is None:
+        return userdb._get_user_by_filter(spec, raise_on_missing=False, return_list=True)
+    return [IdPUser(data=this) for this in userdb._coll.find(spec, fields)]
+
+
+def _has_mail_address(user, address):
+    """
+    Check if a user was found by e-mail address (rather than eppn) in IdPUserDb._lookup_user().
+
+    :param user: User found
+    :param address: E-mail address (lower case)
+
+    :type user: IdPUser
+    :type address: str | unicode
+    :rtype: bool
+    """
+    if user.eppn != address:
+        return True
+    for this in user.mail_addresses.to_list():
+        if this.email == address and this.is_verified:
+            return True
+    return False
+
+
+def _cache_key(username):
+    """
+    Make a key for the user cache out of a username (or user id).
+
+    :param username: string or ObjectId
+    :rtype: string
+    """
+    if isinstance(username, basestring):
+        return 'u:' + username.lower()
+    return 'id:' + str(username)
+
 
-def _make_scoped_eppn(attributes, config):
+def _make_scoped_eppn(attributes, scope):
     """
     Add scope to unscoped eduPersonPrincipalName attributes before relasing them.
 
@@ -135,15 +491,14 @@ def _make_scoped_eppn(attributes, config):
     `default_eppn_scope'.
 
     :param attributes: Attributes of a user
-    :param config: IdP configuration data
+    :param scope: Scope to add
     :return: New attributes
 
     :type attributes: dict
-    :type config: IdPConfig
+    :type scope: str | unicode
     :rtype: dict
     """
     eppn = attributes.get('eduPersonPrincipalName')
-    scope = config.default_eppn_scope
     if not eppn or not scope:
         return attributes
     if '@' not in eppn:
@@ -151,7 +506,7 @@ def _make_scoped_eppn(attributes, config):
     return attributes
 
 
-def _add_scoped_affiliation(attributes, config):
+def _add_scoped_affiliation(attributes, affiliation):
     """
     Add eduPersonScopedAffiliation if configured, and not already present.
 
@@ -159,17 +514,17 @@ def _add_scoped_affiliation(attributes, config):
     `default_scoped_affiliation'.
 
     :param attributes: Attributes of a user
-    :param config: IdP configuration data
+    :param affiliation: Default affiliation
 
     :type attributes: dict
-    :type config: IdPConfig
+    :type affiliation: str | unicode
 
     :return: New attributes
     :rtype: dict
     """
     epsa = 'eduPersonScopedAffiliation'
-    if epsa not in attributes and config.default_scoped_affiliation:
-        attributes[epsa] = config.default_scoped_affiliation
+    if epsa not in attributes and affiliation:
+        attributes[epsa] = affiliation
     return attributes
 
 
@@ -188,7 +543,8 @@ def _add_eduperson_assurance(attributes, user):
     :rtype: dict
     """
     attributes['eduPersonAssurance'] = 'http://www.swamid.se/policy/assurance/al1'
-    _verified_nins = [x for x in user.nins.to_list() if x.is_verified]
-    if _verified_nins:
-        attributes['eduPersonAssurance'] = 'http://www.swamid.se/policy/assurance/al2'
+    for this in user.nins.to_list():
+        if this.is_verified:
+            attributes['eduPersonAssurance'] = 'http://www.swamid.se/policy/assurance/al2'
+            break
     return attributes
@@ -608,8 +608,7 @@ def do_verify(idp_app):
     user = idp_app.authn.get_authn_user(login_data, user_authn)
 
     if not user:
-        _ticket.FailCount += 1
-        idp_app.IDP.ticket.store_ticket(_ticket)
+        idp_app.IDP.ticket.increment_fail_count(_ticket)
         idp_app.logger.debug("Unknown user or wrong password")
         _referer = eduid_idp.mischttp.get_request_header().get('Referer')
         if _referer:
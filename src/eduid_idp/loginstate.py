@@ -8,14 +8,26 @@
 #          Roland Hedberg
 #
 
+import copy
+import zlib
+import base64
 import pprint
+import threading
 from cgi import escape
 
 import eduid_idp
+from eduid_idp.stats import Stats
 from saml2.request import AuthnRequest
 from saml2.sigver import verify_redirect_signature
 from saml2.s_utils import UnravelError
 
+# Version of the format produced by SSOLoginData.to_compact(). Stored login state
+# without a version is in the format produced by SSOLoginData.to_dict().
+COMPACT_VERSION = 1
+
+# SAMLRequests at least this large (in base64 encoded form) are compressed in to_compact()
+COMPRESS_MIN_SIZE = 1024
+
 
 class SSOLoginData(object):
     """
@@ -31,6 +43,10 @@ class SSOLoginData(object):
     :type data: dict
     :type binding: string
     """
+    # Use __slots__ rather than a per-instance __dict__, since there is one of these
+    # for every login in progress
+    __slots__ = ('_key', '_req_info', '_SAMLRequest', '_RelayState', '_FailCount', '_binding')
+
     def __init__(self, key, req_info, data, binding):
         self._key = key
         self._req_info = req_info
@@ -56,6 +72,36 @@ class SSOLoginData(object):
                }
         return res
 
+    def to_compact(self):
+        """
+        Return the object in a compact dict format, for storing in backends that can't
+        store SSOLoginData instances (Redis). The parsed request (req_info) is not included.
+
+        Short key names are used, and large SAMLRequests are compressed (unless they
+        are already compressed, which is the case with the HTTP-Redirect binding).
+        Use from_compact() to get the data back in the format of to_dict().
+
+        :rtype: dict
+        """
+        res = {'v': COMPACT_VERSION,
+               'k': self._key,
+               'r': self._RelayState,
+               'b': self._binding,
+               'f': self._FailCount,
+               }
+        _req = self._SAMLRequest
+        if len(_req) >= COMPRESS_MIN_SIZE:
+            try:
+                _compressed = base64.b64encode(zlib.compress(base64.b64decode(_req)))
+                if len(_compressed) < len(_req):
+                    res['z'] = _compressed
+                    return res
+            except TypeError:
+                # not base64 - can't be a valid SAMLRequest, but store it as it is
+                pass
+        res['s'] = _req
+        return res
+
     @property
     def key(self):
         """
@@ -124,6 +170,34 @@ class SSOLoginData(object):
         return escape(self._binding, quote=True)
 
 
+def from_compact(data):
+    """
+    Decode stored login state produced by SSOLoginData.to_compact() into the format
+    produced by SSOLoginData.to_dict() (without req_info). Login state stored in the
+    to_dict() format (by older versions of the IdP) is returned unchanged.
+
+    :param data: Stored login state
+    :type data: dict
+    :rtype: dict
+    """
+    if 'v' not in data:
+        return data
+    if 'z' in data:
+        _req = base64.b64encode(zlib.decompress(base64.b64decode(data['z'])))
+    else:
+        _req = data['s']
+    return {'key': data['k'],
+            'SAMLRequest': _req,
+            'RelayState': data['r'],
+            'binding': data['b'],
+            'FailCount': data['f'],
+            }
+
+
+# Default bound of the process-local login state cache in front of Redis
+_LOCAL_CACHE_MAX_ENTRIES = 10000
+
+
 class SSOLoginDataCache(object):
     """
     Login data is state kept between rendering the login screen, to when the user is
@@ -143,6 +217,18 @@ class SSOLoginDataCache(object):
     :type ttl: int
     :type config: IdPConfig
     :type lock: threading.Lock
+
+    When the login state is stored in Redis, the SSOLoginData instances are also kept
+    in a process-local cache in front of Redis (ExpiringCacheTiered). The parsed
+    SAMLRequest (req_info) can't be stored in Redis, but is kept in the local instances,
+    so a login handled by the same IdP process from start to end never has to read
+    the login state from Redis, or parse the SAMLRequest more than once. A login that
+    moves to another IdP process will still work, but the login state is read from
+    Redis and the SAMLRequest parsed again in the other process(es).
+
+    The process-local cache is bounded by login_state_max_entries and login_state_max_bytes.
+    If neither is set, it is bounded to _LOCAL_CACHE_MAX_ENTRIES login states, since the
+    login states evicted from it can still be read back from Redis.
     """
 
     def __init__(self, idp_app, name, logger, ttl, config, lock = None):
@@ -150,12 +236,57 @@ class SSOLoginDataCache(object):
         self.IDP = idp_app
         self.logger = logger
         self.config = config
+        self.stats = Stats()
+        self._counters = None
         if (config.redis_sentinel_hosts or config.redis_host) and config.session_app_key:
-            self._cache = eduid_idp.cache.ExpiringCacheCommonSession(name, logger, ttl, config)
+            _max_entries = config.login_state_max_entries
+            if not _max_entries and not config.login_state_max_bytes:
+                _max_entries = _LOCAL_CACHE_MAX_ENTRIES
+            _local = eduid_idp.cache.ExpiringCacheMem(name + '.local', logger, ttl, threading.Lock(),
+                                                      max_entries = _max_entries,
+                                                      max_bytes = config.login_state_max_bytes)
+            _remote = eduid_idp.cache.ExpiringCacheCommonSession(name, logger, ttl, config)
+            self._cache = eduid_idp.cache.ExpiringCacheTiered(name, logger, ttl, _local, _remote,
+                                                              promote = self._promote_ticket)
+            # FailCount is kept in a Redis counter, to not have to re-write the whole ticket on updates
+            self._counters = self._cache
+        elif config.memory_cache_shards > 1:
+            self._cache = eduid_idp.cache.ExpiringCacheShardedMem(name, logger, ttl, config.memory_cache_shards,
+                                                                  max_entries = config.login_state_max_entries,
+                                                                  max_bytes = config.login_state_max_bytes)
         else:
-            self._cache = eduid_idp.cache.ExpiringCacheMem(name, logger, ttl, lock)
+            self._cache = eduid_idp.cache.ExpiringCacheMem(name, logger, ttl, lock,
+                                                           max_entries = config.login_state_max_entries,
+                                                           max_bytes = config.login_state_max_bytes)
         logger.debug('Set up IDP ticket cache {!s}'.format(self._cache))
 
+    def with_config(self, idp_app, config):
+        """
+        Get a copy of this cache using another pysaml2 server and configuration
+        (see IdPApplication.reload_config()). The login states are shared with this instance.
+
+        :param idp_app: saml2.server.Server() instance
+        :param config: IdP configuration data
+
+        :type idp_app: saml2.server.Server
+        :type config: IdPConfig
+        :rtype: SSOLoginDataCache
+        """
+        res = copy.copy(self)
+        res.IDP = idp_app
+        res.config = config
+        return res
+
+    def get_stats(self):
+        """
+        Get counters for SAMLRequest parsing, and the statistics of the backend cache.
+
+        :rtype: dict
+        """
+        res = self.stats.to_dict()
+        res['backend'] = self._cache.get_stats()
+        return res
+
     def store_ticket(self, ticket):
         """
         Add an entry to the IDP.ticket cache.
@@ -167,6 +298,26 @@ class SSOLoginDataCache(object):
         self._cache.add(ticket.key, ticket)
         return True
 
+    def increment_fail_count(self, ticket):
+        """
+        Increment the FailCount of a ticket in the IDP.ticket cache.
+
+        If the backend supports counters (Redis), this is an atomic increment of a
+        counter instead of a re-write of the whole ticket.
+
+        :param ticket: SSOLoginData instance
+        :returns: New FailCount
+
+        :type ticket: SSOLoginData
+        :rtype: int
+        """
+        if self._counters is None:
+            ticket.FailCount += 1
+            self.store_ticket(ticket)
+        else:
+            ticket.FailCount = self._counters.incr(ticket.key, 'FailCount')
+        return ticket.FailCount
+
     def create_ticket(self, data, binding, key=None):
         """
         Create an SSOLoginData instance from a dict.
@@ -248,11 +399,48 @@ class SSOLoginDataCache(object):
 
         if isinstance(_ticket, dict):
             # Ticket was stored in a backend that could not natively store a SSOLoginData instance. Recreate.
-            _ticket = self.create_ticket(_ticket, _ticket['binding'], key=_key)
+            _ticket = self._recreate_ticket(_ticket, _key)
             self.logger.debug('Re-created SSOLoginData from stored ticket state:\n{!s}'.format(_ticket))
 
         return _ticket
 
+    def _recreate_ticket(self, data, key):
+        """
+        Re-create an SSOLoginData instance from data stored in a backend that could not
+        store the SSOLoginData instance itself.
+
+        :param data: Stored ticket state
+        :param key: Ticket key
+        :returns: SSOLoginData instance
+
+        :type data: dict
+        :type key: string
+        :rtype: SSOLoginData
+        """
+        data = from_compact(data)
+        if self._counters is not None:
+            _fail_count = self._counters.get_counter(key, 'FailCount')
+            if _fail_count is not None:
+                data = dict(data)
+                data['FailCount'] = _fail_count
+        return self.create_ticket(data, data['binding'], key=key)
+
+    def _promote_ticket(self, key, data):
+        """
+        Callback from ExpiringCacheTiered when login state was found in Redis, but not in
+        the process-local cache. Re-create the SSOLoginData instance before it is added
+        to the local cache.
+
+        :param key: Ticket key
+        :param data: Stored ticket state
+
+        :type key: string
+        :type data: dict
+        :rtype: SSOLoginData
+        """
+        self.stats.incr('remote_tickets')
+        return self._recreate_ticket(data, key)
+
     def _parse_SAMLRequest(self, info, binding):
         """
         Parse a SAMLRequest query parameter (base64 encoded) into an AuthnRequest
@@ -272,7 +460,8 @@ class SSOLoginDataCache(object):
         """
         # self.logger.debug("Parsing SAML request : {!r}".format(info["SAMLRequest"]))
         try:
-            _req_info = self.IDP.parse_authn_request(info['SAMLRequest'], binding)
+            with self.stats.timed('parse'):
+                _req_info = self.IDP.parse_authn_request(info['SAMLRequest'], binding)
         except UnravelError as exc:
             self.logger.info('Failed parsing SAML request ({!s} bytes)'.format(len(info['SAMLRequest'])))
             self.logger.debug('Failed parsing SAML request:\n{!s}\nException {!s}'.format(info['SAMLRequest'], exc))
@@ -0,0 +1,146 @@
+#
+# Copyright (c) 2016 NORDUnet A/S
+# All rights reserved.
+#
+#   Redistribution and use in source and binary forms, with or
+#   without modification, are permitted provided that the following
+#   conditions are met:
+#
+#     1. Redistributions of source code must retain the above copyright
+#        notice, this list of conditions and the following disclaimer.
+#     2. Redistributions in binary form must reproduce the above
+#        copyright notice, this list of conditions and the following
+#        disclaimer in the documentation and/or other materials provided
+#        with the distribution.
+#     3. Neither the name of the NORDUnet nor the names of its
+#        contributors may be used to endorse or promote products derived
+#        from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS
+# FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE
+# COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT,
+# INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING,
+# BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT
+# LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN
+# ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+#
+# Author : Fredrik Thulin <fredrik@thulin.net>
+#
+"""
+Caching of the per-SP parts of the pysaml2 attribute release policy.
+"""
+
+import threading
+
+from saml2.assertion import Policy
+
+import eduid_idp.cache
+
+
+class CachingPolicy(Policy):
+    """
+    pysaml2 attribute release Policy, remembering what may be released to each SP.
+
+    pysaml2 works out which attributes an SP may receive (the attributes it requests
+    in the metadata, and the attributes its entity categories allow it to receive)
+    for every assertion. This Policy remembers that, and the name format to use, per
+    SP entity id. The results depend on the metadata, so a new CachingPolicy must be
+    used (or clear() called) when the metadata is reloaded.
+
+    :param policy: The Policy from the pysaml2 configuration
+    :param logger: logging logger
+    :param ttl: Number of seconds to remember the policy of an SP
+    :param max_entries: Maximum number of entrys to remember
+
+    :type policy: Policy
+    :type logger: logging.Logger
+    :type ttl: int
+    :type max_entries: int
+    """
+
+    def __init__(self, policy, logger, ttl, max_entries = 10000):
+        Policy.__init__(self)
+        # the restrictions of the configured Policy are already compiled
+        self._restrictions = policy._restrictions
+        self.acs = policy.acs
+        self.logger = logger
+        self._ttl = ttl
+        self._max_entries = max_entries
+        self._cache = None
+        self.clear()
+
+    def clear(self):
+        """
+        Forget the policy of all SPs, e.g. when the metadata has changed.
+
+        :return: None
+        """
+        self._cache = eduid_idp.cache.ExpiringCacheMem('ReleasePolicyCache', self.logger, self._ttl,
+                                                       threading.Lock(), max_entries = self._max_entries)
+
+    def get_stats(self):
+        """
+        :rtype: dict
+        """
+        return self._cache.get_stats()
+
+    def _cached(self, key, func, *args):
+        """
+        Return the cached result for key, or call func(*args) and cache the result.
+
+        :param key: Cache key
+        :param func: Function to call on cache miss
+        """
+        res = self._cache.get(key)
+        if res is None:
+            # store a tuple, to be able to cache None
+            res = (func(*args),)
+            self._cache.add(key, res)
+        return res[0]
+
+    def get_name_form(self, sp_entity_id):
+        return self._cached(('name_form', sp_entity_id), Policy.get_name_form, self, sp_entity_id)
+
+    def get_attribute_restrictions(self, sp_entity_id):
+        return self._cached(('attribute_restrictions', sp_entity_id),
+                            Policy.get_attribute_restrictions, self, sp_entity_id)
+
+    def get_entity_categories(self, sp_entity_id, mds, required):
+        """
+        The attributes the entity categories of the SP allows it to receive.
+
+        :param sp_entity_id: The SP entity ID
+        :param mds: pysaml2 MetadataStore
+        :param required: Attributes the SP requires (according to metadata)
+        :return: A dictionary with restrictions
+        """
+        try:
+            # what Policy.get_entity_categories() uses from 'required'
+            _required = tuple(sorted([x['friendly_name'].lower() for x in required]))
+        except (KeyError, TypeError):
+            _required = ()
+        _key = ('entity_categories', sp_entity_id, mds is None, _required)
+        return self._cached(_key, Policy.get_entity_categories, self, sp_entity_id, mds, required)
+
+    def restrict(self, ava, sp_entity_id, metadata = None):
+        """
+        Filter the attributes in ava according to the policy and the SP's requirements.
+
+        :param ava: The attributes of the user
+        :param sp_entity_id: The SP entity ID
+        :param metadata: pysaml2 MetadataStore
+        :return: The filtered attributes
+        :rtype: dict
+        """
+        spec = None
+        if metadata:
+            spec = self._cached(('attribute_requirement', sp_entity_id), metadata.attribute_requirement,
+                                sp_entity_id)
+        if spec:
+            return self.filter(ava, sp_entity_id, metadata, spec['required'], spec['optional'])
+        return self.filter(ava, sp_entity_id, metadata, [], [])
@@ -0,0 +1,78 @@
+#!/usr/bin/env python
+#
+# Measure the memory used by SSO sessions and login states, as the growth of the
+# resident set size of this process when creating a number of them.
+#
+#   python -m eduid_idp.scripts.memory_benchmark {sessions|tickets|cache} [count]
+#
+# Run each kind of measurement in a separate process, since memory freed by Python
+# is not necessarily returned to the operating system.
+#
+import os
+import gc
+import sys
+import logging
+
+import bson
+
+import eduid_idp.cache
+from eduid_idp.sso_session import SSOSession
+from eduid_idp.loginstate import SSOLoginData
+
+
+def _rss():
+    """
+    Resident set size of this process, in bytes (Linux only).
+    """
+    with open('/proc/self/statm') as fd:
+        return int(fd.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+
+
+def _make_sessions(count):
+    user_id = bson.ObjectId()
+    return [SSOSession(user_id, 'eduid.se:level:1:100', 'eduid.se:level:1', 'id-{!s}'.format(i),
+                       ts = 1234567890 + i) for i in xrange(count)]
+
+
+def _make_tickets(count):
+    return [SSOLoginData('{:040x}'.format(i), None, {'SAMLRequest': 'x' * 8, 'RelayState': ''}, 'binding')
+            for i in xrange(count)]
+
+
+def _make_cache(count):
+    cache = eduid_idp.cache.SSOSessionCacheMem(logging.getLogger(), 3600)
+    for i in xrange(count):
+        session = SSOSession(bson.ObjectId(), 'eduid.se:level:1:100', 'eduid.se:level:1', 'id-{!s}'.format(i))
+        cache.add_session(session.user_id, session.to_dict())
+    return cache
+
+
+_MEASUREMENTS = {'sessions': ('SSOSession objects', _make_sessions),
+                 'tickets': ('SSOLoginData objects', _make_tickets),
+                 'cache': ('SSOSessionCacheMem sessions', _make_cache),
+                 }
+
+
+def main(myname = 'memory_benchmark', what = 'sessions', count = 1000000):
+    if what not in _MEASUREMENTS:
+        sys.stderr.write('Usage: {!s} {{{!s}}} [count]\n'.format(myname, '|'.join(sorted(_MEASUREMENTS))))
+        return False
+    name, func = _MEASUREMENTS[what]
+    gc.collect()
+    before = _rss()
+    _keep = func(count)
+    gc.collect()
+    used = _rss() - before
+    print('{!s} {!s}: {:.1f} MB ({:.0f} bytes/entry)'.format(count, name, used / 1e6, float(used) / count))
+    return True
+
+
+if __name__ == '__main__':
+    try:
+        progname = os.path.basename(sys.argv[0])
+        args = sys.argv[1:2] + [int(x) for x in sys.argv[2:3]]
+        if main(progname, *args):
+            sys.exit(0)
+        sys.exit(1)
+    except KeyboardInterrupt:
+        sys.exit(0)
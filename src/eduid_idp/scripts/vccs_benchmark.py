@@ -0,0 +1,70 @@
+#!/usr/bin/env python
+#
+# Benchmark the VCCS client, with and without kept-alive pooled connections,
+# against a stand-in VCCS server on localhost.
+#
+#   python -m eduid_idp.scripts.vccs_benchmark [requests] [threads] [server delay]
+#
+import os
+import sys
+import time
+import logging
+import threading
+
+import vccs_client
+
+import eduid_idp.vccs
+from eduid_idp.testing import FakeVCCSServer
+
+
+def _run(client, factor, requests, threads):
+    """
+    Make `requests' authentication requests, spread over `threads' threads.
+
+    :return: Seconds it took
+    """
+    def _worker(count):
+        for _ in range(count):
+            client.authenticate('0' * 24, [factor])
+
+    workers = [threading.Thread(target = _worker, args = (requests / threads,)) for _ in range(threads)]
+    start = time.time()
+    for this in workers:
+        this.start()
+    for this in workers:
+        this.join()
+    return time.time() - start
+
+
+def main(myname = 'vccs_benchmark', requests = 2000, threads = 8, delay = 0.0):
+    logger = logging.getLogger(myname)
+    factor = vccs_client.VCCSPasswordFactor('password', '0' * 24)
+    requests = (requests / threads) * threads
+
+    for name in ['plain', 'pooled']:
+        server = FakeVCCSServer(delay = delay)
+        client = vccs_client.VCCSClient(base_url = server.url)
+        if name == 'pooled':
+            client = eduid_idp.vccs.PooledVCCSClient(server.url, logger, pool_size = threads)
+        try:
+            elapsed = _run(client, factor, requests, threads)
+        finally:
+            if name == 'pooled':
+                client.pool.close()
+            server.stop()
+        print('{!s}: {!s} requests in {:.2f} seconds ({:.0f} requests/second), {!s} connections'.format(
+            name, server.requests, elapsed, server.requests / elapsed, server.connections))
+        if name == 'pooled':
+            print('  {!r}'.format(client.get_stats()['pool']))
+    return True
+
+
+if __name__ == '__main__':
+    try:
+        progname = os.path.basename(sys.argv[0])
+        args = [int(x) for x in sys.argv[1:3]] + [float(x) for x in sys.argv[3:4]]
+        if main(progname, *args):
+            sys.exit(0)
+        sys.exit(1)
+    except KeyboardInterrupt:
+        sys.exit(0)
@@ -37,6 +37,19 @@ import eduid_idp.idp_user
 import eduid_idp.assurance
 
 
+# Version of the format produced by SSOSession.to_dict(). Documents without a version
+# are in the original format, with long key names.
+SERIALIZATION_VERSION = 1
+
+# Short key names used in the serialized format
+_COMPACT_KEYS = {'user_id': 'u',
+                 'authn_ref': 'r',
+                 'authn_class_ref': 'c',
+                 'authn_request_id': 'i',
+                 'authn_timestamp': 't',
+                 }
+
+
 class SSOSession(object):
     """
     Single Sign On sessions are used to remember a previous authenticaction
@@ -61,15 +74,19 @@ class SSOSession(object):
     :type ts: int
     """
 
+    # One of these is created for every request from a logged in user, so use __slots__
+    # rather than a per-instance __dict__ (and no nested dict for the serialized data).
+    __slots__ = ('_user_id', '_authn_ref', '_authn_class_ref', '_authn_request_id', '_authn_timestamp',
+                 '_idp_user')
+
     def __init__(self, user_id, authn_ref, authn_class_ref, authn_request_id, ts=None):
         if ts is None:
             ts = int(time.time())
-        self._data = {'user_id': user_id,
-                      'authn_ref': authn_ref,
-                      'authn_class_ref': authn_class_ref,
-                      'authn_request_id': authn_request_id,
-                      'authn_timestamp': ts,
-                      }
+        self._user_id = user_id
+        self._authn_ref = authn_ref
+        self._authn_class_ref = authn_class_ref
+        self._authn_request_id = authn_request_id
+        self._authn_timestamp = ts
         # Extra information not serialized
         self._idp_user = None
 
@@ -77,18 +94,27 @@ class SSOSession(object):
         return '<{cl} instance at {addr}: uid={uid!s}, class={clref!s}, ts={ts!s}>'.format(
             cl = self.__class__.__name__,
             addr = hex(id(self)),
-            uid = str(self._data['user_id']),
-            clref = self._data['authn_class_ref'],
-            ts = self._data['authn_timestamp'],
+            uid = str(self._user_id),
+            clref = self._authn_class_ref,
+            ts = self._authn_timestamp,
         )
 
     def to_dict(self):
         """
-        Return the object in dict format (serialized for storing in MongoDB).
+        Return the object in dict format (serialized for storing in MongoDB or Redis).
+
+        Short key names are used, since this is stored once for every SSO session.
+
         :return: serialized object
         :rtype: dict
         """
-        return self._data
+        return {'v': SERIALIZATION_VERSION,
+                _COMPACT_KEYS['user_id']: self._user_id,
+                _COMPACT_KEYS['authn_ref']: self._authn_ref,
+                _COMPACT_KEYS['authn_class_ref']: self._authn_class_ref,
+                _COMPACT_KEYS['authn_request_id']: self._authn_request_id,
+                _COMPACT_KEYS['authn_timestamp']: self._authn_timestamp,
+                }
 
     @property
     def authn_timestamp(self):
@@ -98,7 +124,7 @@ class SSOSession(object):
         :return: Authn timestamp
         :rtype: int
         """
-        return self._data['authn_timestamp']
+        return self._authn_timestamp
 
     @property
     def user_id(self):
@@ -107,7 +133,7 @@ class SSOSession(object):
 
         :rtype: bson.ObjectId
         """
-        return self._data['user_id']
+        return self._user_id
 
     @property
     def public_id(self):
@@ -115,7 +141,7 @@ class SSOSession(object):
         Return a identifier for this session that can't be used to hijack sessions
         if leaked through a log file etc.
         """
-        return "{!s}.{!s}".format(str(self._data['user_id']), self._data['authn_timestamp'])
+        return "{!s}.{!s}".format(str(self._user_id), self._authn_timestamp)
 
     @property
     def user_authn_class_ref(self):
@@ -125,7 +151,7 @@ class SSOSession(object):
 
         E.g. u'eduid.se:level:1'
         """
-        return self._data['authn_class_ref']
+        return self._authn_class_ref
 
     @property
     def user_authn_ref(self):
@@ -135,7 +161,7 @@ class SSOSession(object):
 
         E.g. u'eduid.se:level:1:100'
         """
-        return self._data['authn_ref']
+        return self._authn_ref
 
     @property
     def user_authn_request_id(self):
@@ -144,7 +170,7 @@ class SSOSession(object):
 
         E.g. u'id-809ecef1cd265efedef7a68708e54b84'
         """
-        return self._data['authn_request_id']
+        return self._authn_request_id
 
     @property
     def idp_user(self):
@@ -202,6 +228,8 @@ def from_dict(data):
     :type data: dict
     :rtype: SSOSession
     """
+    if 'v' in data:
+        data = dict([(key, data[short]) for (key, short) in _COMPACT_KEYS.items()])
     return SSOSession(user_id = data['user_id'],
                       authn_ref = data['authn_ref'],
                       authn_class_ref = data['authn_class_ref'],
@@ -0,0 +1,170 @@
+#
+# Copyright (c) 2016 NORDUnet A/S
+# All rights reserved.
+#
+#   Redistribution and use in source and binary forms, with or
+#   without modification, are permitted provided that the following
+#   conditions are met:
+#
+#     1. Redistributions of source code must retain the above copyright
+#        notice, this list of conditions and the following disclaimer.
+#     2. Redistributions in binary form must reproduce the above
+#        copyright notice, this list of conditions and the following
+#        disclaimer in the documentation and/or other materials provided
+#        with the distribution.
+#     3. Neither the name of the NORDUnet nor the names of its
+#        contributors may be used to endorse or promote products derived
+#        from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS
+# FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE
+# COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT,
+# INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING,
+# BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT
+# LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN
+# ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+#
+# Author : Fredrik Thulin <fredrik@thulin.net>
+#
+"""
+Instrumentation (counters and latency histograms) for caches and backends of the IdP.
+"""
+
+import time
+import threading
+from contextlib import contextmanager
+
+# upper bounds, in seconds, of the buckets in latency histograms
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+
+
+class Stats(object):
+    """
+    Thread safe counters and latency histograms.
+
+    Counters are created on first use. Latency histograms are cumulative, like
+    the ones in Prometheus - bucket `le' counts all observations <= `le' seconds,
+    and observations above the largest bucket are only counted in 'count' and 'sum'.
+
+    :param buckets: upper bounds of the latency histogram buckets, in seconds
+    """
+
+    def __init__(self, buckets = LATENCY_BUCKETS):
+        self._lock = threading.Lock()
+        self._buckets = buckets
+        self._counters = {}
+        self._latency = {}
+
+    def incr(self, name, value = 1):
+        """
+        Increment a counter.
+
+        :param name: Name of counter
+        :param value: Value to increment the counter with
+
+        :type name: str
+        :type value: int
+        """
+        with self._lock:
+            self._counters[name] = self._counters.get(name, 0) + value
+
+    def get(self, name):
+        """
+        Get the current value of a counter.
+
+        :param name: Name of counter
+        :rtype: int
+        """
+        return self._counters.get(name, 0)
+
+    def observe(self, operation, seconds):
+        """
+        Record the latency of an operation.
+
+        :param operation: Name of operation, e.g. 'get'
+        :param seconds: Time the operation took
+
+        :type operation: str
+        :type seconds: float
+        """
+        with self._lock:
+            _hist = self._latency.get(operation)
+            if _hist is None:
+                _hist = {'count': 0,
+                         'sum': 0.0,
+                         'buckets': [0] * len(self._buckets),
+                         }
+                self._latency[operation] = _hist
+            _hist['count'] += 1
+            _hist['sum'] += seconds
+            for (idx, le) in enumerate(self._buckets):
+                if seconds <= le:
+                    _hist['buckets'][idx] += 1
+
+    @contextmanager
+    def timed(self, operation):
+        """
+        Context manager recording the latency of the operation in the with-block.
+
+        Operations raising an exception are recorded too, and counted as `<operation>_errors'.
+
+        :param operation: Name of operation, e.g. 'get'
+        :type operation: str
+        """
+        _start = time.time()
+        try:
+            yield
+        except Exception:
+            self.incr(operation + '_errors')
+            raise
+        finally:
+            self.observe(operation, time.time() - _start)
+
+    def to_dict(self):
+        """
+        Return a snapshot of all counters and latency histograms.
+
+        :return: dict like {'counters': {'hits': 17},
+                            'latency': {'get': {'count': 3, 'sum': 0.012, 'buckets': {0.001: 0, ...}}}}
+        :rtype: dict
+        """
+        with self._lock:
+            latency = {}
+            for (operation, _hist) in self._latency.items():
+                latency[operation] = {'count': _hist['count'],
+                                      'sum': _hist['sum'],
+                                      'buckets': dict(zip(self._buckets, _hist['buckets'])),
+                                      }
+            return {'counters': dict(self._counters),
+                    'latency': latency,
+                    }
+
+
+def merge_stats(snapshots):
+    """
+    Merge snapshots (from Stats.to_dict()) of a number of Stats instances, e.g. from
+    all the shards of a sharded cache.
+
+    :param snapshots: Stats snapshots
+    :type snapshots: [dict]
+    :rtype: dict
+    """
+    counters = {}
+    latency = {}
+    for this in snapshots:
+        for (name, value) in this['counters'].items():
+            counters[name] = counters.get(name, 0) + value
+        for (operation, _hist) in this['latency'].items():
+            _res = latency.setdefault(operation, {'count': 0, 'sum': 0.0, 'buckets': {}})
+            _res['count'] += _hist['count']
+            _res['sum'] += _hist['sum']
+            for (le, count) in _hist['buckets'].items():
+                _res['buckets'][le] = _res['buckets'].get(le, 0) + count
+    return {'counters': counters,
+            'latency': latency,
+            }
@@ -34,8 +34,12 @@
 
 import os
 import bson
+import time
+import threading
 import pkg_resources
 from unittest import TestCase
+from SocketServer import ThreadingMixIn
+from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
 
 import eduid_idp
 from eduid_idp.idp_user import IdPUser
@@ -107,6 +111,30 @@ class FakeUserDb(object):
     def get_user_by_eppn(self, eppn, raise_on_missing=True):
         return self.get_user_by_field('eduPersonPrincipalName', eppn, raise_on_missing)
 
+    def get_user_by_id(self, user_id, raise_on_missing=True):
+        return self.get_user_by_field('_id', user_id, raise_on_missing)
+
+    def _get_user_by_filter(self, filter, raise_on_missing=True, return_list=False):
+        # only supports the filters used by the IdP, like {'$or': [{field: value}, {field: {'$elemMatch': {...}}}]}
+        res = []
+        for _user in _USERDB:
+            for this in filter.get('$or', [filter]):
+                (field, value), = this.items()
+                if isinstance(value, dict):
+                    _match = value['$elemMatch']
+                    _found = [x for x in _user.get(field, []) if all([x.get(k) == v for (k, v) in _match.items()])]
+                else:
+                    _found = _user.get(field) == value
+                if _found:
+                    res.append(IdPUser(data=_user))
+                    break
+        if not res and raise_on_missing:
+            raise Exception('No user matching {!r} found'.format(filter))
+        if return_list:
+            return res
+        if res:
+            return res[0]
+
 
 class FakeAuthClient(object):
     userdb = FakeUserDb()
@@ -130,6 +158,17 @@ class FakeAuthClient(object):
 
 class FakeConfig(object):
     mongo_uri = None
+    userdb_projection = False
+    user_cache_ttl = 0
+    user_cache_negative_ttl = 0
+    user_cache_max_entries = 0
+    default_eppn_scope = None
+    default_scoped_affiliation = None
+    vccs_concurrent_verify = False
+    vccs_pool_size = 0
+    breaker_failure_threshold = 0
+    breaker_latency_threshold = 0
+    breaker_reset_timeout = 10
 
 
 class FakeSAML2Server(server.Server):
@@ -159,6 +198,59 @@ class FakeIdPApp(IdPApplication):
         self.IDP.metadata = FakeMetadata()
 
 
+class _FakeVCCSHandler(BaseHTTPRequestHandler):
+    # keep-alive
+    protocol_version = 'HTTP/1.1'
+    # send the response in one segment, like a real server would
+    wbufsize = -1
+    disable_nagle_algorithm = True
+
+    def setup(self):
+        BaseHTTPRequestHandler.setup(self)
+        self.server.connections += 1
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers.getheader('Content-Length', 0)))
+        self.server.requests += 1
+        if self.server.delay:
+            time.sleep(self.server.delay)
+        _body = '{"auth_response": {"version": 1, "authenticated": true}}'
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(_body)))
+        self.end_headers()
+        self.wfile.write(_body)
+
+    def log_message(self, *args):
+        pass
+
+
+class FakeVCCSServer(ThreadingMixIn, HTTPServer):
+    """
+    Stand-in VCCS authentication backend, accepting every password.
+
+    Listens on a random port on localhost, serving requests in a background thread.
+    Counts the connections and requests made, to test and benchmark VCCS clients.
+
+    :param delay: Seconds to wait before responding to a request
+    """
+    daemon_threads = True
+
+    def __init__(self, delay = 0):
+        HTTPServer.__init__(self, ('127.0.0.1', 0), _FakeVCCSHandler)
+        self.delay = delay
+        self.connections = 0
+        self.requests = 0
+        self.url = 'http://127.0.0.1:{!s}/'.format(self.server_address[1])
+        _thread = threading.Thread(target = self.serve_forever, name = 'FakeVCCSServer')
+        _thread.daemon = True
+        _thread.start()
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+
 class IdPSimpleTestCase(TestCase):
     """
     For simple test cases that do not need a real mongodb, but rather work with the
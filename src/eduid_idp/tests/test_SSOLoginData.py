@@ -33,9 +33,24 @@
 # Author : Fredrik Thulin <fredrik@thulin.net>
 #
 
-from unittest import TestCase
+import os
+import base64
+import logging
+import threading
+import pkg_resources
+from unittest import TestCase, skipIf
 
-from eduid_idp.loginstate import SSOLoginData
+import mock
+
+import eduid_idp
+from eduid_idp.loginstate import SSOLoginData, SSOLoginDataCache, from_compact
+
+try:
+    import fakeredis
+except ImportError:
+    fakeredis = None
+
+logger = logging.getLogger(__name__)
 
 
 class TestSSOLoginData(TestCase):
@@ -52,3 +67,128 @@ class TestSSOLoginData(TestCase):
                 }
         ticket = SSOLoginData('key', 'req_info', data, 'binding')
         self.assertEqual(ticket.SAMLRequest, '4711')
+
+
+class TestSSOLoginDataCompact(TestCase):
+
+    def test_small_request(self):
+        data = {'SAMLRequest': base64.b64encode('<samlp:AuthnRequest/>'),
+                'RelayState': '/foo',
+                'FailCount': 2,
+                }
+        ticket = SSOLoginData('key', 'req_info', data, 'binding')
+        compact = ticket.to_compact()
+        self.assertNotIn('z', compact)
+        expected = ticket.to_dict()
+        del expected['req_info']
+        self.assertEqual(expected, from_compact(compact))
+
+    def test_large_request(self):
+        _xml = '<samlp:AuthnRequest>{!s}</samlp:AuthnRequest>'.format('<saml:Issuer/>' * 200)
+        data = {'SAMLRequest': base64.b64encode(_xml),
+                }
+        ticket = SSOLoginData('key', 'req_info', data, 'binding')
+        compact = ticket.to_compact()
+        self.assertNotIn('s', compact)
+        self.assertTrue(len(compact['z']) < len(data['SAMLRequest']) / 4)
+        self.assertEqual(data['SAMLRequest'], from_compact(compact)['SAMLRequest'])
+
+    def test_large_compressed_request(self):
+        # HTTP-Redirect binding SAMLRequests are already compressed
+        data = {'SAMLRequest': base64.b64encode(os.urandom(2000)),
+                }
+        ticket = SSOLoginData('key', 'req_info', data, 'binding')
+        compact = ticket.to_compact()
+        self.assertEqual(data['SAMLRequest'], compact['s'])
+
+    def test_old_format(self):
+        data = {'key': 'key',
+                'SAMLRequest': '4711',
+                'RelayState': '',
+                'binding': 'binding',
+                'FailCount': 0,
+                'req_info': None,
+                }
+        self.assertEqual(data, from_compact(data))
+
+
+class TestSSOLoginDataCache(TestCase):
+
+    def setUp(self):
+        datadir = pkg_resources.resource_filename(__name__, 'data')
+        self.config = eduid_idp.config.IdPConfig(os.path.join(datadir, 'test_config.ini'), debug = False)
+        # no IdP (saml2.server.Server) - any attempt to parse a SAMLRequest will fail
+        self.cache = SSOLoginDataCache(None, 'TestCache', logger, 60, self.config, threading.Lock())
+        _local = eduid_idp.cache.ExpiringCacheMem('TestCache.local', logger, 60, max_entries = 10)
+        _remote = eduid_idp.cache.ExpiringCacheMem('TestCache.remote', logger, 60)
+        self.cache._cache = eduid_idp.cache.ExpiringCacheTiered('TestCache', logger, 60, _local, _remote,
+                                                                promote = self.cache._promote_ticket)
+
+    def _redis_config(self, **kwargs):
+        defaults = dict(eduid_idp.config._CONFIG_DEFAULTS, redis_host = 'localhost', session_app_key = 'secret')
+        defaults.update(kwargs)
+        return eduid_idp.config.IdPConfig(self.config.filename, debug = False, defaults = defaults)
+
+    def test_local_tier_size(self):
+        with mock.patch('eduid_idp.cache.ExpiringCacheCommonSession'):
+            cache = SSOLoginDataCache(None, 'TestCache', logger, 60, self._redis_config())
+            self.assertEqual(eduid_idp.loginstate._LOCAL_CACHE_MAX_ENTRIES, cache._cache.local.max_entries)
+            config = self._redis_config(login_state_max_entries = '100', login_state_max_bytes = '100000')
+            cache = SSOLoginDataCache(None, 'TestCache', logger, 60, config)
+            self.assertEqual(100, cache._cache.local.max_entries)
+            self.assertEqual(100000, cache._cache.local.max_bytes)
+
+    def test_local_ticket(self):
+        data = {'SAMLRequest': '4711',
+                'binding': 'binding',
+                }
+        self.cache.store_ticket(SSOLoginData('abcd', 'req_info', data, 'binding'))
+        self.assertEqual('abcd', self.cache._cache.remote.get('abcd').key)
+        # served from the local tier, without parsing the SAMLRequest
+        ticket = self.cache.get_ticket({'key': 'abcd'})
+        self.assertEqual('req_info', ticket.req_info)
+        self.assertEqual(1, self.cache._cache.stats.get('local_hits'))
+
+    def test_increment_fail_count(self):
+        data = {'SAMLRequest': '4711',
+                'binding': 'binding',
+                }
+        ticket = SSOLoginData('abcd', 'req_info', data, 'binding')
+        self.cache.store_ticket(ticket)
+        self.assertEqual(1, self.cache.increment_fail_count(ticket))
+        self.assertEqual(1, self.cache._cache.remote.get('abcd').FailCount)
+
+    @skipIf(fakeredis is None, 'fakeredis not available')
+    def test_increment_fail_count_counters(self):
+        self.cache._counters = eduid_idp.cache.ExpiringCacheCommonSession('TestCache', logger, 60, self.config)
+        self.cache._counters._redis = fakeredis.FakeStrictRedis()
+        self.cache._counters._redis.flushall()
+        data = {'SAMLRequest': '4711',
+                'binding': 'binding',
+                }
+        ticket = SSOLoginData('abcd', 'req_info', data, 'binding')
+        self.cache.store_ticket(ticket)
+        self.assertEqual(1, self.cache.increment_fail_count(ticket))
+        self.assertEqual(2, self.cache.increment_fail_count(ticket))
+        self.assertEqual(2, self.cache._counters.get_counter('abcd', 'FailCount'))
+        # the stored ticket is not re-written
+        self.assertEqual(1, self.cache._cache.remote.stats.get('adds'))
+
+        # login state stored by another IdP process gets the FailCount from the counter
+        self.cache._cache.local.delete('abcd')
+        self.cache._cache.remote.add('abcd', ticket.to_compact())
+        self.cache.create_ticket = mock.Mock(side_effect = lambda info, binding, key = None:
+                                             SSOLoginData(key, 'req_info', info, binding))
+        self.assertEqual(2, self.cache.get_ticket({'key': 'abcd'}).FailCount)
+
+    def test_remote_ticket(self):
+        data = {'SAMLRequest': '4711',
+                'binding': 'binding',
+                'FailCount': 2,
+                }
+        # login state stored by another IdP process
+        self.cache._cache.remote.add('abcd', data)
+        # the SAMLRequest has to be parsed to re-create the SSOLoginData, which fails without an IdP
+        with self.assertRaises(AttributeError):
+            self.cache.get_ticket({'key': 'abcd'})
+        self.assertEqual(1, self.cache.stats.get('remote_tickets'))
@@ -0,0 +1,80 @@
+#!/usr/bin/python
+#
+# Copyright (c) 2013 NORDUnet A/S
+# All rights reserved.
+#
+#   Redistribution and use in source and binary forms, with or
+#   without modification, are permitted provided that the following
+#   conditions are met:
+#
+#     1. Redistributions of source code must retain the above copyright
+#        notice, this list of conditions and the following disclaimer.
+#     2. Redistributions in binary form must reproduce the above
+#        copyright notice, this list of conditions and the following
+#        disclaimer in the documentation and/or other materials provided
+#        with the distribution.
+#     3. Neither the name of the NORDUnet nor the names of its
+#        contributors may be used to endorse or promote products derived
+#        from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS
+# FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE
+# COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT,
+# INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING,
+# BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT
+# LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN
+# ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+#
+# Author : Fredrik Thulin <fredrik@thulin.net>
+#
+
+from unittest import TestCase
+
+import bson
+
+from eduid_idp.sso_session import SSOSession, from_dict
+
+
+class TestSSOSessionSerialization(TestCase):
+
+    def setUp(self):
+        self.user_id = bson.ObjectId()
+        self.session = SSOSession(user_id = self.user_id,
+                                  authn_ref = 'eduid.se:level:1:100',
+                                  authn_class_ref = 'eduid.se:level:1',
+                                  authn_request_id = 'id-4711',
+                                  ts = 1234567890,
+                                  )
+
+    def test_to_dict(self):
+        self.assertEqual({'v': 1,
+                          'u': self.user_id,
+                          'r': 'eduid.se:level:1:100',
+                          'c': 'eduid.se:level:1',
+                          'i': 'id-4711',
+                          't': 1234567890,
+                          }, self.session.to_dict())
+
+    def test_round_trip(self):
+        session = from_dict(self.session.to_dict())
+        self.assertEqual(self.user_id, session.user_id)
+        self.assertEqual('eduid.se:level:1:100', session.user_authn_ref)
+        self.assertEqual('eduid.se:level:1', session.user_authn_class_ref)
+        self.assertEqual('id-4711', session.user_authn_request_id)
+        self.assertEqual(1234567890, session.authn_timestamp)
+
+    def test_old_format(self):
+        data = {'user_id': self.user_id,
+                'authn_ref': 'eduid.se:level:1:100',
+                'authn_class_ref': 'eduid.se:level:1',
+                'authn_request_id': 'id-4711',
+                'authn_timestamp': 1234567890,
+                }
+        session = from_dict(data)
+        self.assertEqual(self.user_id, session.user_id)
+        self.assertEqual(1234567890, session.authn_timestamp)
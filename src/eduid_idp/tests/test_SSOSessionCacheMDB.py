@@ -0,0 +1,172 @@
+#!/usr/bin/python
+#
+# Copyright (c) 2016 NORDUnet A/S
+# All rights reserved.
+#
+#   Redistribution and use in source and binary forms, with or
+#   without modification, are permitted provided that the following
+#   conditions are met:
+#
+#     1. Redistributions of source code must retain the above copyright
+#        notice, this list of conditions and the following disclaimer.
+#     2. Redistributions in binary form must reproduce the above
+#        copyright notice, this list of conditions and the following
+#        disclaimer in the documentation and/or other materials provided
+#        with the distribution.
+#     3. Neither the name of the NORDUnet nor the names of its
+#        contributors may be used to endorse or promote products derived
+#        from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS
+# FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE
+# COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT,
+# INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING,
+# BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT
+# LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN
+# ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+#
+# Author : Fredrik Thulin <fredrik@thulin.net>
+#
+
+import time
+import datetime
+import logging
+
+import mock
+
+import eduid_idp
+from eduid_userdb.testing import MongoTestCase
+
+logger = logging.getLogger(__name__)
+
+
+class TestSSOSessionCacheMDB(MongoTestCase):
+
+    def setUp(self):
+        super(TestSSOSessionCacheMDB, self).setUp(celery=None, get_attribute_manager=None)
+        self.mongo_uri = self.tmp_db.get_uri('')
+
+    def _created_ts_indexes(self, cache):
+        res = {}
+        for (name, info) in cache.sso_sessions.index_information().items():
+            if [x[0] for x in info['key']] == ['created_ts']:
+                res[name] = info
+        return res
+
+    def test_add_get_remove(self):
+        cache = eduid_idp.cache.SSOSessionCacheMDB(self.mongo_uri, logger, 60)
+        sid = cache.add_session('user1', {'foo': 'bar'})
+        self.assertEqual({'foo': 'bar'}, cache.get_session(sid))
+        self.assertEqual([sid], cache.get_sessions_for_user('user1'))
+        self.assertTrue(cache.remove_session(sid))
+        self.assertEqual(None, cache.get_session(sid))
+
+    def test_ttl_index(self):
+        cache = eduid_idp.cache.SSOSessionCacheMDB(self.mongo_uri, logger, 60)
+        self.assertEqual(['created_ts_idx'], self._created_ts_indexes(cache).keys())
+        # switch to a TTL index, the old index should be replaced
+        cache = eduid_idp.cache.SSOSessionCacheMDB(self.mongo_uri, logger, 60, ttl_index = True)
+        indexes = self._created_ts_indexes(cache)
+        self.assertEqual(['created_ts_ttl_idx'], indexes.keys())
+        self.assertEqual(60, indexes['created_ts_ttl_idx']['expireAfterSeconds'])
+        # change the SSO session lifetime
+        cache = eduid_idp.cache.SSOSessionCacheMDB(self.mongo_uri, logger, 120, ttl_index = True)
+        indexes = self._created_ts_indexes(cache)
+        self.assertEqual(120, indexes['created_ts_ttl_idx']['expireAfterSeconds'])
+
+    def test_no_inline_expiration(self):
+        # use a reaper (that won't run during the test) rather than a TTL index, to not have
+        # MongoDB expire the old session while the test is running
+        cache = eduid_idp.cache.SSOSessionCacheMDB(self.mongo_uri, logger, 60, reaper_interval = 3600)
+        self.addCleanup(cache.reaper.stop)
+        old_ts = datetime.datetime.utcnow() - datetime.timedelta(seconds = 3600)
+        cache.sso_sessions.insert({'session_id': 'old',
+                                   'username': 'user1',
+                                   'data': {},
+                                   'created_ts': old_ts,
+                                   })
+        cache.add_session('user1', {})
+        # adding a session must not have expired the old one (MongoDB or the reaper does that)
+        self.assertEqual({}, cache.get_session('old'))
+        self.assertTrue(cache.expire_old_sessions(force = True))
+        self.assertEqual(None, cache.get_session('old'))
+
+    def test_reaper_lease(self):
+        cache = eduid_idp.cache.SSOSessionCacheMDB(self.mongo_uri, logger, 60)
+        reaper1 = eduid_idp.cache.SSOSessionReaper(cache, 10, logger)
+        reaper2 = eduid_idp.cache.SSOSessionReaper(cache, 10, logger)
+        now = datetime.datetime.utcnow()
+        self.assertTrue(reaper1.acquire_lease(now = now))
+        self.assertFalse(reaper2.acquire_lease(now = now))
+        # renewal by the holder of the lease
+        self.assertTrue(reaper1.acquire_lease(now = now + datetime.timedelta(seconds = 10)))
+        # the lease expires three intervals after the last renewal
+        self.assertFalse(reaper2.acquire_lease(now = now + datetime.timedelta(seconds = 30)))
+        self.assertTrue(reaper2.acquire_lease(now = now + datetime.timedelta(seconds = 41)))
+        self.assertFalse(reaper1.acquire_lease(now = now + datetime.timedelta(seconds = 42)))
+
+    def test_local_cache(self):
+        cache = eduid_idp.cache.SSOSessionCacheMDB(self.mongo_uri, logger, 60, local_cache_ttl = 10)
+        sid = cache.add_session('user1', {'foo': 'bar'})
+        self.assertEqual({'foo': 'bar'}, cache.get_session(sid))
+        self.assertEqual({'foo': 'bar'}, cache.get_session(sid))
+        self.assertEqual(1, cache.local_cache_hits)
+        self.assertEqual(1, cache.local_cache_misses)
+        self.assertEqual(0.5, cache.local_cache_hit_rate)
+        self.assertTrue(cache.remove_session(sid))
+        self.assertEqual(None, cache.get_session(sid))
+
+    def test_invalidation_during_lookup(self):
+        cache = eduid_idp.cache.SSOSessionCacheMDB(self.mongo_uri, logger, 60, local_cache_ttl = 10)
+        sid = cache.add_session('user1', {'foo': 'bar'})
+        _find_one = cache.sso_sessions.find_one
+
+        def _find_one_and_invalidate(*args, **kwargs):
+            res = _find_one(*args, **kwargs)
+            # the invalidation of the session arrives after it was read from the database
+            cache._invalidate_local(sid)
+            return res
+
+        cache.sso_sessions = mock.Mock(wraps = cache.sso_sessions)
+        cache.sso_sessions.find_one.side_effect = _find_one_and_invalidate
+        self.assertEqual({'foo': 'bar'}, cache.get_session(sid))
+        self.assertEqual(None, cache._local_cache.get(sid))
+
+    def test_lookup_during_remove(self):
+        cache = eduid_idp.cache.SSOSessionCacheMDB(self.mongo_uri, logger, 60, local_cache_ttl = 10)
+        sid = cache.add_session('user1', {'foo': 'bar'})
+        _remove = cache.sso_sessions.remove
+        lookups = []
+
+        def _lookup_and_remove(*args, **kwargs):
+            # the session is looked up (and found) in the database before it is removed
+            lookups.append(cache.get_session(sid))
+            return _remove(*args, **kwargs)
+
+        cache.sso_sessions = mock.Mock(wraps = cache.sso_sessions)
+        cache.sso_sessions.remove.side_effect = _lookup_and_remove
+        self.assertTrue(cache.remove_session(sid))
+        self.assertEqual([{'foo': 'bar'}], lookups)
+        self.assertEqual(None, cache._local_cache.get(sid))
+        self.assertEqual(None, cache.get_session(sid))
+
+    def test_invalidation_channel(self):
+        cache1 = eduid_idp.cache.SSOSessionCacheMDB(self.mongo_uri, logger, 60, local_cache_ttl = 10,
+                                                    invalidation_channel = True)
+        cache2 = eduid_idp.cache.SSOSessionCacheMDB(self.mongo_uri, logger, 60, local_cache_ttl = 10,
+                                                    invalidation_channel = True)
+        self.addCleanup(cache1.invalidation_listener.stop)
+        self.addCleanup(cache2.invalidation_listener.stop)
+        sid = cache1.add_session('user1', {'foo': 'bar'})
+        self.assertEqual({'foo': 'bar'}, cache2.get_session(sid))
+        cache1.remove_session(sid)
+        for _ in range(50):
+            if cache2.get_session(sid) is None:
+                break
+            time.sleep(0.1)
+        self.assertEqual(None, cache2.get_session(sid))
@@ -0,0 +1,119 @@
+#!/usr/bin/python
+#
+# Copyright (c) 2016 NORDUnet A/S
+# All rights reserved.
+#
+#   Redistribution and use in source and binary forms, with or
+#   without modification, are permitted provided that the following
+#   conditions are met:
+#
+#     1. Redistributions of source code must retain the above copyright
+#        notice, this list of conditions and the following disclaimer.
+#     2. Redistributions in binary form must reproduce the above
+#        copyright notice, this list of conditions and the following
+#        disclaimer in the documentation and/or other materials provided
+#        with the distribution.
+#     3. Neither the name of the NORDUnet nor the names of its
+#        contributors may be used to endorse or promote products derived
+#        from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS
+# FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE
+# COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT,
+# INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING,
+# BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT
+# LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN
+# ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+#
+# Author : Fredrik Thulin <fredrik@thulin.net>
+#
+
+import os
+import logging
+import pkg_resources
+from unittest import TestCase, skipIf
+
+import bson
+import mock
+
+import eduid_idp
+
+try:
+    import fakeredis
+except ImportError:
+    fakeredis = None
+
+logger = logging.getLogger(__name__)
+
+
+@skipIf(fakeredis is None, 'fakeredis not available')
+class TestSSOSessionCacheRedis(TestCase):
+
+    def setUp(self):
+        self.redis = fakeredis.FakeStrictRedis()
+        self.redis.flushall()
+        self.cache = eduid_idp.cache.SSOSessionCacheRedis(logger, 60, client = self.redis)
+
+    def test_add_get_remove(self):
+        user_id = bson.ObjectId()
+        sid = self.cache.add_session(user_id, {'user_id': user_id, 'authn_timestamp': 4711})
+        self.assertEqual({'user_id': user_id, 'authn_timestamp': 4711}, self.cache.get_session(sid))
+        self.assertTrue(0 < self.redis.ttl('sso_session:' + sid) <= 60)
+        self.assertTrue(self.cache.remove_session(sid))
+        self.assertEqual(None, self.cache.get_session(sid))
+        self.assertFalse(self.cache.remove_session(sid))
+
+    def test_sessions_for_user(self):
+        user_id = bson.ObjectId()
+        sid1 = self.cache.add_session(user_id, {})
+        sid2 = self.cache.add_session(user_id, {})
+        sid3 = self.cache.add_session(bson.ObjectId(), {})
+        self.assertEqual(sorted([sid1, sid2]), sorted(self.cache.get_sessions_for_user(user_id)))
+        self.cache.remove_session(sid1)
+        self.assertEqual([sid2], self.cache.get_sessions_for_user(user_id))
+        # simulate expiry of a session
+        self.redis.delete('sso_session:' + sid2)
+        self.assertEqual([], self.cache.get_sessions_for_user(user_id))
+        self.assertEqual(set(), self.redis.smembers('sso_session_user:' + str(user_id)))
+        self.assertNotEqual(None, self.cache.get_session(sid3))
+
+
+@skipIf(fakeredis is None, 'fakeredis not available')
+class TestExpiringCacheCommonSessionCounters(TestCase):
+
+    def setUp(self):
+        datadir = pkg_resources.resource_filename(__name__, 'data')
+        self.config = eduid_idp.config.IdPConfig(os.path.join(datadir, 'test_config.ini'), debug = False)
+        self.redis = fakeredis.FakeStrictRedis()
+        self.redis.flushall()
+        self.cache = eduid_idp.cache.ExpiringCacheCommonSession('TestCache', logger, 60, self.config)
+        self.cache._redis = self.redis
+
+    def test_incr(self):
+        self.assertEqual(None, self.cache.get_counter('abcd', 'FailCount'))
+        self.assertEqual(1, self.cache.incr('abcd', 'FailCount'))
+        self.assertEqual(3, self.cache.incr('abcd', 'FailCount', 2))
+        self.assertEqual(3, self.cache.get_counter('abcd', 'FailCount'))
+        self.assertEqual(None, self.cache.get_counter('efgh', 'FailCount'))
+        self.assertTrue(0 < self.redis.ttl('TestCache:abcd:counters') <= 60)
+
+    def test_delete_counters(self):
+        self.cache.incr('abcd', 'FailCount')
+        self.cache._manager = mock.Mock()
+        self.cache._manager.get_session.return_value.db_key = 'session:abcd'
+        self.redis.set('session:abcd', 'encrypted data')
+        self.assertTrue(self.cache.delete('abcd'))
+        self.assertEqual(None, self.cache.get_counter('abcd', 'FailCount'))
+        self.assertFalse(self.redis.exists('TestCache:abcd:counters'))
+        self.assertFalse(self.redis.exists('session:abcd'))
+        # the session isn't loaded to find out if it exists
+        self.assertEqual({}, self.cache._manager.get_session.call_args[1]['data'])
+        self.assertFalse(self.cache.delete('abcd'))
+
+    def test_shared_client(self):
+        self.assertIs(eduid_idp.cache.get_redis_client(self.config), eduid_idp.cache.get_redis_client(self.config))
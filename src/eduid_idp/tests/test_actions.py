@@ -71,6 +71,7 @@ class TestActions(MongoTestCase):
 
         # Create the IdP app
         self.idp_app = IdPApplication(logger, self.config)
+        self.addCleanup(self.idp_app.stop)
 
         self.actions = self.idp_app.actions_db
 
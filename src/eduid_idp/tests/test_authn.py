@@ -0,0 +1,329 @@
+#!/usr/bin/python
+#
+# Copyright (c) 2013 NORDUnet A/S
+# All rights reserved.
+#
+#   Redistribution and use in source and binary forms, with or
+#   without modification, are permitted provided that the following
+#   conditions are met:
+#
+#     1. Redistributions of source code must retain the above copyright
+#        notice, this list of conditions and the following disclaimer.
+#     2. Redistributions in binary form must reproduce the above
+#        copyright notice, this list of conditions and the following
+#        disclaimer in the documentation and/or other materials provided
+#        with the distribution.
+#     3. Neither the name of the NORDUnet nor the names of its
+#        contributors may be used to endorse or promote products derived
+#        from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS
+# FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE
+# COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT,
+# INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING,
+# BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT
+# LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN
+# ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+#
+# Author : Fredrik Thulin <fredrik@thulin.net>
+
+import time
+import logging
+import datetime
+from unittest import TestCase
+
+import mock
+import pymongo
+import vccs_client
+
+import eduid_idp.authn
+from eduid_idp.authn import AuthnLogWriter, AuthnInfoStoreMDB
+from eduid_idp.testing import IdPSimpleTestCase, FakeConfig, FakeAuthClient
+
+logger = logging.getLogger(__name__)
+
+
+class FakeAuthnInfoStore(object):
+
+    def __init__(self):
+        self.writes = []
+        self.fail = False
+
+    def bulk_log_authn(self, credentials, users):
+        if self.fail:
+            raise pymongo.errors.AutoReconnect('test')
+        self.writes.append((credentials, users))
+
+
+class TestAuthnLogWriter(TestCase):
+
+    def setUp(self):
+        self.store = FakeAuthnInfoStore()
+        self.writer = AuthnLogWriter(self.store, logger, max_pending = 2)
+        self.ts = datetime.datetime(2015, 2, 1)
+
+    def test_coalesce(self):
+        self.writer.log_authn('user1', [], ['cred1'], ts = self.ts)
+        self.writer.log_authn('user1', ['cred1'], [], ts = self.ts + datetime.timedelta(seconds = 1))
+        self.writer.flush()
+        (credentials, users), = self.store.writes
+        self.assertEqual({'cred1': self.ts + datetime.timedelta(seconds = 1)}, credentials)
+        success, ts, counts = users['user1']
+        self.assertEqual(['cred1'], success)
+        self.assertEqual({'fail_count.201502': 1, 'success_count.201502': 1}, counts)
+        # nothing more to write
+        self.writer.flush()
+        self.assertEqual(1, len(self.store.writes))
+
+    def test_queue_full(self):
+        self.assertTrue(self.writer.log_authn('user1', [], ['cred1'], ts = self.ts))
+        self.assertTrue(self.writer.log_authn('user2', [], ['cred2'], ts = self.ts))
+        # authentications that don't fit in the queue are written directly
+        self.assertFalse(self.writer.log_authn('user3', [], ['cred3'], ts = self.ts))
+        (credentials, users), = self.store.writes
+        self.assertEqual(['user3'], users.keys())
+        self.assertEqual({'fail_count.201502': 1, 'success_count.201502': 0}, users['user3'][2])
+        # more authentications of queued users are still accepted
+        self.assertTrue(self.writer.log_authn('user1', [], ['cred1'], ts = self.ts))
+        stats = self.writer.get_stats()
+        self.assertEqual(2, stats['pending_users'])
+        self.assertEqual(1, stats['counters']['overflow'])
+
+    def test_write_error(self):
+        self.writer.log_authn('user1', ['cred1'], [], ts = self.ts)
+        self.store.fail = True
+        self.writer.flush()
+        self.assertEqual(1, self.writer.get_stats()['pending_users'])
+        self.store.fail = False
+        self.writer.stop()
+        self.assertEqual(1, len(self.store.writes))
+        self.assertEqual(0, self.writer.get_stats()['pending_users'])
+
+    def test_write_error_queue_full(self):
+        self.writer.log_authn('user1', [], ['cred1'], ts = self.ts)
+        self.writer.log_authn('user2', [], ['cred2'], ts = self.ts)
+
+        def _failing_write(credentials, users):
+            # the queue fills up again while the (failing) write is in progress
+            self.writer.log_authn('user3', [], ['cred3'], ts = self.ts)
+            self.writer.log_authn('user4', [], ['cred4'], ts = self.ts)
+            raise pymongo.errors.AutoReconnect('test')
+
+        self.store.bulk_log_authn = _failing_write
+        self.writer.flush()
+        # failed writes are never dropped, even though max_pending is exceeded
+        self.assertEqual(4, self.writer.get_stats()['pending_users'])
+        del self.store.bulk_log_authn
+        self.writer.flush()
+        (credentials, users), = self.store.writes
+        self.assertEqual(['user1', 'user2', 'user3', 'user4'], sorted(users.keys()))
+
+
+class FakeBulk(object):
+    """
+    Unordered bulk operation, failing the writes to some documents.
+    """
+
+    def __init__(self, collection):
+        self.collection = collection
+        self._ops = []
+        self._spec = None
+
+    def find(self, spec):
+        self._spec = spec
+        return self
+
+    def upsert(self):
+        return self
+
+    def replace_one(self, doc):
+        self._ops.append((self._spec['_id'], 'replace', doc))
+
+    def update_one(self, update):
+        self._ops.append((self._spec['_id'], 'update', update))
+
+    def execute(self):
+        errors = []
+        for index, (_id, op, doc) in enumerate(self._ops):
+            if _id in self.collection.fail_ids:
+                errors.append({'index': index, 'code': 11000, 'errmsg': 'test', 'op': doc})
+            else:
+                self.collection.writes.append((_id, op, doc))
+        if errors:
+            raise pymongo.errors.BulkWriteError({'writeErrors': errors,
+                                                 'writeConcernErrors': [],
+                                                 'nInserted': 0,
+                                                 'nUpserted': len(self._ops) - len(errors),
+                                                 })
+
+
+class FakeBulkCollection(object):
+
+    def __init__(self):
+        self.writes = []
+        self.fail_ids = []
+
+    def initialize_unordered_bulk_op(self):
+        return FakeBulk(self)
+
+
+class TestBulkLogAuthn(TestCase):
+
+    def setUp(self):
+        self.collection = FakeBulkCollection()
+        with mock.patch('eduid_idp.authn.MongoDB') as _mongodb:
+            _mongodb.return_value.get_collection.return_value = self.collection
+            self.store = AuthnInfoStoreMDB('mongodb://localhost', logger)
+        self.writer = AuthnLogWriter(self.store, logger)
+        self.ts = datetime.datetime(2015, 2, 1)
+
+    def test_partial_failure(self):
+        self.writer.log_authn('user1', [], ['cred1'], ts = self.ts)
+        self.writer.log_authn('user2', ['cred2'], [], ts = self.ts)
+        self.writer.log_authn('user3', [], ['cred3'], ts = self.ts)
+        self.collection.fail_ids = ['user2', 'cred2']
+        self.writer.flush()
+        self.assertEqual(['user1', 'user3'], sorted([x[0] for x in self.collection.writes]))
+        # only the failed writes are queued again
+        stats = self.writer.get_stats()
+        self.assertEqual(1, stats['pending_users'])
+        self.assertEqual(1, stats['pending_credentials'])
+        self.collection.fail_ids = []
+        self.collection.writes = []
+        self.writer.flush()
+        self.assertEqual(['cred2', 'user2'], sorted([x[0] for x in self.collection.writes]))
+        self.writer.flush()
+        # the fail counts of the users written in the first flush were not incremented again
+        self.assertEqual(2, len(self.collection.writes))
+
+
+class TestConcurrentVerify(IdPSimpleTestCase):
+
+    def setUp(self):
+        super(TestConcurrentVerify, self).setUp()
+        config = FakeConfig()
+        config.vccs_concurrent_verify = True
+        config.vccs_pool_size = 1
+        self.authn = eduid_idp.authn.IdPAuthn(logger, config, self.idp_userdb,
+                                              auth_client = FakeAuthClient())
+        self.addCleanup(self.authn.stop)
+        self.calls = []
+        _authenticate = self.authn.auth_client.authenticate
+
+        def _counting_authenticate(user_id, factors):
+            self.calls.append(factors[0].credential_id)
+            return _authenticate(user_id, factors)
+
+        self.authn.auth_client.authenticate = _counting_authenticate
+
+    def test_verify_username_and_password(self):
+        for password in ['foo', 'bar']:
+            data = {'username': 'test@example.com',
+                    'password': password,
+                    }
+            self.assertTrue(self.authn.verify_username_and_password(data))
+
+    def test_verify_username_and_incorrect_password(self):
+        data = {'username': 'test@example.com',
+                'password': 'baz',
+                }
+        self.assertFalse(self.authn.verify_username_and_password(data))
+        # all the credentials were tried
+        self.assertEqual(2, len(set(self.calls)))
+
+
+class SlowAuthClient(object):
+    """
+    Checks one password factor per request, taking `delays' seconds per credential.
+    """
+
+    def __init__(self, delays, valid, errors = ()):
+        self.delays = delays
+        self.valid = valid
+        self.errors = errors
+
+    def authenticate(self, user_id, factors):
+        _cred_id = factors[0].credential_id
+        time.sleep(self.delays.get(_cred_id, 0))
+        if _cred_id in self.errors:
+            raise IOError('VCCS connection failed')
+        return _cred_id in self.valid
+
+
+class TestConcurrentVerifyTiming(IdPSimpleTestCase):
+
+    def _verify(self, auth_client):
+        config = FakeConfig()
+        config.vccs_concurrent_verify = True
+        config.vccs_pool_size = 2
+        authn = eduid_idp.authn.IdPAuthn(logger, config, self.idp_userdb, auth_client = auth_client)
+        self.addCleanup(authn.stop)
+        data = {'username': 'test@example.com',
+                'password': 'foo',
+                }
+        _start = time.time()
+        res = authn.verify_username_and_password(data)
+        return res, time.time() - _start
+
+    def test_concurrent(self):
+        # the second credential is valid, and both take 0.5 seconds to check
+        res, duration = self._verify(SlowAuthClient({'a' * 24: 0.5, 'b' * 24: 0.5}, ['b' * 24]))
+        self.assertTrue(res)
+        # about one round trip to VCCS, instead of two
+        self.assertTrue(duration < 0.9, 'verification took {!s} seconds'.format(duration))
+
+    def test_first_success(self):
+        # the first valid credential is returned without waiting for the slow one
+        res, duration = self._verify(SlowAuthClient({'a' * 24: 0.05, 'b' * 24: 2}, ['a' * 24]))
+        self.assertTrue(res)
+        self.assertTrue(duration < 1, 'verification took {!s} seconds'.format(duration))
+
+    def test_error_on_other_factor(self):
+        # an error checking one credential doesn't fail a login another one satisfies
+        res, _duration = self._verify(SlowAuthClient({'b' * 24: 0.1}, ['b' * 24], errors = ['a' * 24]))
+        self.assertTrue(res)
+
+
+class FailingAuthClient(object):
+
+    def __init__(self, http_code):
+        self.http_code = http_code
+
+    def authenticate(self, user_id, factors):
+        raise vccs_client.VCCSClientHTTPError('test', self.http_code)
+
+
+class TestVCCSBreaker(IdPSimpleTestCase):
+
+    def _authn(self, http_code):
+        config = FakeConfig()
+        config.breaker_failure_threshold = 2
+        authn = eduid_idp.authn.IdPAuthn(logger, config, self.idp_userdb,
+                                         auth_client = FailingAuthClient(http_code))
+        user = self.idp_userdb.lookup_user('test@example.com')
+        cred = user.passwords.to_list()[0]
+        factor = vccs_client.VCCSPasswordFactor('foo', str(cred.id), str(cred.salt))
+        for _ in range(config.breaker_failure_threshold):
+            self.assertFalse(authn._authn_factor(user, 'test@example.com', cred, factor))
+        return authn
+
+    def test_is_vccs_failure(self):
+        for http_code in [502, 503, 504]:
+            self.assertTrue(eduid_idp.authn._is_vccs_failure(vccs_client.VCCSClientHTTPError('test', http_code)))
+        for http_code in [400, 500]:
+            self.assertFalse(eduid_idp.authn._is_vccs_failure(vccs_client.VCCSClientHTTPError('test', http_code)))
+        self.assertFalse(eduid_idp.authn._is_vccs_failure(ValueError()))
+
+    def test_revoked_credential(self):
+        # VCCS returns 500 for revoked credentials, which must not open the circuit
+        authn = self._authn(500)
+        self.assertEqual(eduid_idp.breaker.CLOSED, authn.vccs_breaker.state)
+
+    def test_bad_gateway(self):
+        authn = self._authn(502)
+        self.assertEqual(eduid_idp.breaker.OPEN, authn.vccs_breaker.state)
@@ -0,0 +1,155 @@
+#
+# Copyright (c) 2016 NORDUnet A/S
+# All rights reserved.
+#
+#   Redistribution and use in source and binary forms, with or
+#   without modification, are permitted provided that the following
+#   conditions are met:
+#
+#     1. Redistributions of source code must retain the above copyright
+#        notice, this list of conditions and the following disclaimer.
+#     2. Redistributions in binary form must reproduce the above
+#        copyright notice, this list of conditions and the following
+#        disclaimer in the documentation and/or other materials provided
+#        with the distribution.
+#     3. Neither the name of the NORDUnet nor the names of its
+#        contributors may be used to endorse or promote products derived
+#        from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS
+# FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE
+# COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT,
+# INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING,
+# BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT
+# LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN
+# ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+#
+# Author : Fredrik Thulin <fredrik@thulin.net>
+#
+
+import time
+import logging
+from unittest import TestCase
+
+import eduid_idp.error
+from eduid_idp.breaker import CircuitBreaker, CLOSED, OPEN, HALF_OPEN
+
+logger = logging.getLogger(__name__)
+
+
+class BackendDown(Exception):
+    pass
+
+
+class TestCircuitBreaker(TestCase):
+
+    def setUp(self):
+        self.breaker = CircuitBreaker('test', logger, (BackendDown,), failure_threshold = 2, reset_timeout = 10)
+
+    def _fail(self, now = None):
+        with self.assertRaises(BackendDown):
+            with self.breaker.call(now):
+                raise BackendDown()
+
+    def _succeed(self, now = None):
+        with self.breaker.call(now):
+            pass
+
+    def test_open(self):
+        self._fail()
+        self.assertEqual(CLOSED, self.breaker.state)
+        self._fail()
+        self.assertEqual(OPEN, self.breaker.state)
+        with self.assertRaises(eduid_idp.error.ServiceError):
+            self._succeed()
+        stats = self.breaker.get_stats()
+        self.assertEqual(OPEN, stats['state'])
+        self.assertEqual(1, stats['counters']['rejected'])
+        self.assertEqual(2, stats['counters']['errors'])
+
+    def test_success_resets(self):
+        self._fail()
+        self._succeed()
+        self._fail()
+        self.assertEqual(CLOSED, self.breaker.state)
+
+    def test_other_exceptions(self):
+        for _ in range(3):
+            with self.assertRaises(ValueError):
+                with self.breaker.call():
+                    raise ValueError()
+        self.assertEqual(CLOSED, self.breaker.state)
+
+    def test_half_open(self):
+        self._fail()
+        self._fail()
+        _later = time.time() + 11
+        # the probe fails, and the circuit is opened again
+        self._fail(_later)
+        self.assertEqual(OPEN, self.breaker.state)
+        _later = time.time() + 11
+        with self.breaker.call(_later):
+            self.assertEqual(HALF_OPEN, self.breaker.state)
+            # only one probe at a time
+            with self.assertRaises(eduid_idp.error.ServiceError):
+                self._succeed(_later)
+        self.assertEqual(CLOSED, self.breaker.state)
+
+    def test_slow_calls(self):
+        breaker = CircuitBreaker('test', logger, (BackendDown,), failure_threshold = 1, latency_threshold = 0.01)
+        with breaker.call():
+            time.sleep(0.02)
+        self.assertEqual(OPEN, breaker.state)
+        self.assertEqual(1, breaker.get_stats()['counters']['slow_calls'])
+
+    def test_disabled(self):
+        breaker = CircuitBreaker('test', logger, (BackendDown,), failure_threshold = 0)
+        for _ in range(10):
+            with self.assertRaises(BackendDown):
+                with breaker.call():
+                    raise BackendDown()
+        self.assertEqual(CLOSED, breaker.state)
+
+    def test_stale_call(self):
+        _stale = self.breaker.call()
+        _stale.__enter__()
+        self._fail()
+        self._fail()
+        _later = time.time() + 11
+        with self.breaker.call(_later):
+            # a call made before the circuit opened completes while probing
+            _stale.__exit__(None, None, None)
+            self.assertEqual(HALF_OPEN, self.breaker.state)
+            # and doesn't let another probe through
+            with self.assertRaises(eduid_idp.error.ServiceError):
+                self._succeed(_later)
+        self.assertEqual(CLOSED, self.breaker.state)
+
+    def test_interrupted_probe(self):
+        self._fail()
+        self._fail()
+        _later = time.time() + 11
+        with self.assertRaises(KeyboardInterrupt):
+            with self.breaker.call(_later):
+                raise KeyboardInterrupt()
+        self.assertEqual(HALF_OPEN, self.breaker.state)
+        # another probe is let through
+        self._succeed(_later)
+        self.assertEqual(CLOSED, self.breaker.state)
+
+    def test_is_failure(self):
+        breaker = CircuitBreaker('test', logger, (BackendDown,), failure_threshold = 1,
+                                 is_failure = lambda exc: isinstance(exc, ValueError) and exc.args == ('down',))
+        with self.assertRaises(ValueError):
+            with breaker.call():
+                raise ValueError('bad request')
+        self.assertEqual(CLOSED, breaker.state)
+        with self.assertRaises(ValueError):
+            with breaker.call():
+                raise ValueError('down')
+        self.assertEqual(OPEN, breaker.state)
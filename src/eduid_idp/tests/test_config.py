@@ -38,6 +38,8 @@ Test config parsing.
 """
 
 import os
+import shutil
+import tempfile
 import unittest
 import pkg_resources
 
@@ -58,3 +60,43 @@ class TestCredStore(unittest.TestCase):
         """
         self.assertTrue(self.config.static_dir.startswith('/home/'))
         self.assertEqual(self.config.listen_port, 8000)
+
+    def test_read_only(self):
+        with self.assertRaises(AttributeError):
+            self.config.listen_port = 4711
+        self.assertEqual(self.config.listen_port, 8000)
+
+    def test_parsed_once(self):
+        self.assertEqual(self.config.listen_port, 8000)
+        # all settings are stored as plain attributes when the config is loaded
+        self.assertEqual(self.config.__dict__['listen_port'], 8000)
+        self.assertEqual(self.config.__dict__['content_packages'], [])
+
+    def test_bad_value(self):
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        filename = os.path.join(tmpdir, 'bad_config.ini')
+        with open(filename, 'w') as fd:
+            fd.write('[eduid_idp]\nlisten_port = foo\n')
+        with self.assertRaises(ValueError):
+            eduid_idp.config.IdPConfig(filename, debug = False)
+
+    def test_reload(self):
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        filename = os.path.join(tmpdir, 'idp.ini')
+        with open(filename, 'w') as fd:
+            fd.write('[eduid_idp]\nsso_session_lifetime = 15\n')
+        config = eduid_idp.config.IdPConfig(filename, debug = False)
+        with open(filename, 'w') as fd:
+            fd.write('[eduid_idp]\nsso_session_lifetime = 60\nstatus_test_usernames = foo, bar\n')
+        new = config.reload()
+        self.assertEqual(15, config.sso_session_lifetime)
+        self.assertEqual(60, new.sso_session_lifetime)
+        self.assertEqual(['foo', 'bar'], new.status_test_usernames)
+        self.assertEqual(config.pysaml2_config, new.pysaml2_config)
+
+    def test_defaults_not_modified(self):
+        defaults = {'pysaml2_config': 'idp_conf.py'}
+        eduid_idp.config.IdPConfig(self.config_file, debug = False, defaults = defaults)
+        self.assertEqual({'pysaml2_config': 'idp_conf.py'}, defaults)
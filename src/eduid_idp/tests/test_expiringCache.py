@@ -38,6 +38,7 @@ import logging
 from unittest import TestCase
 
 import eduid_idp
+from eduid_idp.loginstate import SSOLoginData
 
 logger = logging.getLogger()
 
@@ -99,3 +100,179 @@ class TestExpiringCache(TestCase):
         self.assertEqual({2: 'two'}, c.items())
         c.delete(2)
         self.assertEqual({}, c.items())
+
+    def test_add_again(self):
+        ttl = 30
+        c = eduid_idp.cache.ExpiringCacheMem('TestCache', logger, ttl)
+        now = int(time.time())
+        c.add('one', 'ett', now = now - 60)
+        c.add('one', 'uno', now = now)
+        c.add('two', 'tvaa', now = now)
+        # the old queue entry for 'one' must not expire the value added later
+        self.assertEqual('uno', c.get('one'))
+        self.assertEqual(2, len(c._ages))
+
+    def test_add_again_queue_length(self):
+        ttl = 30
+        c = eduid_idp.cache.ExpiringCacheMem('TestCache', logger, ttl)
+        now = int(time.time())
+        c.add('one', 'ett', now = now)
+        for this in range(1000):
+            c.add('two', this, now = now)
+        self.assertEqual(999, c.get('two'))
+        self.assertTrue(len(c._ages) <= 2 * len(c.items()) + 16)
+        c.add('three', 'tre', now = now + 60)
+        self.assertEqual({'three': 'tre'}, c.items())
+        self.assertEqual(1, len(c._ages))
+
+
+class TestExpiringCacheShardedMem(TestCase):
+    def test_add(self):
+        ttl = 30
+        c = eduid_idp.cache.ExpiringCacheShardedMem('TestCache', logger, ttl, 4)
+        now = int(time.time())
+        c.add('one', 'ett', now = now - 60)
+        self.assertEqual('ett', c.get('one'))
+        # purging is done per shard, so add an entry to every shard
+        for this in range(100):
+            c.add(this, str(this), now = now)
+        self.assertEqual(None, c.get('one'))
+        self.assertEqual('42', c.get(42))
+
+    def test_items_and_delete(self):
+        ttl = 30
+        c = eduid_idp.cache.ExpiringCacheShardedMem('TestCache', logger, ttl, 4)
+        c.add(1, 'one')
+        c.add(2, 'two')
+        self.assertEqual({1: 'one', 2: 'two'}, c.items())
+        self.assertTrue(c.delete(1))
+        self.assertEqual({2: 'two'}, c.items())
+
+    def test_bad_shards(self):
+        with self.assertRaises(ValueError):
+            eduid_idp.cache.ExpiringCacheShardedMem('TestCache', logger, 30, 0)
+
+
+class TestExpiringCacheMemBounded(TestCase):
+    def test_max_entries(self):
+        ttl = 30
+        c = eduid_idp.cache.ExpiringCacheMem('TestCache', logger, ttl, max_entries = 2)
+        c.add('one', 'ett')
+        c.add('two', 'tvaa')
+        # make 'one' the most recently used entry
+        self.assertEqual('ett', c.get('one'))
+        c.add('three', 'tre')
+        self.assertEqual({'one': 'ett', 'three': 'tre'}, c.items())
+        self.assertEqual(1, c.evictions)
+        self.assertEqual(0, c.expiries)
+
+    def test_max_bytes(self):
+        ttl = 30
+        c = eduid_idp.cache.ExpiringCacheMem('TestCache', logger, ttl, max_bytes = 5000)
+        for this in range(10):
+            c.add(this, 'x' * 1000)
+        self.assertTrue(c.size_bytes <= 5000)
+        self.assertTrue(len(c.items()) < 5)
+        self.assertEqual(10, len(c.items()) + c.evictions)
+        self.assertEqual('x' * 1000, c.get(9))
+        c.delete(9)
+        self.assertEqual(len(c.items()) * c._sizes.values()[0], c.size_bytes)
+
+    def test_max_bytes_slots(self):
+        ttl = 30
+        c = eduid_idp.cache.ExpiringCacheMem('TestCache', logger, ttl, max_bytes = 5000)
+        # SSOLoginData has __slots__ and no __dict__, make sure the SAMLRequest is counted
+        ticket = SSOLoginData('key', None, {'SAMLRequest': 'x' * 1000}, 'binding')
+        c.add('one', ticket)
+        self.assertTrue(c.size_bytes > 1000)
+
+    def test_expiries(self):
+        ttl = 30
+        c = eduid_idp.cache.ExpiringCacheMem('TestCache', logger, ttl, max_entries = 10)
+        now = int(time.time())
+        c.add('one', 'ett', now = now - 60)
+        c.add('two', 'tvaa', now = now)
+        self.assertEqual(None, c.get('one'))
+        self.assertEqual(1, c.expiries)
+        self.assertEqual(0, c.evictions)
+
+    def test_get_stats(self):
+        ttl = 30
+        c = eduid_idp.cache.ExpiringCacheMem('TestCache', logger, ttl, max_entries = 1)
+        c.add('one', 'ett')
+        c.add('two', 'tvaa')
+        c.get('one')
+        c.get('two')
+        res = c.get_stats()
+        self.assertEqual({'adds': 2, 'hits': 1, 'misses': 1, 'evictions': 1}, res['counters'])
+        self.assertEqual(1, res['entries'])
+
+    def test_sharded_get_stats(self):
+        ttl = 30
+        c = eduid_idp.cache.ExpiringCacheShardedMem('TestCache', logger, ttl, 4)
+        for this in range(10):
+            c.add(this, str(this))
+        c.get(3)
+        c.get(11)
+        res = c.get_stats()
+        self.assertEqual({'adds': 10, 'hits': 1, 'misses': 1}, res['counters'])
+        self.assertEqual(10, res['entries'])
+
+
+class TestExpiringCacheTiered(TestCase):
+    def setUp(self):
+        self.local = eduid_idp.cache.ExpiringCacheMem('TestCache.local', logger, 30)
+        self.remote = eduid_idp.cache.ExpiringCacheMem('TestCache.remote', logger, 30)
+        self.c = eduid_idp.cache.ExpiringCacheTiered('TestCache', logger, 30, self.local, self.remote,
+                                                     promote = lambda key, data: data.upper())
+
+    def test_add_get(self):
+        self.c.add('one', 'ett')
+        self.assertEqual('ett', self.remote.get('one'))
+        self.assertEqual('ett', self.c.get('one'))
+        self.assertEqual(1, self.c.stats.get('local_hits'))
+
+    def test_promote(self):
+        self.remote.add('one', 'ett')
+        self.assertEqual('ETT', self.c.get('one'))
+        self.assertEqual('ETT', self.local.get('one'))
+        self.assertEqual(None, self.c.get('two'))
+        self.assertEqual({'remote_hits': 1, 'misses': 1}, self.c.stats.to_dict()['counters'])
+
+    def test_delete(self):
+        self.c.add('one', 'ett')
+        self.assertTrue(self.c.delete('one'))
+        self.assertEqual(None, self.c.get('one'))
+        self.assertEqual({}, self.local.items())
+
+
+class TestSSOSessionCacheMem(TestCase):
+    def test_sessions_for_user(self):
+        c = eduid_idp.cache.SSOSessionCacheMem(logger, 30)
+        sid1 = c.add_session('user1', {'foo': 'bar'})
+        sid2 = c.add_session('user1', {'foo': 'baz'})
+        sid3 = c.add_session('user2', {'foo': 'bar'})
+        self.assertEqual(sorted([sid1, sid2]), sorted(c.get_sessions_for_user('user1')))
+        self.assertEqual([sid3], c.get_sessions_for_user('user2'))
+        self.assertEqual([], c.get_sessions_for_user('user3'))
+        self.assertTrue(c.remove_session(sid1))
+        self.assertEqual([sid2], c.get_sessions_for_user('user1'))
+        self.assertEqual({'foo': 'baz'}, c.get_session(sid2))
+
+    def test_sessions_for_user_expired(self):
+        ttl = 30
+        c = eduid_idp.cache.SSOSessionCacheMem(logger, ttl)
+        now = int(time.time())
+        sid1 = c.add_session('user1', {'foo': 'bar'})
+        c.lid2data.add(sid1, c.lid2data.get(sid1), now = now - 60)
+        sid2 = c.add_session('user2', {'foo': 'bar'})
+        self.assertEqual(None, c.get_session(sid1))
+        self.assertEqual([], c.get_sessions_for_user('user1'))
+        self.assertEqual([sid2], c.get_sessions_for_user('user2'))
+        self.assertEqual({'user2': set([sid2])}, c._user_sessions)
+
+    def test_sessions_for_user_evicted(self):
+        c = eduid_idp.cache.SSOSessionCacheMem(logger, 30, shards = 2, max_entries = 2)
+        for this in range(10):
+            c.add_session('user1', {'foo': this})
+        self.assertEqual(sorted(c.lid2data.items().keys()), sorted(c.get_sessions_for_user('user1')))
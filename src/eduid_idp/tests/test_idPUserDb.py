@@ -34,19 +34,25 @@
 #
 
 import os
+import inspect
 import logging
 import datetime
 import pkg_resources
 
+import mock
+
 import eduid_idp
 import eduid_userdb
+import eduid_userdb.exceptions
 import eduid_common.authn
 import vccs_client
 
-from eduid_idp.testing import IdPSimpleTestCase
+import eduid_idp.testing
+from eduid_idp.testing import IdPSimpleTestCase, FakeConfig, FakeUserDb
 from eduid_userdb.testing import MongoTestCase
 from eduid_idp.idp import IdPApplication
 
+import pymongo
 from bson import ObjectId
 
 logger = logging.getLogger(__name__)
@@ -64,6 +70,59 @@ class TestIdPUserDb(IdPSimpleTestCase):
         _this = self.idp_userdb.lookup_user('test2@eduid.se')
         self.assertEqual(_this.mail_addresses.primary.email, 'test2@example.com')
 
+    def test_lookup_user_unscoped_eppn(self):
+        self.assertEqual(None, self.idp_userdb.lookup_user('test2'))
+
+    def test_lookup_user_mail_alias(self):
+        _this = self.idp_userdb.lookup_user('Test2@Example.com')
+        self.assertEqual(_this.eppn, 'test2@eduid.se')
+
+    def test_lookup_user_mail_precedence(self):
+        # another user with the first users eppn as e-mail address
+        _other = {'_id': '2' * 24,
+                  'eduPersonPrincipalName': 'test3@eduid.se',
+                  'mail': 'test1@eduid.se',
+                  'mailAliases': [{'email': 'test1@eduid.se',
+                                   'verified': True,
+                                   }],
+                  }
+        with mock.patch.object(eduid_idp.testing, '_USERDB', eduid_idp.testing._USERDB + [_other]):
+            _this = self.idp_userdb.lookup_user('test1@eduid.se')
+        # like the lookup by e-mail address before the lookup by eppn
+        self.assertEqual(_this.eppn, 'test3@eduid.se')
+
+    def test_lookup_user_multiple_mail(self):
+        _other = {'_id': '2' * 24,
+                  'eduPersonPrincipalName': 'test3@eduid.se',
+                  'mail': 'test@example.com',
+                  'mailAliases': [{'email': 'test@example.com',
+                                   'verified': True,
+                                   }],
+                  }
+        with mock.patch.object(eduid_idp.testing, '_USERDB', eduid_idp.testing._USERDB + [_other]):
+            with self.assertRaises(eduid_userdb.exceptions.MultipleUsersReturned):
+                self.idp_userdb.lookup_user('test@example.com')
+
+    def test_lookup_user_multiple_mail_and_eppn(self):
+        # two users with the e-mail address, one of them also having it as eppn
+        _other1 = {'_id': '2' * 24,
+                   'eduPersonPrincipalName': 'test3@eduid.se',
+                   'mail': 'test3@eduid.se',
+                   'mailAliases': [{'email': 'test3@eduid.se',
+                                    'verified': True,
+                                    }],
+                   }
+        _other2 = {'_id': '3' * 24,
+                   'eduPersonPrincipalName': 'test4@eduid.se',
+                   'mail': 'test3@eduid.se',
+                   'mailAliases': [{'email': 'test3@eduid.se',
+                                    'verified': True,
+                                    }],
+                   }
+        with mock.patch.object(eduid_idp.testing, '_USERDB', eduid_idp.testing._USERDB + [_other1, _other2]):
+            with self.assertRaises(eduid_userdb.exceptions.MultipleUsersReturned):
+                self.idp_userdb.lookup_user('test3@eduid.se')
+
     def test_verify_username_and_password(self):
         self.assertTrue(self._test_authn('test@example.com', 'foo'))
         self.assertTrue(self._test_authn('test@example.com', 'bar'))
@@ -81,6 +140,170 @@ class TestIdPUserDb(IdPSimpleTestCase):
         return self.authn.verify_username_and_password(data,)
 
 
+class TestIdPUserDbCache(IdPSimpleTestCase):
+
+    def setUp(self):
+        super(TestIdPUserDbCache, self).setUp()
+        config = FakeConfig()
+        config.user_cache_ttl = 60
+        config.user_cache_negative_ttl = 60
+        config.user_cache_max_entries = 100
+        userdb = FakeUserDb()
+        self.lookups = []
+        _get_user_by_filter = userdb._get_user_by_filter
+
+        def _counting_get_user_by_filter(spec, raise_on_missing=True, return_list=False):
+            self.lookups.append(spec)
+            return _get_user_by_filter(spec, raise_on_missing, return_list)
+
+        userdb._get_user_by_filter = _counting_get_user_by_filter
+        self.idp_userdb = eduid_idp.idp_user.IdPUserDb(logger, config, userdb = userdb)
+
+    def test_cached_user(self):
+        _this = self.idp_userdb.lookup_user('test@example.com')
+        _lookups = len(self.lookups)
+        self.assertEqual(_this, self.idp_userdb.lookup_user('TEST@example.com'))
+        # the user is also cached by eppn and user id
+        self.assertEqual(_this, self.idp_userdb.lookup_user('test1@eduid.se'))
+        self.assertEqual(_this, self.idp_userdb.lookup_user(_this.user_id))
+        self.assertEqual(_lookups, len(self.lookups))
+
+    def test_negative_cache(self):
+        self.assertEqual(None, self.idp_userdb.lookup_user('nobody@example.com'))
+        _lookups = len(self.lookups)
+        self.assertEqual(None, self.idp_userdb.lookup_user('nobody@example.com'))
+        self.assertEqual(_lookups, len(self.lookups))
+        self.idp_userdb.invalidate('nobody@example.com')
+        self.assertEqual(None, self.idp_userdb.lookup_user('nobody@example.com'))
+        self.assertTrue(len(self.lookups) > _lookups)
+
+    def test_lookup_user_no_cache(self):
+        _this = self.idp_userdb.lookup_user('test@example.com')
+        _lookups = len(self.lookups)
+        _fresh = self.idp_userdb.lookup_user('test@example.com', use_cache = False)
+        self.assertTrue(len(self.lookups) > _lookups)
+        # the cache is refreshed with the user loaded from the database
+        self.assertIs(_fresh, self.idp_userdb.lookup_user('test@example.com'))
+
+    def test_invalidate_user(self):
+        _this = self.idp_userdb.lookup_user('test@example.com')
+        self.idp_userdb.invalidate_user(_this)
+        _lookups = len(self.lookups)
+        self.idp_userdb.lookup_user('test1@eduid.se')
+        self.assertTrue(len(self.lookups) > _lookups)
+
+
+class TestIdPUserDbProjection(IdPSimpleTestCase):
+
+    def test_projection(self):
+        config = FakeConfig()
+        config.userdb_projection = True
+        userdb = FakeUserDb()
+        userdb._coll = mock.Mock()
+        userdb._coll.find.return_value = [dict(eduid_idp.testing._USERDB[1])]
+        idp_userdb = eduid_idp.idp_user.IdPUserDb(logger, config, userdb = userdb)
+        _this = idp_userdb.lookup_user('test2@eduid.se')
+        self.assertEqual(_this.mail_addresses.primary.email, 'test2@example.com')
+        (_spec, _fields), = [x[0] for x in userdb._coll.find.call_args_list]
+        self.assertIn('passwords', _fields)
+        self.assertNotIn('phone', _fields)
+
+    def test_projection_tou(self):
+        config = FakeConfig()
+        config.userdb_projection = True
+        _data = dict(eduid_idp.testing._USERDB[1])
+        _data['tou'] = [{'event_type': 'tou_event',
+                         'event_id': ObjectId(),
+                         'version': '2016-v1',
+                         'created_by': 'eduid_tou_plugin',
+                         'created_ts': datetime.datetime(2016, 1, 1),
+                         }]
+        _data['phone'] = [{'number': '+46700011336',
+                           'verified': True,
+                           'primary': True,
+                           }]
+
+        def _find(spec, fields):
+            return [dict([(k, v) for (k, v) in _data.items() if k in fields])]
+
+        userdb = FakeUserDb()
+        userdb._coll = mock.Mock()
+        userdb._coll.find.side_effect = _find
+        idp_userdb = eduid_idp.idp_user.IdPUserDb(logger, config, userdb = userdb)
+        _this = idp_userdb.lookup_user('test2@eduid.se')
+        # the ToU plugin checks this for every login, so it must survive the projection
+        self.assertTrue(_this.tou.has_accepted('2016-v1'))
+
+    def test_no_projection(self):
+        config = FakeConfig()
+        config.userdb_projection = True
+        userdb = FakeUserDb()
+        userdb._coll = mock.Mock()
+        idp_userdb = eduid_idp.idp_user.IdPUserDb(logger, config, userdb = userdb)
+        _this = idp_userdb.lookup_user('test2@eduid.se', projection = False)
+        self.assertEqual(_this.mail_addresses.primary.email, 'test2@example.com')
+        self.assertFalse(userdb._coll.find.called)
+
+
+class TestAttributeRelease(IdPSimpleTestCase):
+
+    def setUp(self):
+        super(TestAttributeRelease, self).setUp()
+        config = FakeConfig()
+        config.default_eppn_scope = 'eduid.se'
+        config.default_scoped_affiliation = 'member@eduid.se'
+        self.release = eduid_idp.idp_user.AttributeRelease(config, logger)
+        self.user = self.idp_userdb.lookup_user('test@example.com')
+        self.user.modified_ts = datetime.datetime(2015, 1, 1)
+
+    def test_attributes(self):
+        attributes = self.release.get_attributes(self.user)
+        self.assertEqual(attributes['eduPersonScopedAffiliation'], 'member@eduid.se')
+        self.assertIn('eduPersonAssurance', attributes)
+        self.assertNotIn('passwords', attributes)
+
+    def test_memoized(self):
+        first = self.release.get_attributes(self.user)
+        with mock.patch.object(self.user, 'to_dict') as _to_dict:
+            self.assertEqual(first, self.release.get_attributes(self.user))
+            self.assertFalse(_to_dict.called)
+            self.user.modified_ts = datetime.datetime(2015, 1, 2)
+            _to_dict.return_value = {}
+            self.release.get_attributes(self.user)
+            self.assertTrue(_to_dict.called)
+
+    def test_memoized_copy(self):
+        first = self.release.get_attributes(self.user)
+        first['eduPersonScopedAffiliation'] = 'modified'
+        second = self.release.get_attributes(self.user)
+        self.assertEqual(second['eduPersonScopedAffiliation'], 'member@eduid.se')
+
+
+class TestUserDBInternals(MongoTestCase):
+    """
+    IdPUserDb uses some internals of eduid_userdb.UserDB (see eduid_idp.idp_user._query_userdb()),
+    make sure they are still there.
+    """
+
+    def setUp(self):
+        super(TestUserDBInternals, self).setUp(celery=None, get_attribute_manager=None)
+
+    def test_get_user_by_filter(self):
+        _args = inspect.getargspec(eduid_userdb.UserDB._get_user_by_filter).args
+        self.assertEqual(['self', 'filter', 'raise_on_missing', 'return_list'], _args)
+        _user = self.amdb.get_user_by_mail('johnsmith@example.com')
+        _users = self.amdb._get_user_by_filter({'_id': _user.user_id}, raise_on_missing=False, return_list=True)
+        self.assertEqual([_user.user_id], [x.user_id for x in _users])
+        self.assertEqual([], self.amdb._get_user_by_filter({'_id': ObjectId()},
+                                                           raise_on_missing=False, return_list=True))
+
+    def test_collection(self):
+        self.assertIsInstance(self.amdb._coll, pymongo.collection.Collection)
+        _user = self.amdb.get_user_by_mail('johnsmith@example.com')
+        _doc = self.amdb._coll.find_one({'_id': _user.user_id}, ['eduPersonPrincipalName'])
+        self.assertEqual(['_id', 'eduPersonPrincipalName'], sorted(_doc.keys()))
+
+
 class TestAuthentication(MongoTestCase):
 
     def setUp(self):
@@ -96,6 +319,7 @@ class TestAuthentication(MongoTestCase):
 
         # Create the IdP app
         self.idp_app = IdPApplication(logger, self.config)
+        self.addCleanup(self.idp_app.stop)
 
         self.test_user = self.amdb.get_user_by_mail('johnsmith@example.com')
         assert isinstance(self.test_user, eduid_userdb.User)
@@ -126,6 +350,20 @@ class TestAuthentication(MongoTestCase):
                 }
         self.assertTrue(self.idp_app.authn.verify_username_and_password(data))
 
+    def test_authn_info_credentials(self):
+        assert isinstance(self.test_user, eduid_userdb.User)
+        passwords = self.test_user.passwords.to_list()
+        authn_store = self.idp_app.authn.authn_store
+        info = authn_store.get_user_authn_info(self.test_user)
+        self.assertTrue(info.has_credential(passwords[0].key))
+        self.assertEqual(None, info.credential_last_used(passwords[0].key))
+        ts = datetime.datetime(2015, 1, 1)
+        authn_store.credential_success([passwords[0].key], ts)
+        authn_store.update_user(self.test_user.user_id, [passwords[0].key], [], ts)
+        info = authn_store.get_user_authn_info(self.test_user)
+        self.assertEqual(ts, info.credential_last_used(passwords[0].key))
+        self.assertEqual([passwords[0].key], info.last_used_credentials())
+
     def test_authn_expired_credential(self):
         assert isinstance(self.test_user, eduid_userdb.User)
         passwords = self.test_user.passwords.to_list()
@@ -144,3 +382,24 @@ class TestAuthentication(MongoTestCase):
         # expired credential.
         with self.assertRaises(eduid_idp.error.Forbidden):
             self.assertTrue(self.idp_app.authn.verify_username_and_password(data))
+
+    def test_reload_config(self):
+        pinned = self.idp_app.pinned()
+        _ticket = self.idp_app.IDP.ticket
+        self.assertTrue(self.idp_app.reload_config())
+        # requests in progress keep using the configuration they started with
+        self.assertIs(self.config, pinned.config)
+        self.assertIs(pinned.IDP, pinned.IDP.ticket.IDP)
+        self.assertIs(self.config, pinned.IDP.ticket.config)
+        self.assertIs(self.config, pinned.authn.config)
+        self.assertIs(pinned.userdb, pinned.authn.userdb)
+        # while new requests use the new configuration
+        self.assertIsNot(self.config, self.idp_app.config)
+        self.assertIs(self.idp_app.IDP, self.idp_app.IDP.ticket.IDP)
+        self.assertIs(self.idp_app.config, self.idp_app.IDP.ticket.config)
+        self.assertIs(self.idp_app.config, self.idp_app.authn.config)
+        self.assertIs(self.idp_app.userdb, self.idp_app.authn.userdb)
+        # sharing the SSO sessions and login states
+        self.assertIs(pinned.IDP.cache, self.idp_app.IDP.cache)
+        self.assertIs(_ticket, pinned.IDP.ticket)
+        self.assertIs(_ticket._cache, self.idp_app.IDP.ticket._cache)
@@ -0,0 +1,103 @@
+#!/usr/bin/python
+#
+# Copyright (c) 2013 NORDUnet A/S
+# All rights reserved.
+#
+#   Redistribution and use in source and binary forms, with or
+#   without modification, are permitted provided that the following
+#   conditions are met:
+#
+#     1. Redistributions of source code must retain the above copyright
+#        notice, this list of conditions and the following disclaimer.
+#     2. Redistributions in binary form must reproduce the above
+#        copyright notice, this list of conditions and the following
+#        disclaimer in the documentation and/or other materials provided
+#        with the distribution.
+#     3. Neither the name of the NORDUnet nor the names of its
+#        contributors may be used to endorse or promote products derived
+#        from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS
+# FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE
+# COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT,
+# INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING,
+# BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT
+# LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN
+# ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+#
+# Author : Fredrik Thulin <fredrik@thulin.net>
+
+import logging
+from unittest import TestCase
+
+from saml2.assertion import Policy
+from saml2.saml import NAME_FORMAT_URI
+
+from eduid_idp.policy import CachingPolicy
+
+logger = logging.getLogger(__name__)
+
+_SWAMID_CATEGORIES = ['http://www.swamid.se/category/research-and-education',
+                      'http://www.swamid.se/category/nren-service',
+                      ]
+
+
+class FakeMetadataStore(object):
+
+    def __init__(self):
+        self.calls = []
+
+    def entity_categories(self, entity_id):
+        self.calls.append(('entity_categories', entity_id))
+        if entity_id == 'https://rs.example.org/sp':
+            return _SWAMID_CATEGORIES
+        return []
+
+    def attribute_requirement(self, entity_id, index = None):
+        self.calls.append(('attribute_requirement', entity_id))
+        return {'required': [], 'optional': []}
+
+
+class TestCachingPolicy(TestCase):
+
+    def setUp(self):
+        self.policy = CachingPolicy(Policy({'default': {'name_form': NAME_FORMAT_URI,
+                                                        'entity_categories': ['swamid', 'edugain'],
+                                                        }}), logger, ttl = 60)
+        self.mds = FakeMetadataStore()
+        self.ava = {'eduPersonPrincipalName': ['test@eduid.se'],
+                    'displayName': ['Test Testsson'],
+                    'norEduPersonNIN': ['190102031234'],
+                    }
+
+    def test_restrict(self):
+        res = self.policy.restrict(dict(self.ava), 'https://rs.example.org/sp', self.mds)
+        self.assertEqual(['test@eduid.se'], res['eduPersonPrincipalName'])
+        self.assertEqual(['Test Testsson'], res['displayName'])
+        self.assertNotIn('norEduPersonNIN', res)
+        self.assertEqual({}, self.policy.restrict(dict(self.ava), 'https://other.example.org/sp', self.mds))
+
+    def test_same_as_policy(self):
+        _policy = Policy({'default': {'entity_categories': ['swamid', 'edugain']}})
+        for sp in ['https://rs.example.org/sp', 'https://other.example.org/sp']:
+            self.assertEqual(_policy.restrict(dict(self.ava), sp, self.mds),
+                             self.policy.restrict(dict(self.ava), sp, self.mds))
+
+    def test_cached(self):
+        self.policy.restrict(dict(self.ava), 'https://rs.example.org/sp', self.mds)
+        _calls = len(self.mds.calls)
+        self.policy.restrict(dict(self.ava), 'https://rs.example.org/sp', self.mds)
+        self.assertEqual(_calls, len(self.mds.calls))
+        self.assertEqual(NAME_FORMAT_URI, self.policy.get_name_form('https://rs.example.org/sp'))
+
+    def test_clear(self):
+        self.policy.restrict(dict(self.ava), 'https://rs.example.org/sp', self.mds)
+        _calls = len(self.mds.calls)
+        self.policy.clear()
+        self.policy.restrict(dict(self.ava), 'https://rs.example.org/sp', self.mds)
+        self.assertTrue(len(self.mds.calls) > _calls)
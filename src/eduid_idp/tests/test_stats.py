@@ -0,0 +1,78 @@
+#!/usr/bin/python
+#
+# Copyright (c) 2013 NORDUnet A/S
+# All rights reserved.
+#
+#   Redistribution and use in source and binary forms, with or
+#   without modification, are permitted provided that the following
+#   conditions are met:
+#
+#     1. Redistributions of source code must retain the above copyright
+#        notice, this list of conditions and the following disclaimer.
+#     2. Redistributions in binary form must reproduce the above
+#        copyright notice, this list of conditions and the following
+#        disclaimer in the documentation and/or other materials provided
+#        with the distribution.
+#     3. Neither the name of the NORDUnet nor the names of its
+#        contributors may be used to endorse or promote products derived
+#        from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS
+# FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE
+# COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT,
+# INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING,
+# BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT
+# LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN
+# ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+#
+# Author : Fredrik Thulin <fredrik@thulin.net>
+#
+
+from unittest import TestCase
+
+from eduid_idp.stats import Stats, merge_stats
+
+
+class TestStats(TestCase):
+    def test_counters(self):
+        s = Stats()
+        self.assertEqual(0, s.get('hits'))
+        s.incr('hits')
+        s.incr('hits', 2)
+        self.assertEqual(3, s.get('hits'))
+        self.assertEqual({'hits': 3}, s.to_dict()['counters'])
+
+    def test_latency(self):
+        s = Stats(buckets = (0.1, 1.0))
+        s.observe('get', 0.05)
+        s.observe('get', 0.5)
+        s.observe('get', 5)
+        res = s.to_dict()['latency']['get']
+        self.assertEqual(3, res['count'])
+        self.assertAlmostEqual(5.55, res['sum'])
+        self.assertEqual({0.1: 1, 1.0: 2}, res['buckets'])
+
+    def test_timed_error(self):
+        s = Stats()
+        with self.assertRaises(ValueError):
+            with s.timed('get'):
+                raise ValueError('test')
+        self.assertEqual(1, s.get('get_errors'))
+        self.assertEqual(1, s.to_dict()['latency']['get']['count'])
+
+    def test_merge(self):
+        s1 = Stats(buckets = (1.0,))
+        s2 = Stats(buckets = (1.0,))
+        s1.incr('hits')
+        s2.incr('hits')
+        s2.incr('misses')
+        s1.observe('get', 0.5)
+        s2.observe('get', 2.0)
+        res = merge_stats([s1.to_dict(), s2.to_dict()])
+        self.assertEqual({'hits': 2, 'misses': 1}, res['counters'])
+        self.assertEqual({'count': 2, 'sum': 2.5, 'buckets': {1.0: 1}}, res['latency']['get'])
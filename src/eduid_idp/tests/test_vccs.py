@@ -0,0 +1,123 @@
+#
+# Copyright (c) 2016 NORDUnet A/S
+# All rights reserved.
+#
+#   Redistribution and use in source and binary forms, with or
+#   without modification, are permitted provided that the following
+#   conditions are met:
+#
+#     1. Redistributions of source code must retain the above copyright
+#        notice, this list of conditions and the following disclaimer.
+#     2. Redistributions in binary form must reproduce the above
+#        copyright notice, this list of conditions and the following
+#        disclaimer in the documentation and/or other materials provided
+#        with the distribution.
+#     3. Neither the name of the NORDUnet nor the names of its
+#        contributors may be used to endorse or promote products derived
+#        from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS
+# FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE
+# COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT,
+# INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING,
+# BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT
+# LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN
+# ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+#
+# Author : Fredrik Thulin <fredrik@thulin.net>
+#
+
+import socket
+import inspect
+import logging
+from unittest import TestCase
+
+import mock
+import vccs_client
+
+from eduid_idp.vccs import HTTPConnectionPool, PooledVCCSClient, VCCSPoolTimeout
+from eduid_idp.testing import FakeVCCSServer
+
+logger = logging.getLogger(__name__)
+
+
+class TestHTTPConnectionPool(TestCase):
+
+    def setUp(self):
+        self.server = FakeVCCSServer()
+        self.pool = HTTPConnectionPool(self.server.url, logger, size = 2, timeout = 1)
+
+    def tearDown(self):
+        self.pool.close()
+        self.server.stop()
+
+    def test_keepalive(self):
+        for _ in range(5):
+            status, _reason, data = self.pool.request('POST', 'authenticate', 'request=x')
+            self.assertEqual(200, status)
+            self.assertIn('auth_response', data)
+        self.assertEqual(5, self.server.requests)
+        self.assertEqual(1, self.server.connections)
+        stats = self.pool.get_stats()
+        self.assertEqual(1, stats['counters']['connections_created'])
+        self.assertEqual(4, stats['counters']['connections_reused'])
+        self.assertEqual(0, stats['pool']['in_use'])
+
+    def test_reconnect(self):
+        self.pool.request('POST', 'authenticate', 'request=x')
+        # make the server close the kept-alive connection
+        conn = self.pool._pool.get()
+        conn.sock.shutdown(2)
+        self.pool._pool.put(conn)
+        status, _reason, _data = self.pool.request('POST', 'authenticate', 'request=x')
+        self.assertEqual(200, status)
+        counters = self.pool.get_stats()['counters']
+        self.assertEqual(1, counters['connections_dropped'])
+        self.assertEqual(0, counters.get('retries', 0))
+        self.assertEqual(2, counters['connections_created'])
+        self.assertEqual(2, self.server.connections)
+
+    def test_retry_send(self):
+        self.pool.request('POST', 'authenticate', 'request=x')
+        conn = self.pool._pool.get()
+        conn.sock.shutdown(2)
+        self.pool._pool.put(conn)
+        # a closed connection that isn't detected before use makes the send fail
+        with mock.patch('eduid_idp.vccs._is_dropped', return_value = False):
+            status, _reason, _data = self.pool.request('POST', 'authenticate', 'request=x')
+        self.assertEqual(200, status)
+        counters = self.pool.get_stats()['counters']
+        self.assertEqual(1, counters['retries'])
+        self.assertEqual(2, counters['connections_created'])
+
+    def test_no_retry_after_send(self):
+        self.pool.request('POST', 'authenticate', 'request=x')
+        self.server.delay = 0.5
+        # the request might have been processed by the server, so it must not be retried
+        with self.assertRaises(socket.timeout):
+            self.pool.request('POST', 'authenticate', 'request=x', timeout = 0.1)
+        counters = self.pool.get_stats()['counters']
+        self.assertEqual(0, counters.get('retries', 0))
+        self.assertEqual(1, counters['errors'])
+
+    def test_pool_timeout(self):
+        _conns = [self.pool._get_connection(1), self.pool._get_connection(1)]
+        with self.assertRaises(VCCSPoolTimeout):
+            self.pool.request('POST', 'authenticate', 'request=x', timeout = 0.1)
+        self.assertEqual(2, self.pool.get_stats()['pool']['max_in_use'])
+
+
+class TestPooledVCCSClient(TestCase):
+
+    def test_vccs_client_internals(self):
+        # PooledVCCSClient replaces this internal method of vccs_client.VCCSClient, so
+        # make sure it still exists, with the same arguments, in the installed vccs_client
+        _method = vccs_client.VCCSClient._execute_request_response
+        self.assertEqual(['self', 'service', 'values'], inspect.getargspec(_method).args)
+        self.assertEqual(inspect.getargspec(_method),
+                         inspect.getargspec(PooledVCCSClient._execute_request_response))
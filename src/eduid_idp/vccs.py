@@ -0,0 +1,280 @@
+#
+# Copyright (c) 2016 NORDUnet A/S
+# All rights reserved.
+#
+#   Redistribution and use in source and binary forms, with or
+#   without modification, are permitted provided that the following
+#   conditions are met:
+#
+#     1. Redistributions of source code must retain the above copyright
+#        notice, this list of conditions and the following disclaimer.
+#     2. Redistributions in binary form must reproduce the above
+#        copyright notice, this list of conditions and the following
+#        disclaimer in the documentation and/or other materials provided
+#        with the distribution.
+#     3. Neither the name of the NORDUnet nor the names of its
+#        contributors may be used to endorse or promote products derived
+#        from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS
+# FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE
+# COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT,
+# INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING,
+# BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT
+# LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN
+# ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+#
+# Author : Fredrik Thulin <fredrik@thulin.net>
+#
+"""
+Pooled, keep-alive HTTP transport for the VCCS authentication backend client.
+"""
+
+import Queue
+import socket
+import select
+import urllib
+import httplib
+import urlparse
+import threading
+
+import vccs_client
+
+import eduid_idp.stats
+
+
+class VCCSPoolTimeout(Exception):
+    """
+    No connection to VCCS became available in time.
+    """
+    pass
+
+
+class HTTPConnectionPool(object):
+    """
+    Thread safe pool of keep-alive HTTP(S) connections to a single server.
+
+    Connections are created when needed, up to `size' of them, and are re-used
+    (most recently used first) for subsequent requests. A request waits at most
+    `timeout' seconds for a connection to become available.
+
+    :param base_url: URL of the server, path included
+    :param logger: logging logger instance
+    :param size: maximum number of connections
+    :param timeout: socket timeout in seconds, for connecting and for every read
+
+    :type base_url: str
+    :type logger: logging.Logger
+    :type size: int
+    :type timeout: int | float
+    """
+
+    def __init__(self, base_url, logger, size = 10, timeout = 5):
+        self.logger = logger
+        self.size = size
+        self.timeout = timeout
+        self.stats = eduid_idp.stats.Stats()
+        _url = urlparse.urlsplit(base_url)
+        self._connection_class = httplib.HTTPConnection
+        if _url.scheme == 'https':
+            self._connection_class = httplib.HTTPSConnection
+        self._host = _url.hostname
+        self._port = _url.port
+        self.path = _url.path or '/'
+        # None is a slot for a connection that has not been created yet
+        self._pool = Queue.LifoQueue(maxsize = size)
+        for _ in range(size):
+            self._pool.put(None)
+        self._lock = threading.Lock()
+        self._in_use = 0
+        self._max_in_use = 0
+
+    def _get_connection(self, timeout):
+        """
+        Get a connection from the pool, waiting for one to become available if necessary.
+
+        :type timeout: int | float
+        :rtype: httplib.HTTPConnection
+        """
+        try:
+            conn = self._pool.get(timeout = timeout)
+        except Queue.Empty:
+            self.stats.incr('pool_timeouts')
+            raise VCCSPoolTimeout('No connection to {!s} available within {!s} seconds'.format(self._host, timeout))
+        with self._lock:
+            self._in_use += 1
+            self._max_in_use = max(self._in_use, self._max_in_use)
+        if conn is None:
+            conn = self._connection_class(self._host, self._port, timeout = timeout)
+        return conn
+
+    def _put_connection(self, conn):
+        """
+        Return a connection to the pool.
+
+        :type conn: httplib.HTTPConnection | None
+        """
+        with self._lock:
+            self._in_use -= 1
+        self._pool.put(conn)
+
+    def request(self, method, path, body = None, headers = None, timeout = None):
+        """
+        Make a HTTP request.
+
+        Kept-alive connections closed by the server while idle are detected, and
+        replaced, before being used. If sending a request on a kept-alive connection
+        still fails, it is retried once on a new connection. A request is never retried
+        once it has been sent, since VCCS requests (POST) are not idempotent.
+
+        :param method: HTTP method
+        :param path: Path to request, relative to the path of the base URL
+        :param body: Request body
+        :param headers: Request headers
+        :param timeout: Socket timeout in seconds for this request, instead of the pool default
+
+        :type method: str
+        :type path: str
+        :type body: str | None
+        :type headers: dict | None
+        :type timeout: int | float | None
+        :return: HTTP status, reason and response body
+        :rtype: (int, str, str)
+        """
+        if timeout is None:
+            timeout = self.timeout
+        conn = self._get_connection(timeout)
+        try:
+            with self.stats.timed('request'):
+                if conn.sock is not None and _is_dropped(conn.sock):
+                    self.stats.incr('connections_dropped')
+                    conn.close()
+                for attempt in [1, 2]:
+                    _reused = conn.sock is not None
+                    if _reused:
+                        self.stats.incr('connections_reused')
+                        conn.sock.settimeout(timeout)
+                    else:
+                        # httplib connects (again) on its own if the connection has been closed
+                        self.stats.incr('connections_created')
+                    conn.timeout = timeout
+                    try:
+                        conn.request(method, self.path + path, body, headers or {})
+                        break
+                    except (httplib.HTTPException, socket.error) as exc:
+                        conn.close()
+                        if attempt > 1 or not _reused:
+                            raise
+                        self.logger.debug('Request on kept-alive connection to {!s} failed, retrying: {!r}'.format(
+                            self._host, exc))
+                        self.stats.incr('retries')
+                response = conn.getresponse()
+                data = response.read()
+            if response.will_close:
+                # a new connection is made on the next request
+                conn.close()
+        except Exception:
+            self.stats.incr('errors')
+            conn.close()
+            raise
+        finally:
+            self._put_connection(conn)
+        return response.status, response.reason, data
+
+    def close(self):
+        """
+        Close all idle connections. They are re-opened if the pool is used again.
+
+        :return: None
+        """
+        _conns = []
+        while True:
+            try:
+                _conns.append(self._pool.get_nowait())
+            except Queue.Empty:
+                break
+        for conn in _conns:
+            if conn is not None:
+                conn.close()
+            self._pool.put(conn)
+
+    def get_stats(self):
+        """
+        Get statistics about the pool and the requests made.
+
+        :rtype: dict
+        """
+        res = self.stats.to_dict()
+        with self._lock:
+            res['pool'] = {'size': self.size,
+                           'in_use': self._in_use,
+                           'max_in_use': self._max_in_use,
+                           }
+        return res
+
+
+def _is_dropped(sock):
+    """
+    Check if an idle kept-alive connection has been closed by the server.
+
+    An idle connection should have nothing to read, so if it is readable the
+    server has closed it (or sent something unexpected, which is just as bad).
+
+    :type sock: socket.socket
+    :rtype: bool
+    """
+    try:
+        readable, _, _ = select.select([sock], [], [], 0)
+    except (select.error, socket.error, ValueError):
+        return True
+    return bool(readable)
+
+
+class PooledVCCSClient(vccs_client.VCCSClient):
+    """
+    VCCS client making it's requests using a HTTPConnectionPool, instead of setting
+    up a new HTTP connection for every request.
+
+    :param base_url: URL of the VCCS authentication backend
+    :param logger: logging logger instance
+    :param pool_size: maximum number of connections to VCCS
+    :param timeout: timeout in seconds of requests to VCCS
+
+    :type base_url: str
+    :type logger: logging.Logger
+    :type pool_size: int
+    :type timeout: int | float
+    """
+
+    def __init__(self, base_url, logger, pool_size = 10, timeout = 5):
+        vccs_client.VCCSClient.__init__(self, base_url = base_url)
+        self.pool = HTTPConnectionPool(base_url, logger, size = pool_size, timeout = timeout)
+
+    def _execute_request_response(self, service, values):
+        """
+        Send a request to VCCS, and return the body of the response.
+
+        :param service: VCCS service ('authenticate', 'add_creds' etc.)
+        :param values: POST parameters
+
+        :type service: str
+        :type values: dict
+        :rtype: str
+        """
+        body = urllib.urlencode(values)
+        headers = {'Content-Type': 'application/x-www-form-urlencoded'}
+        status, reason, data = self.pool.request('POST', service, body, headers)
+        if status != 200:
+            raise vccs_client.VCCSClientHTTPError(reason, status)
+        return data
+
+    def get_stats(self):
+        """
+        :rtype: dict
+        """
+        return self.pool.get_stats()